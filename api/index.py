@@ -1,11 +1,22 @@
 from http.server import BaseHTTPRequestHandler
 from backend.routes.auth import handle_auth_routes
 from backend.routes.devices import handle_device_routes
+from backend.routes.geofences import handle_geofence_routes
 from backend.routes.locations import handle_location_routes
-from backend.utils.http import error_response, parse_json_body
+from backend.utils.http import error_response, parse_request_body, response_body
 import json
+import base64
 from urllib.parse import urlparse, parse_qs
 
+def unsupported_event_stream(response):
+    """
+    Serverless functions can't hold connections open, so event stream
+    subscriptions are refused here.
+    """
+    if response.get('subscribe') is not None:
+        return error_response('Event streams are not available in serverless deployments', 501)
+    return response
+
 class VercelHandler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
         """Handle preflight requests for CORS."""
@@ -41,7 +52,7 @@ class VercelHandler(BaseHTTPRequestHandler):
                 content_length = int(self.headers.get('Content-Length', 0))
                 if content_length > 0:
                     body_data = self.rfile.read(content_length)
-                    body = parse_json_body(body_data.decode('utf-8'))
+                    body = parse_request_body(body_data.decode('utf-8'), self.headers.get('Content-Type', ''))
 
             # Get authorization header
             auth_header = self.headers.get('Authorization', '')
@@ -58,7 +69,7 @@ class VercelHandler(BaseHTTPRequestHandler):
             }
 
             # Route the request
-            response = self._route_request(request)
+            response = unsupported_event_stream(self._route_request(request))
 
             # Send the response
             self._send_response(response)
@@ -79,6 +90,10 @@ class VercelHandler(BaseHTTPRequestHandler):
         elif path.startswith('/api/devices'):
             return handle_device_routes(request)
 
+        # Geofence routes
+        elif path.startswith('/api/geofences'):
+            return handle_geofence_routes(request)
+
         # Location routes
         elif path.startswith('/api/location/'):
             return handle_location_routes(request)
@@ -107,9 +122,11 @@ class VercelHandler(BaseHTTPRequestHandler):
             self.end_headers()
 
             # Send body
-            if 'body' in response and response['body']:
-                response_data = json.dumps(response['body']).encode('utf-8')
-                self.wfile.write(response_data)
+            # Bodies are already encoded (JSON text, or bytes for binary
+            # formats); write them out unchanged like backend/server.py
+            body = response_body(response)
+            if body:
+                self.wfile.write(body.encode('utf-8') if isinstance(body, str) else body)
         except Exception as e:
             print(f"Error sending response: {str(e)}")
             # If we can't send the proper response, try to send a basic error
@@ -166,10 +183,19 @@ def handler(request, context):
                 response = handle_auth_routes(api_request)
             elif path.startswith('/api/devices'):
                 response = handle_device_routes(api_request)
+            elif path.startswith('/api/geofences'):
+                response = handle_geofence_routes(api_request)
             elif path.startswith('/api/location/'):
                 response = handle_location_routes(api_request)
             else:
                 response = error_response('Not found', 404)
+            response = unsupported_event_stream(response)
+
+            # Binary bodies (format=binary) travel base64-encoded
+            body = response_body(response)
+            is_binary = isinstance(body, bytes)
+            if is_binary:
+                body = base64.b64encode(body).decode('ascii')
 
             # Convert response format for Vercel
             return {
@@ -180,7 +206,8 @@ def handler(request, context):
                     'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
                     'Access-Control-Allow-Headers': 'Content-Type, Authorization'
                 }),
-                'body': response.get('body', '')
+                'body': body,
+                'isBase64Encoded': is_binary,
             }
 
         except Exception as route_error:
@@ -0,0 +1,418 @@
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlparse, parse_qs
+
+from .config import REALTIME_CONFIG, SERVER_CONFIG
+from .database.maintenance import start_maintenance_thread
+from .database.migrations import create_tables
+from .database.notify import ensure_listener
+from .server import dispatch_request
+from .utils.http import error_response, parse_request_body
+from .utils.pubsub import event_bus
+from .utils.rate_limit import is_rate_limited
+from .utils.sse import HEARTBEAT, RETRY, format_sse, event_id_for
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+}
+
+MAX_HEADER_LINES = 100
+MAX_LINE_LENGTH = 8192
+
+
+class BadRequest(Exception):
+    """
+    Raised when a request cannot be parsed.
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncHTTPServer:
+    """
+    HTTP/1.1 server on asyncio streams.
+
+    Each connection is a coroutine rather than a thread, so thousands of
+    idle keep-alive connections cost only a few kilobytes each. Route
+    handlers and the database layer are synchronous and run on a bounded
+    thread pool, so at most SERVER_CONFIG['threads'] requests touch the
+    database at once.
+    """
+
+    def __init__(self, host, port, threads, keepalive_timeout, max_body_size):
+        self.host = host
+        self.port = port
+        self.keepalive_timeout = keepalive_timeout
+        self.max_body_size = max_body_size
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='async-handler')
+        self._server = None
+        self.open_connections = 0
+        self.event_subscribers = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port,
+            reuse_address=True, limit=MAX_LINE_LENGTH,
+        )
+        return self._server
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        self._executor.shutdown(wait=False)
+
+    async def _handle_connection(self, reader, writer):
+        self.open_connections += 1
+        peer = writer.get_extra_info('peername')
+        client_ip = peer[0] if peer else '0.0.0.0'
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request_line = await asyncio.wait_for(
+                        self._read_line(reader, 'Request line too long', 414), self.keepalive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                except BadRequest as e:
+                    await self._write_response(writer, error_response(str(e), e.status), keep_alive=False)
+                    break
+                if not request_line:
+                    break
+                if request_line in (b'\r\n', b'\n'):
+                    # Tolerate stray blank lines between pipelined requests
+                    continue
+
+                try:
+                    method, target, version, headers, body = await self._read_request(request_line, reader)
+                except BadRequest as e:
+                    await self._write_response(writer, error_response(str(e), e.status), keep_alive=False)
+                    break
+
+                keep_alive = self._wants_keep_alive(version, headers)
+                response = await self._process(method, target, headers, body, client_ip)
+                if response.get('subscribe') is not None:
+                    # The connection stays an event stream until the client leaves
+                    await self._write_events(reader, writer, response)
+                    break
+                await self._write_response(writer, response, keep_alive, head_only=(method == 'HEAD'))
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, asyncio.IncompleteReadError) as e:
+            print(f"Client connection error: {e}")
+        except Exception as e:
+            print(f"Error handling connection: {e}")
+            traceback.print_exc()
+        finally:
+            self.open_connections -= 1
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _read_line(self, reader, message, status=400):
+        """
+        Read one line, raising BadRequest with status if it is longer than
+        MAX_LINE_LENGTH rather than letting the stream's ValueError drop
+        the connection unanswered.
+        """
+        try:
+            return await reader.readline()
+        except ValueError:
+            raise BadRequest(message, status)
+
+    async def _read_request(self, request_line, reader):
+        """
+        Parse the request line, headers and body of one HTTP/1.x request.
+        """
+        try:
+            method, target, version = request_line.decode('latin-1').rstrip('\r\n').split(' ')
+        except ValueError:
+            raise BadRequest('Malformed request line')
+        if not version.startswith('HTTP/1.'):
+            raise BadRequest('Unsupported HTTP version', 505)
+
+        headers = {}
+        for _ in range(MAX_HEADER_LINES + 1):
+            line = await self._read_line(reader, 'Header line too long', 431)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, sep, value = line.decode('latin-1').partition(':')
+            if not sep:
+                raise BadRequest('Malformed header')
+            name = name.strip().title()
+            value = value.strip()
+            headers[name] = f"{headers[name]}, {value}" if name in headers else value
+        else:
+            raise BadRequest('Too many headers', 431)
+
+        if headers.get('Expect', '').lower() == '100-continue':
+            raise BadRequest('Expect: 100-continue is not supported', 417)
+
+        body = b''
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            body = await self._read_chunked(reader)
+        elif 'Content-Length' in headers:
+            try:
+                length = int(headers['Content-Length'])
+            except ValueError:
+                raise BadRequest('Invalid Content-Length')
+            if length < 0:
+                raise BadRequest('Invalid Content-Length')
+            if length > self.max_body_size:
+                raise BadRequest('Request body too large', 413)
+            body = await reader.readexactly(length)
+
+        return method.upper(), target, version, headers, body
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        total = 0
+        while True:
+            size_line = await self._read_line(reader, 'Chunk size line too long')
+            try:
+                size = int(size_line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise BadRequest('Malformed chunk size')
+            if size == 0:
+                # Skip trailers
+                while True:
+                    trailer = await self._read_line(reader, 'Trailer line too long', 431)
+                    if trailer in (b'\r\n', b'\n', b''):
+                        break
+                return b''.join(chunks)
+            total += size
+            if total > self.max_body_size:
+                raise BadRequest('Request body too large', 413)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)  # CRLF after each chunk
+
+    def _wants_keep_alive(self, version, headers):
+        connection = headers.get('Connection', '').lower()
+        if version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    async def _process(self, method, target, headers, body, client_ip):
+        """
+        Turn a parsed request into a response using the shared route handlers.
+        """
+        if method == 'OPTIONS':
+            response_headers = dict(CORS_HEADERS)
+            response_headers['Access-Control-Max-Age'] = '86400'  # 24 hours
+            return {'status': 200, 'headers': response_headers, 'body': ''}
+
+        if is_rate_limited(client_ip):
+            return error_response('Rate limit exceeded', 429)
+
+        parsed_url = urlparse(target)
+
+        # Parse request body for POST and PUT requests
+        parsed_body = None
+        if method in ['POST', 'PUT'] and body:
+            try:
+                parsed_body = parse_request_body(body.decode('utf-8'), headers.get('Content-Type', ''))
+            except UnicodeDecodeError:
+                return error_response('Invalid request body', 400)
+
+        request = {
+            'method': method,
+            'path': parsed_url.path,
+            'query_params': parse_qs(parsed_url.query),
+            'body': parsed_body,
+            'headers': headers,
+            'auth_header': headers.get('Authorization', ''),
+            'client_ip': client_ip,
+        }
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, dispatch_request, request)
+        except Exception as e:
+            print(f"Error routing request: {e}")
+            traceback.print_exc()
+            return error_response('Internal server error', 500)
+
+    async def _write_response(self, writer, response, keep_alive, head_only=False):
+        if response.get('stream') is not None:
+            await self._write_stream(writer, response, head_only)
+            return
+
+        status = response['status']
+        body = response.get('body') or ''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ''
+
+        headers = dict(CORS_HEADERS)
+        headers.update(response.get('headers', {}))
+        headers['Content-Length'] = str(len(body))
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+
+        head = f"HTTP/1.1 {status} {reason}\r\n"
+        head += ''.join(f"{name}: {value}\r\n" for name, value in headers.items())
+        head += "\r\n"
+
+        writer.write(head.encode('latin-1'))
+        if body and not head_only:
+            writer.write(body)
+        await writer.drain()
+
+
+    async def _write_stream(self, writer, response, head_only=False):
+        """
+        Write a streamed response with chunked transfer encoding. The stream
+        is a synchronous generator that may block on the database, so each
+        chunk is produced on the handler thread pool.
+        """
+        stream = response['stream']
+        headers = dict(CORS_HEADERS)
+        headers.update(response.get('headers', {}))
+        headers['Transfer-Encoding'] = 'chunked'
+
+        head = f"HTTP/1.1 {response['status']} {HTTPStatus(response['status']).phrase}\r\n"
+        head += ''.join(f"{name}: {value}\r\n" for name, value in headers.items())
+        head += "\r\n"
+        writer.write(head.encode('latin-1'))
+
+        loop = asyncio.get_running_loop()
+        done = object()
+        try:
+            if head_only:
+                return
+            while True:
+                chunk = await loop.run_in_executor(self._executor, next, stream, done)
+                if chunk is done:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if chunk:
+                    writer.write(f"{len(chunk):X}\r\n".encode('latin-1') + chunk + b"\r\n")
+                    await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            close = getattr(stream, 'close', None)
+            if close:
+                await loop.run_in_executor(self._executor, close)
+
+    async def _write_events(self, reader, writer, response):
+        """
+        Serve an event stream subscription on this connection until the
+        client goes away. Events are published on other threads and handed
+        to the loop; a client that falls behind loses its oldest events
+        rather than growing its buffer, and one that accepts nothing for
+        stall_timeout seconds is disconnected.
+        """
+        if self.event_subscribers >= REALTIME_CONFIG['max_subscribers']:
+            await self._write_response(writer, error_response('Too many event stream subscribers', 503), keep_alive=False)
+            return
+
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue(maxsize=REALTIME_CONFIG['buffer_size'])
+
+        def enqueue(payload):
+            if events.full():
+                events.get_nowait()
+            events.put_nowait(payload)
+
+        def deliver(device_id, event, data):
+            try:
+                loop.call_soon_threadsafe(enqueue, format_sse(event, data, event_id_for(data)))
+            except RuntimeError:
+                # The loop has been closed
+                pass
+
+        headers = dict(CORS_HEADERS)
+        headers.update(response.get('headers', {}))
+        headers['Connection'] = 'close'
+
+        head = f"HTTP/1.1 {response['status']} {HTTPStatus(response['status']).phrase}\r\n"
+        head += ''.join(f"{name}: {value}\r\n" for name, value in headers.items())
+        head += "\r\n"
+        writer.write(head.encode('latin-1') + RETRY)
+        await writer.drain()
+
+        await loop.run_in_executor(self._executor, ensure_listener)
+        token = event_bus.subscribe(response['subscribe'], deliver)
+        self.event_subscribers += 1
+
+        # Clients never send anything on an event stream; EOF means they left
+        closed = asyncio.ensure_future(reader.read(1))
+        try:
+            while True:
+                getter = asyncio.ensure_future(events.get())
+                done, _ = await asyncio.wait(
+                    {getter, closed}, timeout=REALTIME_CONFIG['heartbeat_interval'],
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if getter in done:
+                    payload = getter.result()
+                else:
+                    getter.cancel()
+                    if closed in done:
+                        break
+                    payload = HEARTBEAT
+                writer.write(payload)
+                await asyncio.wait_for(writer.drain(), REALTIME_CONFIG['stall_timeout'])
+        except asyncio.TimeoutError:
+            print("Disconnecting stalled event subscriber")
+        finally:
+            event_bus.unsubscribe(token)
+            self.event_subscribers -= 1
+            closed.cancel()
+
+async def serve():
+    server = AsyncHTTPServer(
+        SERVER_CONFIG['host'],
+        SERVER_CONFIG['port'],
+        threads=SERVER_CONFIG['threads'],
+        keepalive_timeout=SERVER_CONFIG['keepalive_timeout'],
+        max_body_size=SERVER_CONFIG['max_body_size'],
+    )
+    start_maintenance_thread()
+    try:
+        await server.serve_forever()
+    finally:
+        server.close()
+
+
+def run_async_server():
+    """
+    Run the asyncio HTTP server.
+    """
+    try:
+        # Create database tables
+        print("Initializing database...")
+        if create_tables():
+            print("Database tables created or verified successfully")
+        else:
+            print("WARNING: Database tables could not be created or verified")
+            print("The server will start, but some functionality may not work correctly")
+
+        print(f"Async server running at http://{SERVER_CONFIG['host']}:{SERVER_CONFIG['port']}")
+        print(f"Keep-alive timeout {SERVER_CONFIG['keepalive_timeout']}s, {SERVER_CONFIG['threads']} handler threads")
+        asyncio.run(serve())
+
+    except KeyboardInterrupt:
+        print("Server stopped")
+    except Exception as e:
+        print(f"Error starting server: {e}")
+        traceback.print_exc()
+
+
+if __name__ == '__main__':
+    run_async_server()
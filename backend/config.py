@@ -20,7 +20,23 @@ DB_CONFIG = {
 SERVER_CONFIG = {
     'host': os.environ.get('SERVER_HOST', '0.0.0.0'),
     'port': int(os.environ.get('PORT', 8000)),
-    'timeout': int(os.environ.get('SERVER_TIMEOUT', 30))
+    'timeout': int(os.environ.get('SERVER_TIMEOUT', 30)),
+    # Concurrency mode: 'single' (one request at a time), 'threaded' (worker
+    # thread pool) or 'prefork' (several threaded processes sharing the port)
+    'mode': os.environ.get('SERVER_MODE', 'threaded'),
+    'threads': int(os.environ.get('SERVER_THREADS', 16)),
+    # Accepted connections waiting for a worker thread; beyond this we answer 503
+    'queue_size': int(os.environ.get('SERVER_QUEUE_SIZE', 128)),
+    # Listen backlog: connections the kernel holds before accept(). Kept at
+    # least queue_size so bursts reach the queue (and its 503s) instead of
+    # having their SYNs dropped.
+    'backlog': int(os.environ.get('SERVER_BACKLOG', 1024)),
+    'workers': int(os.environ.get('SERVER_WORKERS', os.cpu_count() or 1)),
+    # Seconds between per-worker stats log lines (0 disables)
+    'stats_interval': int(os.environ.get('SERVER_STATS_INTERVAL', 0)),
+    # Asyncio server: seconds an idle keep-alive connection is held open
+    'keepalive_timeout': int(os.environ.get('SERVER_KEEPALIVE_TIMEOUT', 75)),
+    'max_body_size': int(os.environ.get('SERVER_MAX_BODY_SIZE', 10 * 1024 * 1024)),
 }
 
 # JWT configuration
@@ -30,7 +46,180 @@ JWT_CONFIG = {
     'token_expiry_minutes': int(os.environ.get('JWT_EXPIRY', 60 * 24)),
 }
 
+# Password hashing (scrypt) in a process pool
+PASSWORD_CONFIG = {
+    # scrypt cost: CPU/memory cost n (a power of two), block size r and parallelism p.
+    # Memory per hash is 128 * n * r bytes (16 MiB by default).
+    'scrypt_n': int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14)),
+    'scrypt_r': int(os.environ.get('PASSWORD_SCRYPT_R', 8)),
+    'scrypt_p': int(os.environ.get('PASSWORD_SCRYPT_P', 1)),
+    # Hashing processes per server process; 0 hashes in the calling thread
+    'workers': int(os.environ.get('PASSWORD_WORKERS', min(4, os.cpu_count() or 1))),
+    # Hashes queued or running at once; beyond this callers wait up to queue_timeout seconds
+    'max_pending': int(os.environ.get('PASSWORD_MAX_PENDING', 32)),
+    'queue_timeout': float(os.environ.get('PASSWORD_QUEUE_TIMEOUT', 5)),
+}
+
 # Rate limiting configuration
 RATE_LIMIT_CONFIG = {
+    # Token bucket per client IP: refilled at this rate, holding up to burst tokens
     'requests_per_minute': int(os.environ.get('RATE_LIMIT', 60)),
-}
\ No newline at end of file
+    'burst': int(os.environ.get('RATE_LIMIT_BURST', os.environ.get('RATE_LIMIT', 60))),
+    # Per authenticated user across all their clients (0 disables)
+    'user_requests_per_minute': int(os.environ.get('RATE_LIMIT_USER', 0)),
+    # Per client on routes under a path prefix, as "prefix=limit,..."
+    # (e.g. "/api/auth/=10,/api/location/history=30")
+    'routes': {
+        prefix.strip(): int(limit)
+        for prefix, limit in (
+            rule.split('=') for rule in os.environ.get('RATE_LIMIT_ROUTES', '').split(',') if rule.strip()
+        )
+    },
+    # Buckets tracked per limit; idle ones are evicted first, then the least recently seen
+    'max_clients': int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', 100000)),
+    # 'shared' keeps buckets in shared memory seen by every worker process,
+    # 'memory' in each process, 'auto' uses shared when running several workers
+    'backend': os.environ.get('RATE_LIMIT_BACKEND', 'auto'),
+    # Locks guarding the shared table, each covering an equal slice of it
+    'lock_stripes': int(os.environ.get('RATE_LIMIT_LOCK_STRIPES', 64)),
+}
+
+# Database connection pool configuration
+DB_POOL_CONFIG = {
+    'min_size': int(os.environ.get('DB_POOL_MIN', 1)),
+    'max_size': int(os.environ.get('DB_POOL_MAX', 10)),
+    # Seconds a request may wait for a free connection before giving up
+    'checkout_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+    # Connections older than this are closed and replaced
+    'max_lifetime': float(os.environ.get('DB_POOL_MAX_LIFETIME', 30 * 60)),
+    # Idle connections above min_size are closed after this many seconds
+    'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', 5 * 60)),
+    # Connections idle for longer than this are pinged before being handed out
+    'health_check_after': float(os.environ.get('DB_POOL_HEALTH_CHECK_AFTER', 30)),
+}
+
+# Location ingest configuration
+LOCATION_CONFIG = {
+    # Maximum number of fixes accepted by POST /api/location/batch
+    'max_batch_size': int(os.environ.get('LOCATION_MAX_BATCH', 5000)),
+    # Default and maximum page size for paginated history requests
+    'history_page_size': int(os.environ.get('LOCATION_HISTORY_PAGE_SIZE', 1000)),
+    'history_max_page_size': int(os.environ.get('LOCATION_HISTORY_MAX_PAGE_SIZE', 10000)),
+    # Rows fetched per round trip when streaming history through a server-side cursor
+    'history_stream_batch': int(os.environ.get('LOCATION_HISTORY_STREAM_BATCH', 2000)),
+    # A stop is a stretch of at least stop_min_duration seconds within stop_radius meters
+    'stop_radius_m': float(os.environ.get('LOCATION_STOP_RADIUS', 25)),
+    'stop_min_duration_s': float(os.environ.get('LOCATION_STOP_MIN_DURATION', 120)),
+    # Trips are also split wherever fixes are further apart than this many seconds
+    'trip_max_gap_s': float(os.environ.get('LOCATION_TRIP_MAX_GAP', 600)),
+    # Fixes segmented per chunk when catching up on a device's trips
+    'trip_chunk_size': int(os.environ.get('LOCATION_TRIP_CHUNK_SIZE', 50000)),
+    # Heatmap zoom levels and the longest range one request may cover
+    'heatmap_default_zoom': int(os.environ.get('LOCATION_HEATMAP_DEFAULT_ZOOM', 14)),
+    'heatmap_max_zoom': int(os.environ.get('LOCATION_HEATMAP_MAX_ZOOM', 20)),
+    'heatmap_max_days': int(os.environ.get('LOCATION_HEATMAP_MAX_DAYS', 366)),
+    # Grid cell size in degrees of the in-memory index behind /api/location/nearby
+    'nearby_cell_size': float(os.environ.get('LOCATION_NEARBY_CELL_SIZE', 0.01)),
+    'nearby_default_k': int(os.environ.get('LOCATION_NEARBY_DEFAULT_K', 10)),
+    'nearby_max_results': int(os.environ.get('LOCATION_NEARBY_MAX_RESULTS', 1000)),
+}
+
+# In-process cache configuration
+CACHE_CONFIG = {
+    # Digest of a verified bearer token -> (user id, expiry), skipping JWT
+    # decoding on repeat requests. Entries never outlive the token.
+    'token_max_size': int(os.environ.get('CACHE_TOKEN_SIZE', 100000)),
+    # Device id -> owner user id, consulted on every location write
+    'ownership_max_size': int(os.environ.get('CACHE_OWNERSHIP_SIZE', 100000)),
+    'ownership_ttl': int(os.environ.get('CACHE_OWNERSHIP_TTL', 300)),
+    # Device id -> latest fix, served to /api/location/current polls
+    'current_location_max_size': int(os.environ.get('CACHE_CURRENT_LOCATION_SIZE', 100000)),
+    'current_location_ttl': int(os.environ.get('CACHE_CURRENT_LOCATION_TTL', 30)),
+    # User id -> latest fix of each of their devices, for fleet views. Larger
+    # fleets than fleet_location_max_devices are streamed and not cached.
+    'fleet_location_max_size': int(os.environ.get('CACHE_FLEET_LOCATION_SIZE', 10000)),
+    'fleet_location_ttl': int(os.environ.get('CACHE_FLEET_LOCATION_TTL', 30)),
+    'fleet_location_max_devices': int(os.environ.get('CACHE_FLEET_LOCATION_MAX_DEVICES', 1000)),
+    # User id -> spatial index of their devices' latest positions. Kept
+    # current by ingest in this process; the ttl bounds how long writes
+    # handled by other worker processes go unseen.
+    'position_index_max_size': int(os.environ.get('CACHE_POSITION_INDEX_SIZE', 1000)),
+    'position_index_ttl': int(os.environ.get('CACHE_POSITION_INDEX_TTL', 300)),
+    # (device id, day, zoom) -> heatmap bins of a finished day
+    'heatmap_max_size': int(os.environ.get('CACHE_HEATMAP_SIZE', 10000)),
+    'heatmap_ttl': int(os.environ.get('CACHE_HEATMAP_TTL', 86400)),
+}
+
+# Locations table partitioning configuration
+PARTITION_CONFIG = {
+    # Convert locations to a range-partitioned table on startup
+    'enabled': os.environ.get('LOCATION_PARTITIONING', 'false').lower() == 'true',
+    # Partition width: 'day' or 'month'. Fixed once the table has been converted.
+    'interval': os.environ.get('LOCATION_PARTITION_INTERVAL', 'month'),
+    # Number of future partitions kept ready ahead of time
+    'premake': int(os.environ.get('LOCATION_PARTITION_PREMAKE', 3)),
+    # Partitions entirely older than this many intervals are removed (0 keeps everything)
+    'retention': int(os.environ.get('LOCATION_PARTITION_RETENTION', 0)),
+    # 'detach' leaves expired partitions as standalone tables, 'drop' deletes them
+    'retention_action': os.environ.get('LOCATION_PARTITION_RETENTION_ACTION', 'detach'),
+}
+
+# Token revocation at logout
+REVOCATION_CONFIG = {
+    # Seconds between fetches of tokens revoked by other workers
+    'sync_interval': int(os.environ.get('REVOCATION_SYNC_INTERVAL', 5)),
+}
+
+# Background maintenance configuration
+MAINTENANCE_CONFIG = {
+    # Seconds between maintenance runs in each worker (0 disables)
+    'interval': int(os.environ.get('MAINTENANCE_INTERVAL', 3600)),
+    # Seconds between folding new fixes into location_rollups (0 disables)
+    'rollup_interval': int(os.environ.get('MAINTENANCE_ROLLUP_INTERVAL', 60)),
+}
+
+# Downsampling of aged location data into locations_archive
+RETENTION_CONFIG = {
+    # Fixes older than this many days are downsampled (0 disables)
+    'raw_days': int(os.environ.get('RETENTION_RAW_DAYS', 0)),
+    # One fix is kept per device per bucket of this many seconds
+    'bucket_seconds': int(os.environ.get('RETENTION_BUCKET_SECONDS', 30)),
+    # Buckets moved per transaction, bounding rows locked at once (2 h of 1 Hz data)
+    'batch_buckets': int(os.environ.get('RETENTION_BATCH_BUCKETS', 240)),
+    'max_batches': int(os.environ.get('RETENTION_MAX_BATCHES', 500)),
+}
+
+# Hourly per-device statistics kept in location_rollups
+ROLLUP_CONFIG = {
+    # Dirty (device, hour) buckets recomputed per transaction, and batches per run
+    'batch_size': int(os.environ.get('ROLLUP_BATCH_SIZE', 500)),
+    'max_batches': int(os.environ.get('ROLLUP_MAX_BATCHES', 100)),
+}
+
+# Real-time location push (Server-Sent Events) configuration
+REALTIME_CONFIG = {
+    # 'notify' fans events out to every worker through Postgres LISTEN/NOTIFY,
+    # 'local' only reaches subscribers in the same process, 'auto' uses
+    # notify when running several worker processes
+    'fanout': os.environ.get('REALTIME_FANOUT', 'auto'),
+    'channel': os.environ.get('REALTIME_CHANNEL', 'location_events'),
+    # Seconds between heartbeat comments sent to idle subscribers
+    'heartbeat_interval': int(os.environ.get('REALTIME_HEARTBEAT', 15)),
+    # Events buffered per subscriber; the oldest are dropped beyond this
+    'buffer_size': int(os.environ.get('REALTIME_BUFFER_SIZE', 256)),
+    # Subscribers that can't accept any data for this long are disconnected
+    'stall_timeout': int(os.environ.get('REALTIME_STALL_TIMEOUT', 60)),
+    'max_subscribers': int(os.environ.get('REALTIME_MAX_SUBSCRIBERS', 10000)),
+}
+
+# Geofence evaluation on ingest
+GEOFENCE_CONFIG = {
+    'max_per_user': int(os.environ.get('GEOFENCE_MAX_PER_USER', 1000)),
+    # Grid cell size of the in-memory fence index, in degrees
+    'cell_size': float(os.environ.get('GEOFENCE_CELL_SIZE', 0.05)),
+    # Fences covering more cells than this are kept in a list checked by bounding box
+    'max_cells_per_fence': int(os.environ.get('GEOFENCE_MAX_CELLS', 4096)),
+    # User id -> fence index; other worker processes pick up changes after the ttl
+    'index_cache_size': int(os.environ.get('GEOFENCE_INDEX_CACHE_SIZE', 10000)),
+    'index_ttl': int(os.environ.get('GEOFENCE_INDEX_TTL', 60)),
+}
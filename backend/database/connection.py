@@ -1,133 +1,323 @@
+import os
 import time
+import threading
+import traceback
+from collections import deque
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
-from ..config import DB_CONFIG
-from contextlib import contextmanager
-import traceback
+from ..config import DB_CONFIG, DB_POOL_CONFIG
 
-@contextmanager
-def get_connection():
+
+def open_connection():
     """
-    Create and return a connection to the PostgreSQL database with retry logic.
-    Uses context manager pattern for automatic cleanup in serverless environments.
+    Open a new connection to the database with retry logic.
     """
-    conn = None
     max_retries = 3
     retry_count = 0
-    last_error = None
 
-    # Log connection attempt with configuration (hide password)
-    db_config_safe = DB_CONFIG.copy()
-    db_config_safe['password'] = '********'  # Hide password in logs
-    print(f"Attempting database connection with config: {db_config_safe}")
+    while True:
+        try:
+            # Connect using Supabase connection parameters
+            conn = psycopg2.connect(
+                user=DB_CONFIG['user'],
+                password=DB_CONFIG['password'],
+                host=DB_CONFIG['host'],
+                port=DB_CONFIG['port'],
+                database=DB_CONFIG['database'],
+                sslmode='require',  # Required for Supabase
+                connect_timeout=10  # Add timeout for serverless environments
+            )
+            print(f"Database connection opened to {DB_CONFIG['host']}")
+            return conn
+        except Exception as e:
+            retry_count += 1
+            print(f"Database connection attempt {retry_count} failed: {str(e)}")
+            if retry_count >= max_retries:
+                print(f"Error connecting to PostgreSQL database after {max_retries} attempts: {str(e)}")
+                print(traceback.format_exc())
+                raise Exception(f"Database connection failed: {str(e)}")
+            time.sleep(1)  # Wait before retrying
 
-    try:
-        while retry_count < max_retries:
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when no pooled connection becomes available within the checkout timeout.
+    """
+
+
+class ConnectionPool:
+    """
+    Thread-safe, bounded pool of PostgreSQL connections.
+
+    Connections are opened lazily up to max_size and handed out LIFO so that a
+    small hot set stays warm while the rest idle out. On checkout a connection
+    is recycled if it has outlived max_lifetime and pinged if it has been idle
+    for longer than health_check_after. Idle connections above min_size are
+    closed once they have been unused for max_idle seconds.
+    """
+
+    def __init__(self, min_size=1, max_size=10, checkout_timeout=10.0,
+                 max_lifetime=1800.0, max_idle=300.0, health_check_after=30.0):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.min_size = max(0, min(min_size, max_size))
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, returned_at), most recently used on the right
+        self._created_at = {}  # conn -> creation time, for every open connection
+        self._size = 0  # open connections plus connections being opened
+        self._in_use = 0
+        self._closed = False
+        self._pid = os.getpid()
+
+        # Observability counters, guarded by self._cond
+        self._checkouts = 0
+        self._timeouts = 0
+        self._waiting = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._peak_in_use = 0
+        self._opened = 0
+        self._discarded = 0
+
+    def _connect(self):
+        return open_connection()
+
+    def _close(self, conn):
+        """
+        Close a connection that has already been removed from the pool's accounting.
+        """
+        try:
+            conn.close()
+        except Exception as e:
+            print(f"Error closing database connection: {str(e)}")
+
+    def _forget_locked(self, conn):
+        self._created_at.pop(conn, None)
+        self._size -= 1
+        self._discarded += 1
+        self._cond.notify()
+
+    def _reap_idle_locked(self, now):
+        """
+        Detach idle connections that have expired. Returns them so they can be
+        closed outside the lock.
+        """
+        expired = []
+        # The least recently used connections sit on the left
+        while self._idle and self._size > self.min_size:
+            conn, returned_at = self._idle[0]
+            if now - returned_at < self.max_idle and \
+                    now - self._created_at.get(conn, now) < self.max_lifetime:
+                break
+            self._idle.popleft()
+            self._forget_locked(conn)
+            expired.append(conn)
+        return expired
+
+    def _is_healthy(self, conn, created_at, returned_at, now):
+        if conn.closed:
+            return False
+        if now - created_at >= self.max_lifetime:
+            return False
+        if now - returned_at >= self.health_check_after:
             try:
-                # Connect using Supabase connection parameters
-                conn = psycopg2.connect(
-                    user=DB_CONFIG['user'],
-                    password=DB_CONFIG['password'],
-                    host=DB_CONFIG['host'],
-                    port=DB_CONFIG['port'],
-                    database=DB_CONFIG['database'],
-                    sslmode='require',  # Required for Supabase
-                    connect_timeout=10  # Add timeout for serverless environments
-                )
-                print(f"Database connection successful to {DB_CONFIG['host']}")
-                yield conn
-                return
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conn.rollback()
             except Exception as e:
-                last_error = e
-                retry_count += 1
-                print(f"Database connection attempt {retry_count} failed: {str(e)}")
-                if retry_count >= max_retries:
-                    error_msg = f"Error connecting to PostgreSQL database after {max_retries} attempts: {str(e)}"
-                    print(error_msg)
-                    print(traceback.format_exc())
-                    raise Exception(f"Database connection failed: {str(e)}")
-                time.sleep(1)  # Wait before retrying
-    finally:
-        if conn:
+                print(f"Discarding unhealthy database connection: {e}")
+                return False
+        return True
+
+    def getconn(self):
+        """
+        Borrow a connection, waiting up to checkout_timeout for one to free up.
+        """
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+
+        while True:
+            conn = None
+            returned_at = None
+            with self._cond:
+                expired = self._reap_idle_locked(started)
+                self._waiting += 1
+                try:
+                    while True:
+                        if self._closed:
+                            raise Exception('Connection pool is closed')
+                        if self._idle:
+                            conn, returned_at = self._idle.pop()
+                            break
+                        if self._size < self.max_size:
+                            self._size += 1
+                            break
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._timeouts += 1
+                            raise PoolTimeoutError(
+                                f"No database connection available after {self.checkout_timeout}s "
+                                f"({self._in_use}/{self.max_size} in use)"
+                            )
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            for stale in expired:
+                self._close(stale)
+
+            now = time.monotonic()
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._created_at[conn] = now
+                    self._opened += 1
+            elif not self._is_healthy(conn, self._created_at.get(conn, now), returned_at, now):
+                with self._cond:
+                    self._forget_locked(conn)
+                self._close(conn)
+                continue
+
+            with self._cond:
+                waited = now - started
+                self._checkouts += 1
+                self._total_wait += waited
+                self._max_wait = max(self._max_wait, waited)
+                self._in_use += 1
+                self._peak_in_use = max(self._peak_in_use, self._in_use)
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """
+        Return a borrowed connection. Open transactions are rolled back; broken
+        connections, or ones flagged with discard, are closed instead of reused.
+        """
+        if not discard and not conn.closed:
             try:
-                conn.close()
-                print("Database connection closed")
+                status = conn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
             except Exception as e:
-                print(f"Error closing database connection: {str(e)}")
-                print(traceback.format_exc())
-def create_tables():
+                print(f"Error resetting database connection: {e}")
+                discard = True
+
+        now = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed or self._closed or \
+                    now - self._created_at.get(conn, now) >= self.max_lifetime:
+                self._forget_locked(conn)
+                to_close = [conn]
+            else:
+                self._idle.append((conn, now))
+                self._cond.notify()
+                to_close = []
+            to_close.extend(self._reap_idle_locked(now))
+
+        for stale in to_close:
+            self._close(stale)
+
+    def close(self):
+        """
+        Close all idle connections and refuse further checkouts. Connections
+        still borrowed are closed when they are returned.
+        """
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            for conn in idle:
+                self._forget_locked(conn)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        """
+        Snapshot of pool size, utilisation and checkout wait times.
+        """
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'utilisation': self._in_use / self.max_size,
+                'peak_in_use': self._peak_in_use,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'avg_wait_ms': (self._total_wait / self._checkouts * 1000) if self._checkouts else 0.0,
+                'max_wait_ms': self._max_wait * 1000,
+                'connections_opened': self._opened,
+                'connections_closed': self._discarded,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
     """
-    Create the necessary tables in the database if they don't exist.
+    Return the process-wide connection pool, creating it on first use.
     """
-    try:
-        print("Attempting to create database tables...")
-        with get_connection() as conn:
-            cursor = conn.cursor()
-
-            # Create users table
-            print("Creating users table...")
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                phone_number VARCHAR(20) UNIQUE NOT NULL,
-                name VARCHAR(100) NOT NULL,
-                email VARCHAR(100) UNIQUE NOT NULL,
-                password_hash VARCHAR(255) NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            """)
-
-            # Create devices table
-            print("Creating devices table...")
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS devices (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                device_name VARCHAR(100) NOT NULL,
-                device_id VARCHAR(100) NOT NULL,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            """)
-
-            # Create locations table
-            print("Creating locations table...")
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS locations (
-                id SERIAL PRIMARY KEY,
-                device_id INTEGER REFERENCES devices(id) ON DELETE CASCADE,
-                latitude DOUBLE PRECISION NOT NULL,
-                longitude DOUBLE PRECISION NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                accuracy DOUBLE PRECISION,
-                speed DOUBLE PRECISION,
-                heading DOUBLE PRECISION,
-                altitude DOUBLE PRECISION
-            );
-            """)
-
-            # Create sessions table
-            print("Creating sessions table...")
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS sessions (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                end_time TIMESTAMP,
-                notes TEXT
-            );
-            """)
-
-            conn.commit()
-            print("All tables created successfully")
-            return True
-    except Exception as e:
-        error_msg = f"Error creating tables: {str(e)}"
-        print(error_msg)
-        print(traceback.format_exc())
-        # Don't raise the exception, just return False to indicate failure
-        # This allows the application to continue even if table creation fails
-        return False
+    global _pool
+    if _pool is None or _pool._pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool._pid != os.getpid():
+                _pool = ConnectionPool(**DB_POOL_CONFIG)
+    return _pool
 
 
+def close_pool():
+    """
+    Close the process-wide pool. Must be called before forking worker
+    processes so that children never share a parent's sockets.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
 
+@contextmanager
+def get_connection():
+    """
+    Borrow a connection from the process-wide pool.
+    Uses context manager pattern so the connection is always returned; any
+    transaction left open by the caller is rolled back on return.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    discard = False
+    try:
+        yield conn
+    except Exception:
+        try:
+            if not conn.closed:
+                conn.rollback()
+        except Exception:
+            discard = True
+        raise
+    finally:
+        pool.putconn(conn, discard)
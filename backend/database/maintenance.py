@@ -0,0 +1,61 @@
+import time
+import threading
+import traceback
+from ..config import MAINTENANCE_CONFIG, PARTITION_CONFIG
+from .partitions import maintain_partitions
+from .retention import downsample_aged_locations
+from .revocations import prune_revocations
+from .rollups import compact_rollups
+
+def _partition_job():
+    if PARTITION_CONFIG['enabled']:
+        maintain_partitions()
+
+# Periodic database housekeeping as (name, job, interval in seconds), run in
+# order by every worker. Each job guards itself with an advisory lock or
+# row locks where running it twice would matter. An interval of 0 disables
+# the job.
+MAINTENANCE_JOBS = [
+    ('location partitions', _partition_job, MAINTENANCE_CONFIG['interval']),
+    ('location rollups', compact_rollups, MAINTENANCE_CONFIG['rollup_interval']),
+    ('location retention', downsample_aged_locations, MAINTENANCE_CONFIG['interval']),
+    ('token revocations', prune_revocations, MAINTENANCE_CONFIG['interval']),
+]
+
+def run_job(name, job):
+    """
+    Run one maintenance job, logging failures without raising.
+    """
+    try:
+        job()
+    except Exception as e:
+        print(f"Maintenance job '{name}' failed: {e}")
+        traceback.print_exc()
+
+def run_maintenance():
+    """
+    Run every maintenance job once, logging failures without stopping.
+    """
+    for name, job, _ in MAINTENANCE_JOBS:
+        run_job(name, job)
+
+def start_maintenance_thread():
+    """
+    Run each maintenance job in a daemon thread every interval seconds.
+    """
+    jobs = [(name, job, interval) for name, job, interval in MAINTENANCE_JOBS if interval > 0]
+    if not jobs:
+        return None
+
+    def loop():
+        due = {name: time.monotonic() + interval for name, _, interval in jobs}
+        while True:
+            time.sleep(max(0.0, min(due.values()) - time.monotonic()))
+            for name, job, interval in jobs:
+                if time.monotonic() >= due[name]:
+                    run_job(name, job)
+                    due[name] = time.monotonic() + interval
+
+    thread = threading.Thread(target=loop, name='db-maintenance', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,365 @@
+import re
+import sys
+import traceback
+from datetime import datetime, timedelta, timezone
+from ..config import PARTITION_CONFIG
+from .connection import get_connection
+from .models import Device, Geofence, Location, LocationRollup, Session, TripSegment
+from .partitions import ensure_partitioned
+
+# Arbitrary key for pg_advisory_lock so concurrent instances don't race
+MIGRATION_LOCK_ID = 727100
+
+# Ordered schema migrations: (version, name, steps). A step is a SQL string or
+# a callable taking a cursor. Applied migrations are recorded in
+# schema_migrations; never edit one that has shipped, append a new one.
+MIGRATIONS = [
+    (1, 'create_base_tables', [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            phone_number VARCHAR(20) UNIQUE NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            email VARCHAR(100) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS devices (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            device_name VARCHAR(100) NOT NULL,
+            device_id VARCHAR(100) NOT NULL,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS locations (
+            id SERIAL PRIMARY KEY,
+            device_id INTEGER REFERENCES devices(id) ON DELETE CASCADE,
+            latitude DOUBLE PRECISION NOT NULL,
+            longitude DOUBLE PRECISION NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            accuracy DOUBLE PRECISION,
+            speed DOUBLE PRECISION,
+            heading DOUBLE PRECISION,
+            altitude DOUBLE PRECISION
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            end_time TIMESTAMP,
+            notes TEXT
+        );
+        """,
+    ]),
+    (2, 'add_tracking_indexes', [
+        # Location.get_current / get_history: equality on device, range + sort on time
+        "CREATE INDEX IF NOT EXISTS idx_locations_device_timestamp ON locations (device_id, timestamp);",
+        # Device.get_by_user_id and the ON DELETE CASCADE from users
+        "CREATE INDEX IF NOT EXISTS idx_devices_user_id ON devices (user_id);",
+        # Session.get_by_user_id orders by start_time DESC
+        "CREATE INDEX IF NOT EXISTS idx_sessions_user_id_start_time ON sessions (user_id, start_time DESC);",
+    ]),
+    (3, 'create_device_latest_location', [
+        # One row per device holding its newest fix, maintained by Location.create
+        """
+        CREATE TABLE IF NOT EXISTS device_latest_location (
+            device_id INTEGER PRIMARY KEY REFERENCES devices(id) ON DELETE CASCADE,
+            location_id INTEGER NOT NULL,
+            latitude DOUBLE PRECISION NOT NULL,
+            longitude DOUBLE PRECISION NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            accuracy DOUBLE PRECISION,
+            speed DOUBLE PRECISION,
+            heading DOUBLE PRECISION,
+            altitude DOUBLE PRECISION
+        );
+        """,
+        """
+        INSERT INTO device_latest_location
+            (device_id, location_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude)
+        SELECT DISTINCT ON (device_id)
+            device_id, id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+        FROM locations
+        WHERE device_id IS NOT NULL AND timestamp IS NOT NULL
+        ORDER BY device_id, timestamp DESC, id DESC
+        ON CONFLICT (device_id) DO NOTHING;
+        """,
+    ]),
+    (4, 'create_geofences', [
+        """
+        CREATE TABLE IF NOT EXISTS geofences (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            name VARCHAR(100) NOT NULL,
+            kind VARCHAR(10) NOT NULL CHECK (kind IN ('circle', 'polygon')),
+            latitude DOUBLE PRECISION,
+            longitude DOUBLE PRECISION,
+            radius DOUBLE PRECISION,
+            points JSONB,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_geofences_user_id ON geofences(user_id);",
+        # Fences each device was last inside, and the fix that was evaluated
+        """
+        CREATE TABLE IF NOT EXISTS geofence_device_state (
+            device_id INTEGER PRIMARY KEY REFERENCES devices(id) ON DELETE CASCADE,
+            inside INTEGER[] NOT NULL DEFAULT '{}',
+            location_id INTEGER NOT NULL,
+            timestamp TIMESTAMP NOT NULL
+        );
+        """,
+    ]),
+    (5, 'create_trip_segments', [
+        """
+        CREATE TABLE IF NOT EXISTS trip_segments (
+            id SERIAL PRIMARY KEY,
+            device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+            kind VARCHAR(4) NOT NULL CHECK (kind IN ('trip', 'stop')),
+            start_time TIMESTAMP NOT NULL,
+            end_time TIMESTAMP NOT NULL,
+            start_location_id INTEGER NOT NULL,
+            end_location_id INTEGER NOT NULL,
+            point_count INTEGER NOT NULL,
+            distance_m DOUBLE PRECISION NOT NULL,
+            duration_s DOUBLE PRECISION NOT NULL,
+            avg_speed_mps DOUBLE PRECISION NOT NULL,
+            max_speed_mps DOUBLE PRECISION NOT NULL,
+            start_latitude DOUBLE PRECISION NOT NULL,
+            start_longitude DOUBLE PRECISION NOT NULL,
+            end_latitude DOUBLE PRECISION NOT NULL,
+            end_longitude DOUBLE PRECISION NOT NULL,
+            latitude DOUBLE PRECISION NOT NULL,
+            longitude DOUBLE PRECISION NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_trip_segments_device_start_time ON trip_segments(device_id, start_time);",
+        # Last fix covered by each device's persisted segments
+        """
+        CREATE TABLE IF NOT EXISTS trip_segment_watermarks (
+            device_id INTEGER PRIMARY KEY REFERENCES devices(id) ON DELETE CASCADE,
+            computed_until TIMESTAMP NOT NULL,
+            location_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ]),
+    (6, 'create_location_rollups', [
+        """
+        CREATE OR REPLACE FUNCTION haversine_m(
+            lat1 DOUBLE PRECISION, lon1 DOUBLE PRECISION,
+            lat2 DOUBLE PRECISION, lon2 DOUBLE PRECISION
+        ) RETURNS DOUBLE PRECISION
+        LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+            SELECT 2 * 6371008.8 * asin(sqrt(least(1.0,
+                sin(radians(lat2 - lat1) / 2) ^ 2
+                + cos(radians(lat1)) * cos(radians(lat2)) * sin(radians(lon2 - lon1) / 2) ^ 2
+            )))
+        $$;
+        """,
+        # Per device per hour statistics, maintained by database/rollups.py
+        """
+        CREATE TABLE IF NOT EXISTS location_rollups (
+            device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+            hour TIMESTAMP NOT NULL,
+            point_count INTEGER NOT NULL,
+            distance_m DOUBLE PRECISION NOT NULL,
+            min_latitude DOUBLE PRECISION NOT NULL,
+            max_latitude DOUBLE PRECISION NOT NULL,
+            min_longitude DOUBLE PRECISION NOT NULL,
+            max_longitude DOUBLE PRECISION NOT NULL,
+            max_speed DOUBLE PRECISION,
+            first_location_id INTEGER NOT NULL,
+            first_time TIMESTAMP NOT NULL,
+            first_latitude DOUBLE PRECISION NOT NULL,
+            first_longitude DOUBLE PRECISION NOT NULL,
+            last_location_id INTEGER NOT NULL,
+            last_time TIMESTAMP NOT NULL,
+            last_latitude DOUBLE PRECISION NOT NULL,
+            last_longitude DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (device_id, hour)
+        );
+        """,
+        # Buckets with fixes not yet folded into location_rollups
+        """
+        CREATE TABLE IF NOT EXISTS location_rollup_dirty (
+            device_id INTEGER NOT NULL,
+            hour TIMESTAMP NOT NULL,
+            PRIMARY KEY (device_id, hour)
+        );
+        """,
+        """
+        INSERT INTO location_rollup_dirty (device_id, hour)
+        SELECT DISTINCT device_id, date_trunc('hour', timestamp)
+        FROM locations
+        WHERE device_id IS NOT NULL AND timestamp IS NOT NULL
+        ON CONFLICT DO NOTHING;
+        """,
+    ]),
+    (7, 'create_locations_archive', [
+        # Downsampled aged fixes, keeping their original ids (database/retention.py)
+        """
+        CREATE TABLE IF NOT EXISTS locations_archive (
+            id INTEGER PRIMARY KEY,
+            device_id INTEGER REFERENCES devices(id) ON DELETE CASCADE,
+            latitude DOUBLE PRECISION NOT NULL,
+            longitude DOUBLE PRECISION NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            accuracy DOUBLE PRECISION,
+            speed DOUBLE PRECISION,
+            heading DOUBLE PRECISION,
+            altitude DOUBLE PRECISION
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_locations_archive_device_timestamp ON locations_archive(device_id, timestamp);",
+    ]),
+    (8, 'create_revoked_tokens', [
+        # Ids of tokens revoked at logout, kept until the token expires (database/revocations.py)
+        """
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            jti VARCHAR(64) PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            expires_at TIMESTAMP NOT NULL,
+            revoked_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_revoked_tokens_revoked_at ON revoked_tokens(revoked_at);",
+        "CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires_at ON revoked_tokens(expires_at);",
+    ]),
+]
+
+def hot_queries(now):
+    """
+    The hot queries as the models execute them, with sample parameters
+    for a window of the last day ending at now, as (name, query, params).
+    """
+    day_ago = now - timedelta(days=1)
+    return [
+        ('Location.get_current', Location.CURRENT_QUERY, (1,)),
+        ('Location.iter_current_for_user', Location.CURRENT_FOR_USER_QUERY, (1,)),
+        ('Location.get_history', Location.HISTORY_QUERY, (1, day_ago, now)),
+        ('Location.get_history_columns', Location.HISTORY_COLUMNS_QUERY, (1, day_ago, now, None)),
+        ('TripSegment.get_range', TripSegment.RANGE_QUERY, (1, now, day_ago, now, 0)),
+        ('LocationRollup.get_range', LocationRollup.RANGE_QUERY, ('day', 1, now - timedelta(days=90), now)),
+        ('Device.get_by_user_id', Device.BY_USER_QUERY, (1,)),
+        ('Geofence.get_by_user_id', Geofence.BY_USER_QUERY, (1,)),
+        ('Session.get_by_user_id', Session.BY_USER_QUERY, (1,)),
+    ]
+
+def run_migrations():
+    """
+    Apply any pending migrations in order, each in its own transaction.
+    Returns the list of versions applied.
+    """
+    applied = []
+    with get_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+        conn.commit()
+
+        cursor.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
+        try:
+            cursor.execute("SELECT version FROM schema_migrations;")
+            done = {row[0] for row in cursor.fetchall()}
+            conn.commit()
+
+            for version, name, steps in sorted(MIGRATIONS, key=lambda m: m[0]):
+                if version in done:
+                    continue
+
+                print(f"Applying migration {version}: {name}...")
+                try:
+                    for step in steps:
+                        if callable(step):
+                            step(cursor)
+                        else:
+                            cursor.execute(step)
+                    cursor.execute("""
+                    INSERT INTO schema_migrations (version, name)
+                    VALUES (%s, %s);
+                    """, (version, name))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                applied.append(version)
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
+            conn.commit()
+
+    return applied
+
+def create_tables():
+    """
+    Create or upgrade the database schema by running pending migrations.
+    """
+    try:
+        print("Running database migrations...")
+        applied = run_migrations()
+        if applied:
+            print(f"Applied migrations: {', '.join(str(version) for version in applied)}")
+        else:
+            print("Database schema is up to date")
+        if PARTITION_CONFIG['enabled']:
+            ensure_partitioned()
+        return True
+    except Exception as e:
+        error_msg = f"Error creating tables: {str(e)}"
+        print(error_msg)
+        print(traceback.format_exc())
+        # Don't raise the exception, just return False to indicate failure
+        # This allows the application to continue even if table creation fails
+        return False
+
+def check_query_plans():
+    """
+    EXPLAIN each hot query and report the tables it reads with a sequential
+    scan, which should be none. Sequential scans are disabled for the check
+    so that the result does not depend on how much data the tables
+    currently hold; the planner still falls back to one where no index
+    applies.
+    Returns a list of (query name, sequentially scanned tables, plan text).
+    """
+    results = []
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SET LOCAL enable_seqscan = off;")
+
+        for name, query, params in hot_queries(datetime.now(timezone.utc).replace(tzinfo=None)):
+            cursor.execute("EXPLAIN " + query, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            results.append((name, re.findall(r'Seq Scan on (\S+)', plan), plan))
+
+        conn.rollback()
+
+    return results
+
+if __name__ == '__main__':
+    # python -m backend.database.migrations [--explain]
+    if not create_tables():
+        sys.exit(1)
+    if '--explain' in sys.argv:
+        failed = False
+        for name, seq_scans, plan in check_query_plans():
+            if seq_scans:
+                failed = True
+                print(f"BAD {name} -> seq scan on {', '.join(seq_scans)}")
+                print(plan)
+            else:
+                print(f"OK  {name}")
+        sys.exit(1 if failed else 0)
@@ -1,6 +1,63 @@
-import hashlib
 import datetime
+import numpy as np
+import psycopg2.extras
+from ..config import CACHE_CONFIG
+from ..utils.cache import LRUCache
+from ..utils.passwords import HasherBusyError, password_hasher
 from .connection import get_connection
+from .notify import notify_events, use_notify
+
+# Device id -> owning user id. Ownership never changes after creation, so
+# entries only need dropping when a device is updated or deleted.
+device_owner_cache = LRUCache(CACHE_CONFIG['ownership_max_size'], CACHE_CONFIG['ownership_ttl'])
+
+# Appended to an INSERT into locations that is wrapped in an "inserted" CTE.
+# Upserts the newest inserted fix per device into device_latest_location in
+# the same statement; an out-of-order fix never replaces a newer position.
+UPSERT_LATEST_LOCATION = """
+latest AS (
+    INSERT INTO device_latest_location
+        (device_id, location_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude)
+    SELECT DISTINCT ON (device_id)
+        device_id, id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+    FROM inserted
+    ORDER BY device_id, timestamp DESC, id DESC
+    ON CONFLICT (device_id) DO UPDATE SET
+        location_id = EXCLUDED.location_id,
+        latitude = EXCLUDED.latitude,
+        longitude = EXCLUDED.longitude,
+        timestamp = EXCLUDED.timestamp,
+        accuracy = EXCLUDED.accuracy,
+        speed = EXCLUDED.speed,
+        heading = EXCLUDED.heading,
+        altitude = EXCLUDED.altitude
+    WHERE (device_latest_location.timestamp, device_latest_location.location_id)
+        < (EXCLUDED.timestamp, EXCLUDED.location_id)
+)
+"""
+
+# Appended the same way. Marks the hourly rollup buckets the inserted fixes
+# fall into for recomputation by the compaction job (database/rollups.py).
+MARK_ROLLUPS_DIRTY = """
+rollup_dirty AS (
+    INSERT INTO location_rollup_dirty (device_id, hour)
+    SELECT DISTINCT device_id, date_trunc('hour', timestamp)
+    FROM inserted
+    ON CONFLICT DO NOTHING
+)
+"""
+
+# Location history across both tiers: raw fixes and the downsampled archive
+# of aged ones (database/retention.py). Predicates on the outer query are
+# pushed into both branches, so each still uses its (device_id, timestamp)
+# index and partition pruning.
+LOCATION_HISTORY = """(
+    SELECT id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+    FROM locations
+    UNION ALL
+    SELECT id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+    FROM locations_archive
+)"""
 
 class User:
     @staticmethod
@@ -8,14 +65,12 @@ class User:
         """
         Create a new user in the database.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        # Hash the password before taking a connection; it takes a while
+        password_hash = password_hasher.hash(password)
+        
+        with get_connection() as conn:
             cursor = conn.cursor()
             
-            # Hash the password
-            password_hash = hashlib.sha256(password.encode()).hexdigest()
-            
             # Insert the user
             cursor.execute("""
             INSERT INTO users (phone_number, name, email, password_hash)
@@ -33,60 +88,65 @@ class User:
                 'email': user[3],
                 'created_at': user[4].isoformat(),
             }
-        except Exception as e:
-            if conn:
-                conn.rollback()
-            raise
-        finally:
-            if conn:
-                conn.close()
     
     @staticmethod
     def authenticate(phone_number, password):
         """
         Authenticate a user by phone number and password.
+        A legacy SHA-256 hash, or one made with an older scrypt cost, is
+        replaced with a current one once the password has matched it, unless
+        the hasher is too busy to take the extra hash.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
-            # Hash the password
-            password_hash = hashlib.sha256(password.encode()).hexdigest()
-            
             # Find the user
             cursor.execute("""
-            SELECT id, phone_number, name, email, created_at
+            SELECT id, phone_number, name, email, created_at, password_hash
             FROM users
-            WHERE phone_number = %s AND password_hash = %s;
-            """, (phone_number, password_hash))
+            WHERE phone_number = %s;
+            """, (phone_number,))
             
             user = cursor.fetchone()
+        
+        # Verify outside the connection, so slow hashing doesn't tie up the pool
+        matches, needs_upgrade = password_hasher.verify(password, user[5] if user else None)
+        if not matches:
+            return None
+        
+        if needs_upgrade:
+            try:
+                password_hash = password_hasher.hash(password)
+            except HasherBusyError:
+                # The password was right; upgrade the hash at the next login
+                password_hash = None
             
-            if user:
-                return {
-                    'id': user[0],
-                    'phone_number': user[1],
-                    'name': user[2],
-                    'email': user[3],
-                    'created_at': user[4].isoformat(),
-                }
-            else:
-                return None
-        except Exception as e:
-            raise
-        finally:
-            if conn:
-                conn.close()
+            if password_hash is not None:
+                with get_connection() as conn:
+                    cursor = conn.cursor()
+                    
+                    # Skipped if the password changed in the meantime
+                    cursor.execute("""
+                    UPDATE users SET password_hash = %s
+                    WHERE id = %s AND password_hash = %s;
+                    """, (password_hash, user[0], user[5]))
+                    
+                    conn.commit()
+        
+        return {
+            'id': user[0],
+            'phone_number': user[1],
+            'name': user[2],
+            'email': user[3],
+            'created_at': user[4].isoformat(),
+        }
     
     @staticmethod
     def get_by_id(user_id):
         """
         Get a user by ID.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
             cursor.execute("""
@@ -107,21 +167,21 @@ class User:
                 }
             else:
                 return None
-        except Exception as e:
-            raise
-        finally:
-            if conn:
-                conn.close()
 
 class Device:
+    # Statements shared with check_query_plans (database/migrations.py)
+    BY_USER_QUERY = """
+    SELECT id, user_id, device_name, device_id, is_active, created_at
+    FROM devices
+    WHERE user_id = %s;
+    """
+    
     @staticmethod
     def create(user_id, device_name, device_id):
         """
         Create a new device in the database.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
             cursor.execute("""
@@ -133,6 +193,8 @@ class Device:
             device = cursor.fetchone()
             conn.commit()
             
+            device_owner_cache.set(device[0], device[1])
+            
             return {
                 'id': device[0],
                 'user_id': device[1],
@@ -141,29 +203,16 @@ class Device:
                 'is_active': device[4],
                 'created_at': device[5].isoformat(),
             }
-        except Exception as e:
-            if conn:
-                conn.rollback()
-            raise
-        finally:
-            if conn:
-                conn.close()
     
     @staticmethod
     def get_by_user_id(user_id):
         """
         Get all devices for a user.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
-            cursor.execute("""
-            SELECT id, user_id, device_name, device_id, is_active, created_at
-            FROM devices
-            WHERE user_id = %s;
-            """, (user_id,))
+            cursor.execute(Device.BY_USER_QUERY, (user_id,))
             
             devices = cursor.fetchall()
             
@@ -175,20 +224,77 @@ class Device:
                 'is_active': device[4],
                 'created_at': device[5].isoformat(),
             } for device in devices]
-        except Exception as e:
-            raise
-        finally:
-            if conn:
-                conn.close()
+    
+    @staticmethod
+    def is_owned_by(device_id, user_id):
+        """
+        Check whether a device belongs to a user.
+        Answered from the ownership cache when possible, otherwise with a
+        primary-key lookup.
+        """
+        owner_id = device_owner_cache.get(device_id)
+        if owner_id is not None:
+            return owner_id == user_id
+        
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+            SELECT user_id
+            FROM devices
+            WHERE id = %s;
+            """, (device_id,))
+            
+            row = cursor.fetchone()
+        
+        if not row:
+            return False
+        
+        device_owner_cache.set(device_id, row[0])
+        return row[0] == user_id
+    
+    @staticmethod
+    def get_owned_ids(user_id, device_ids):
+        """
+        Return the subset of device_ids that belong to a user.
+        """
+        owned = set()
+        missing = []
+        
+        for device_id in device_ids:
+            owner_id = device_owner_cache.get(device_id)
+            if owner_id is None:
+                missing.append(device_id)
+            elif owner_id == user_id:
+                owned.add(device_id)
+        
+        if not missing:
+            return owned
+        
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+            SELECT id, user_id
+            FROM devices
+            WHERE id = ANY(%s);
+            """, (missing,))
+            
+            rows = cursor.fetchall()
+        
+        for device_id, owner_id in rows:
+            device_owner_cache.set(device_id, owner_id)
+            if owner_id == user_id:
+                owned.add(device_id)
+        
+        return owned
     
     @staticmethod
     def update(device_id, device_name=None, is_active=None):
         """
         Update a device in the database.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
             update_fields = []
@@ -206,6 +312,7 @@ class Device:
                 return None
             
             params.append(device_id)
+            device_owner_cache.delete(device_id)
             
             cursor.execute(f"""
             UPDATE devices
@@ -228,22 +335,13 @@ class Device:
                 }
             else:
                 return None
-        except Exception as e:
-            if conn:
-                conn.rollback()
-            raise
-        finally:
-            if conn:
-                conn.close()
     
     @staticmethod
     def delete(device_id):
         """
         Delete a device from the database.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
             cursor.execute("""
@@ -254,37 +352,138 @@ class Device:
             
             result = cursor.fetchone()
             conn.commit()
+            device_owner_cache.delete(device_id)
             
             return result is not None
-        except Exception as e:
-            if conn:
-                conn.rollback()
-            raise
-        finally:
-            if conn:
-                conn.close()
 
 class Location:
+    # Statements shared with check_query_plans (database/migrations.py)
+    CURRENT_QUERY = """
+    SELECT location_id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+    FROM device_latest_location
+    WHERE device_id = %s;
+    """
+    CURRENT_FOR_USER_QUERY = """
+    SELECT l.location_id, l.device_id, l.latitude, l.longitude, l.timestamp,
+           l.accuracy, l.speed, l.heading, l.altitude
+    FROM devices d
+    JOIN device_latest_location l ON l.device_id = d.id
+    WHERE d.user_id = %s
+    ORDER BY d.id;
+    """
+    HISTORY_QUERY = """
+    SELECT id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+    FROM """ + LOCATION_HISTORY + """ AS location_history
+    WHERE device_id = %s AND timestamp BETWEEN %s AND %s
+    ORDER BY timestamp ASC, id ASC;
+    """
+    # Milliseconds are floored: rounding up would put a fix after a
+    # watermark taken from its own timestamp
+    HISTORY_COLUMNS_QUERY = """
+    SELECT id, floor(EXTRACT(EPOCH FROM timestamp) * 1000)::BIGINT,
+           latitude, longitude, accuracy, speed, heading, altitude
+    FROM """ + LOCATION_HISTORY + """ AS location_history
+    WHERE device_id = %s AND timestamp BETWEEN %s AND %s
+    ORDER BY timestamp ASC, id ASC
+    LIMIT %s;
+    """
+    
     @staticmethod
-    def create(device_id, latitude, longitude, accuracy=None, speed=None, heading=None, altitude=None):
+    def create(device_id, latitude, longitude, accuracy=None, speed=None, heading=None, altitude=None, publish=False):
         """
         Create a new location record in the database.
+        With publish set and NOTIFY fan-out in use, the fix is also sent as
+        a location event in the same transaction, so it goes out exactly
+        when the row is committed.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
             cursor.execute("""
-            INSERT INTO locations (device_id, latitude, longitude, accuracy, speed, heading, altitude)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            RETURNING id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude;
+            WITH inserted AS (
+                INSERT INTO locations (device_id, latitude, longitude, accuracy, speed, heading, altitude)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+            ),
+            """ + UPSERT_LATEST_LOCATION + "," + MARK_ROLLUPS_DIRTY + """
+            SELECT id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+            FROM inserted;
             """, (device_id, latitude, longitude, accuracy, speed, heading, altitude))
             
             location = cursor.fetchone()
+            location = {
+                'id': location[0],
+                'device_id': location[1],
+                'latitude': location[2],
+                'longitude': location[3],
+                'timestamp': location[4].isoformat(),
+                'accuracy': location[5],
+                'speed': location[6],
+                'heading': location[7],
+                'altitude': location[8],
+            }
+            
+            if publish and use_notify():
+                notify_events(cursor, [(location['device_id'], 'location', location)])
             conn.commit()
             
-            return {
+            return location
+    
+    @staticmethod
+    def create_many(fixes, publish=False):
+        """
+        Insert many location records with a single multi-row INSERT.
+        Each fix is a dict with device_id, latitude, longitude and optionally
+        timestamp, accuracy, speed, heading and altitude. Returns the created
+        records in input order. publish works as for create.
+        """
+        if not fixes:
+            return []
+        
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            rows = [(
+                ordinal,
+                fix['device_id'],
+                fix['latitude'],
+                fix['longitude'],
+                fix.get('timestamp'),
+                fix.get('accuracy'),
+                fix.get('speed'),
+                fix.get('heading'),
+                fix.get('altitude'),
+            ) for ordinal, fix in enumerate(fixes)]
+            
+            # RETURNING order is unspecified, so ids are drawn up front next
+            # to each row's input position and the result is sorted by it.
+            # numbered calls nextval, so it is materialized once.
+            locations = psycopg2.extras.execute_values(cursor, """
+            WITH numbered AS (
+                SELECT nextval('locations_id_seq') AS id, input.*
+                FROM (VALUES %s) AS input (ordinal, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude)
+            ),
+            inserted AS (
+                INSERT INTO locations (id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude)
+                SELECT id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+                FROM numbered
+                RETURNING id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+            ),
+            """ + UPSERT_LATEST_LOCATION + "," + MARK_ROLLUPS_DIRTY + """
+            SELECT i.id, i.device_id, i.latitude, i.longitude, i.timestamp, i.accuracy, i.speed, i.heading, i.altitude
+            FROM inserted i
+            JOIN numbered n ON n.id = i.id
+            ORDER BY n.ordinal;
+            """, rows,
+                template=(
+                    '(%s, %s::integer, %s::double precision, %s::double precision,'
+                    ' COALESCE(%s::timestamp, CURRENT_TIMESTAMP), %s::double precision,'
+                    ' %s::double precision, %s::double precision, %s::double precision)'
+                ),
+                page_size=len(rows),
+                fetch=True,
+            )
+            locations = [{
                 'id': location[0],
                 'device_id': location[1],
                 'latitude': location[2],
@@ -294,32 +493,25 @@ class Location:
                 'speed': location[6],
                 'heading': location[7],
                 'altitude': location[8],
-            }
-        except Exception as e:
-            if conn:
-                conn.rollback()
-            raise
-        finally:
-            if conn:
-                conn.close()
+            } for location in locations]
+            
+            if publish and use_notify():
+                notify_events(cursor, [(location['device_id'], 'location', location) for location in locations])
+            conn.commit()
+            
+            return locations
     
     @staticmethod
     def get_current(device_id):
         """
         Get the most recent location for a device.
+        Reads the device's row in device_latest_location, which
+        Location.create keeps up to date.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
-            cursor.execute("""
-            SELECT id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
-            FROM locations
-            WHERE device_id = %s
-            ORDER BY timestamp DESC
-            LIMIT 1;
-            """, (device_id,))
+            cursor.execute(Location.CURRENT_QUERY, (device_id,))
             
             location = cursor.fetchone()
             
@@ -337,29 +529,92 @@ class Location:
                 }
             else:
                 return None
-        except Exception as e:
-            raise
-        finally:
-            if conn:
-                conn.close()
+    
+    @staticmethod
+    def iter_current_for_user(user_id, batch_size=2000):
+        """
+        Lazily yield the most recent location of every device a user owns
+        that has reported one, in one query over device_latest_location.
+        The connection is held until the generator is exhausted or closed.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor(name='fleet_locations')
+            cursor.itersize = batch_size
+            
+            cursor.execute(Location.CURRENT_FOR_USER_QUERY, (user_id,))
+            
+            try:
+                for location in cursor:
+                    yield {
+                        'id': location[0],
+                        'device_id': location[1],
+                        'latitude': location[2],
+                        'longitude': location[3],
+                        'timestamp': location[4].isoformat(),
+                        'accuracy': location[5],
+                        'speed': location[6],
+                        'heading': location[7],
+                        'altitude': location[8],
+                    }
+            finally:
+                cursor.close()
     
     @staticmethod
     def get_history(device_id, start_time, end_time):
         """
         Get location history for a device within a time range.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
-            cursor.execute("""
+            # The time bounds are sent as literals, so on a partitioned
+            # locations table the planner prunes to the partitions in range.
+            # Aged fixes are read from the archive tier alongside.
+            cursor.execute(Location.HISTORY_QUERY, (device_id, start_time, end_time))
+            
+            locations = cursor.fetchall()
+            
+            return [{
+                'id': location[0],
+                'device_id': location[1],
+                'latitude': location[2],
+                'longitude': location[3],
+                'timestamp': location[4].isoformat(),
+                'accuracy': location[5],
+                'speed': location[6],
+                'heading': location[7],
+                'altitude': location[8],
+            } for location in locations]
+
+    @staticmethod
+    def get_history_page(device_id, start_time, end_time, limit, after=None):
+        """
+        Get one page of location history using keyset pagination.
+        after is the (timestamp, id) of the last row of the previous page.
+        Returns (locations, has_more).
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            query = """
             SELECT id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
-            FROM locations
+            FROM """ + LOCATION_HISTORY + """ AS location_history
             WHERE device_id = %s AND timestamp BETWEEN %s AND %s
-            ORDER BY timestamp ASC;
-            """, (device_id, start_time, end_time))
+            """
+            params = [device_id, start_time, end_time]
             
+            if after is not None:
+                query += " AND (timestamp, id) > (%s, %s)"
+                params.extend(after)
+            
+            # Fetch one extra row to know whether another page follows
+            query += """
+            ORDER BY timestamp ASC, id ASC
+            LIMIT %s;
+            """
+            params.append(limit + 1)
+            
+            cursor.execute(query, params)
             locations = cursor.fetchall()
             
             return [{
@@ -372,22 +627,411 @@ class Location:
                 'speed': location[6],
                 'heading': location[7],
                 'altitude': location[8],
-            } for location in locations]
-        except Exception as e:
-            raise
-        finally:
-            if conn:
-                conn.close()
+            } for location in locations[:limit]], len(locations) > limit
+    
+    @staticmethod
+    def iter_history(device_id, start_time, end_time, batch_size=2000):
+        """
+        Lazily yield location history through a server-side cursor, fetching
+        batch_size rows per round trip so memory use does not depend on the
+        size of the time range. The connection is held until the generator
+        is exhausted or closed.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor(name='location_history')
+            cursor.itersize = batch_size
+            
+            cursor.execute(Location.HISTORY_QUERY, (device_id, start_time, end_time))
+            
+            try:
+                for location in cursor:
+                    yield {
+                        'id': location[0],
+                        'device_id': location[1],
+                        'latitude': location[2],
+                        'longitude': location[3],
+                        'timestamp': location[4].isoformat(),
+                        'accuracy': location[5],
+                        'speed': location[6],
+                        'heading': location[7],
+                        'altitude': location[8],
+                    }
+            finally:
+                cursor.close()
+
+    # Columns returned by get_history_columns, in SELECT order
+    HISTORY_COLUMNS = ('id', 'timestamp_ms', 'latitude', 'longitude', 'accuracy', 'speed', 'heading', 'altitude')
+    
+    @staticmethod
+    def get_history_columns(device_id, start_time, end_time, batch_size=2000, limit=None):
+        """
+        Get location history as parallel NumPy arrays keyed by
+        HISTORY_COLUMNS instead of a dict per row. timestamp_ms is
+        whole milliseconds since the epoch, rounded down; missing optional
+        values are NaN.
+        At most limit fixes (the oldest) are returned if given.
+        """
+        columns = [[] for _ in Location.HISTORY_COLUMNS]
+        
+        with get_connection() as conn:
+            cursor = conn.cursor(name='location_history_columns')
+            cursor.itersize = batch_size
+            
+            cursor.execute(Location.HISTORY_COLUMNS_QUERY, (device_id, start_time, end_time, limit))
+            
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for column, values in zip(columns, zip(*rows)):
+                        column.extend(values)
+            finally:
+                cursor.close()
+        
+        return {
+            'id': np.array(columns[0], dtype=np.int64),
+            'timestamp_ms': np.array(columns[1], dtype=np.int64),
+            'latitude': np.array(columns[2], dtype=float),
+            'longitude': np.array(columns[3], dtype=float),
+            # None becomes NaN
+            'accuracy': np.array(columns[4], dtype=float),
+            'speed': np.array(columns[5], dtype=float),
+            'heading': np.array(columns[6], dtype=float),
+            'altitude': np.array(columns[7], dtype=float),
+        }
+
+class Geofence:
+    # Statements shared with check_query_plans (database/migrations.py)
+    BY_USER_QUERY = """
+    SELECT id, user_id, name, kind, latitude, longitude, radius, points, created_at
+    FROM geofences
+    WHERE user_id = %s
+    ORDER BY id;
+    """
+    
+    @staticmethod
+    def _to_dict(geofence):
+        return {
+            'id': geofence[0],
+            'user_id': geofence[1],
+            'name': geofence[2],
+            'kind': geofence[3],
+            'latitude': geofence[4],
+            'longitude': geofence[5],
+            'radius': geofence[6],
+            'points': geofence[7],
+            'created_at': geofence[8].isoformat(),
+        }
+    
+    @staticmethod
+    def create(user_id, name, kind, latitude=None, longitude=None, radius=None, points=None):
+        """
+        Create a circle (center and radius in meters) or polygon ([lat, lon]
+        vertices) geofence.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+            INSERT INTO geofences (user_id, name, kind, latitude, longitude, radius, points)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING id, user_id, name, kind, latitude, longitude, radius, points, created_at;
+            """, (user_id, name, kind, latitude, longitude, radius,
+                  psycopg2.extras.Json(points) if points is not None else None))
+            
+            geofence = cursor.fetchone()
+            conn.commit()
+            
+            return Geofence._to_dict(geofence)
+    
+    @staticmethod
+    def get_by_user_id(user_id):
+        """
+        Get all geofences for a user.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(Geofence.BY_USER_QUERY, (user_id,))
+            
+            return [Geofence._to_dict(geofence) for geofence in cursor.fetchall()]
+    
+    @staticmethod
+    def count_by_user_id(user_id):
+        """
+        Count a user's geofences.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+            SELECT COUNT(*) FROM geofences WHERE user_id = %s;
+            """, (user_id,))
+            
+            return cursor.fetchone()[0]
+    
+    @staticmethod
+    def get_by_id(geofence_id, user_id):
+        """
+        Get one of a user's geofences.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+            SELECT id, user_id, name, kind, latitude, longitude, radius, points, created_at
+            FROM geofences
+            WHERE id = %s AND user_id = %s;
+            """, (geofence_id, user_id))
+            
+            geofence = cursor.fetchone()
+            
+            return Geofence._to_dict(geofence) if geofence else None
+    
+    @staticmethod
+    def delete(geofence_id, user_id):
+        """
+        Delete one of a user's geofences.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+            DELETE FROM geofences
+            WHERE id = %s AND user_id = %s
+            RETURNING id;
+            """, (geofence_id, user_id))
+            
+            deleted = cursor.fetchone()
+            conn.commit()
+            
+            return deleted is not None
+    
+    @staticmethod
+    def get_device_states(device_ids):
+        """
+        Fences each device was last inside and the (timestamp, location id)
+        of the fix that was evaluated, keyed by device id.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+            SELECT device_id, inside, timestamp, location_id
+            FROM geofence_device_state
+            WHERE device_id = ANY(%s);
+            """, (list(device_ids),))
+            
+            return {
+                row[0]: (set(row[1]), (row[2].isoformat(), row[3]))
+                for row in cursor.fetchall()
+            }
+    
+    @staticmethod
+    def save_device_states(states):
+        """
+        Store (device_id, inside, timestamp, location_id) states. A state is
+        only written if its fix is newer than the stored one, so concurrent
+        writers can't move a device backwards. Returns the device ids written.
+        """
+        if not states:
+            return set()
+        
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            written = psycopg2.extras.execute_values(cursor, """
+            INSERT INTO geofence_device_state (device_id, inside, timestamp, location_id)
+            VALUES %s
+            ON CONFLICT (device_id) DO UPDATE SET
+                inside = EXCLUDED.inside,
+                timestamp = EXCLUDED.timestamp,
+                location_id = EXCLUDED.location_id
+            WHERE (geofence_device_state.timestamp, geofence_device_state.location_id)
+                < (EXCLUDED.timestamp, EXCLUDED.location_id)
+            RETURNING device_id;
+            """, [
+                (device_id, sorted(inside), timestamp, location_id)
+                for device_id, inside, timestamp, location_id in states
+            ], template="(%s, %s::integer[], %s, %s)", page_size=len(states), fetch=True)
+            conn.commit()
+            
+            return {row[0] for row in written}
+
+class LocationRollup:
+    # Statements shared with check_query_plans (database/migrations.py)
+    RANGE_QUERY = """
+    SELECT date_trunc(%s, hour) AS bucket,
+           SUM(point_count), SUM(distance_m),
+           MIN(min_latitude), MAX(max_latitude), MIN(min_longitude), MAX(max_longitude),
+           MAX(max_speed),
+           (ARRAY_AGG(first_location_id ORDER BY hour))[1], MIN(first_time),
+           (ARRAY_AGG(first_latitude ORDER BY hour))[1], (ARRAY_AGG(first_longitude ORDER BY hour))[1],
+           (ARRAY_AGG(last_location_id ORDER BY hour DESC))[1], MAX(last_time),
+           (ARRAY_AGG(last_latitude ORDER BY hour DESC))[1], (ARRAY_AGG(last_longitude ORDER BY hour DESC))[1]
+    FROM location_rollups
+    WHERE device_id = %s AND hour >= date_trunc('hour', %s::timestamp) AND hour <= %s
+    GROUP BY bucket
+    ORDER BY bucket;
+    """
+    
+    @staticmethod
+    def get_range(device_id, start_time, end_time, interval='day'):
+        """
+        Statistics of a device per hour or day (UTC) between two times,
+        aggregated from the hourly rollups.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(LocationRollup.RANGE_QUERY, (interval, device_id, start_time, end_time))
+            
+            return [{
+                'start': row[0].isoformat(),
+                'point_count': int(row[1]),
+                'distance_m': round(row[2], 1),
+                'bounding_box': {
+                    'min_latitude': row[3],
+                    'max_latitude': row[4],
+                    'min_longitude': row[5],
+                    'max_longitude': row[6],
+                },
+                'max_speed': row[7],
+                'first': {
+                    'id': row[8],
+                    'timestamp': row[9].isoformat(),
+                    'latitude': row[10],
+                    'longitude': row[11],
+                },
+                'last': {
+                    'id': row[12],
+                    'timestamp': row[13].isoformat(),
+                    'latitude': row[14],
+                    'longitude': row[15],
+                },
+            } for row in cursor.fetchall()]
+
+# Advisory lock key (with the device id) serializing TripSegment.save per device
+TRIP_SEGMENT_LOCK = 727102
+
+class TripSegment:
+    COLUMNS = (
+        'kind', 'start_time', 'end_time', 'start_location_id', 'end_location_id', 'point_count',
+        'distance_m', 'duration_s', 'avg_speed_mps', 'max_speed_mps',
+        'start_latitude', 'start_longitude', 'end_latitude', 'end_longitude', 'latitude', 'longitude',
+    )
+    # Statements shared with check_query_plans (database/migrations.py)
+    RANGE_QUERY = f"""
+    SELECT {", ".join(COLUMNS)}
+    FROM trip_segments
+    WHERE device_id = %s AND start_time <= %s AND end_time >= %s
+        AND (end_time, end_location_id) <= (%s, %s)
+    ORDER BY start_time, id;
+    """
+    
+    @staticmethod
+    def get_watermark(device_id):
+        """
+        (timestamp, location id) of the last fix covered by a device's
+        persisted segments, or None if none have been persisted.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+            SELECT computed_until, location_id
+            FROM trip_segment_watermarks
+            WHERE device_id = %s;
+            """, (device_id,))
+            
+            row = cursor.fetchone()
+            
+            return (row[0].isoformat(), row[1]) if row else None
+    
+    @staticmethod
+    def save(device_id, segments, previous_watermark):
+        """
+        Persist closed segments computed from the fixes after
+        previous_watermark and advance the watermark to the end of the last
+        one. Nothing is written if another request got there first; returns
+        whether the segments were saved.
+        """
+        if not segments:
+            return False
+        
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("SELECT pg_try_advisory_xact_lock(%s, %s);", (TRIP_SEGMENT_LOCK, device_id))
+            if not cursor.fetchone()[0]:
+                conn.rollback()
+                return False
+            
+            cursor.execute("""
+            SELECT computed_until, location_id
+            FROM trip_segment_watermarks
+            WHERE device_id = %s;
+            """, (device_id,))
+            
+            row = cursor.fetchone()
+            if ((row[0].isoformat(), row[1]) if row else None) != previous_watermark:
+                conn.rollback()
+                return False
+            
+            psycopg2.extras.execute_values(cursor, f"""
+            INSERT INTO trip_segments (device_id, {", ".join(TripSegment.COLUMNS)})
+            VALUES %s;
+            """, [
+                (device_id, segment['type']) + tuple(segment[column] for column in TripSegment.COLUMNS[1:])
+                for segment in segments
+            ], page_size=len(segments))
+            
+            cursor.execute("""
+            INSERT INTO trip_segment_watermarks (device_id, computed_until, location_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (device_id) DO UPDATE SET
+                computed_until = EXCLUDED.computed_until,
+                location_id = EXCLUDED.location_id,
+                updated_at = CURRENT_TIMESTAMP;
+            """, (device_id, segments[-1]['end_time'], segments[-1]['end_location_id']))
+            
+            conn.commit()
+            return True
+    
+    @staticmethod
+    def get_range(device_id, start_time, end_time, until):
+        """
+        Persisted segments of a device overlapping a time range, up to and
+        including the one ending at the until watermark.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(TripSegment.RANGE_QUERY, (device_id, end_time, start_time, until[0], until[1]))
+            
+            return [{
+                'type': row[0],
+                'start_time': row[1].isoformat(),
+                'end_time': row[2].isoformat(),
+                **dict(zip(TripSegment.COLUMNS[3:], row[3:])),
+            } for row in cursor.fetchall()]
 
 class Session:
+    # Statements shared with check_query_plans (database/migrations.py)
+    BY_USER_QUERY = """
+    SELECT id, user_id, start_time, end_time, notes
+    FROM sessions
+    WHERE user_id = %s
+    ORDER BY start_time DESC;
+    """
+    
     @staticmethod
     def create(user_id, notes=None):
         """
         Create a new tracking session.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
             cursor.execute("""
@@ -406,22 +1050,13 @@ class Session:
                 'end_time': session[3].isoformat() if session[3] else None,
                 'notes': session[4],
             }
-        except Exception as e:
-            if conn:
-                conn.rollback()
-            raise
-        finally:
-            if conn:
-                conn.close()
     
     @staticmethod
     def end_session(session_id, notes=None):
         """
         End a tracking session.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
             update_query = """
@@ -457,30 +1092,16 @@ class Session:
                 }
             else:
                 return None
-        except Exception as e:
-            if conn:
-                conn.rollback()
-            raise
-        finally:
-            if conn:
-                conn.close()
     
     @staticmethod
     def get_by_user_id(user_id):
         """
         Get all sessions for a user.
         """
-        conn = None
-        try:
-            conn = get_connection()
+        with get_connection() as conn:
             cursor = conn.cursor()
             
-            cursor.execute("""
-            SELECT id, user_id, start_time, end_time, notes
-            FROM sessions
-            WHERE user_id = %s
-            ORDER BY start_time DESC;
-            """, (user_id,))
+            cursor.execute(Session.BY_USER_QUERY, (user_id,))
             
             sessions = cursor.fetchall()
             
@@ -491,8 +1112,57 @@ class Session:
                 'end_time': session[3].isoformat() if session[3] else None,
                 'notes': session[4],
             } for session in sessions]
-        except Exception as e:
-            raise
-        finally:
-            if conn:
-                conn.close()
+
+class RevokedToken:
+    @staticmethod
+    def revoke(jti, user_id, expires_at):
+        """
+        Record a token id as revoked until expires_at (naive UTC).
+        Revoking the same token twice is a no-op.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+            INSERT INTO revoked_tokens (jti, user_id, expires_at)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (jti) DO NOTHING;
+            """, (jti, user_id, expires_at))
+            
+            conn.commit()
+    
+    @staticmethod
+    def get_unexpired(now, revoked_since=None):
+        """
+        (jti, expires_at, revoked_at) of tokens revoked after revoked_since
+        (all if None) that have not expired by now.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+            SELECT jti, expires_at, revoked_at
+            FROM revoked_tokens
+            WHERE expires_at > %s
+            AND (%s::timestamp IS NULL OR revoked_at > %s);
+            """, (now, revoked_since, revoked_since))
+            
+            return cursor.fetchall()
+    
+    @staticmethod
+    def prune_expired(now):
+        """
+        Delete revocations of tokens that have expired by now.
+        Returns the number deleted.
+        """
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+            DELETE FROM revoked_tokens WHERE expires_at <= %s;
+            """, (now,))
+            
+            deleted = cursor.rowcount
+            conn.commit()
+            
+            return deleted
@@ -0,0 +1,110 @@
+import os
+import json
+import select
+import threading
+import time
+import traceback
+import psycopg2.extensions
+from psycopg2 import sql
+from ..config import REALTIME_CONFIG, SERVER_CONFIG
+from ..utils.pubsub import event_bus
+from .connection import get_connection, open_connection
+
+def use_notify():
+    """
+    Whether events fan out through Postgres NOTIFY rather than only in-process.
+    """
+    fanout = REALTIME_CONFIG['fanout']
+    if fanout == 'auto':
+        return SERVER_CONFIG['mode'] == 'prefork'
+    return fanout == 'notify'
+
+def notify_events(cursor, events):
+    """
+    Queue (device_id, event, data) tuples as NOTIFYs in the cursor's
+    transaction, in one statement. Postgres delivers them when the
+    transaction commits and drops them if it rolls back.
+    """
+    if not events:
+        return
+    payloads = [json.dumps({'device_id': device_id, 'event': event, 'data': data})
+                for device_id, event, data in events]
+    cursor.execute("""
+    SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload;
+    """, (REALTIME_CONFIG['channel'], payloads))
+
+def publish_events(events):
+    """
+    Publish (device_id, event, data) tuples to every subscriber. With
+    NOTIFY fan-out all events go out in one statement and reach this
+    process's subscribers through its own listener.
+    """
+    if not events:
+        return
+
+    if not use_notify():
+        for device_id, event, data in events:
+            event_bus.publish(device_id, event, data)
+        return
+
+    with get_connection() as conn:
+        notify_events(conn.cursor(), events)
+        conn.commit()
+
+class NotifyListener(threading.Thread):
+    """
+    Daemon thread that LISTENs on the realtime channel with a dedicated
+    connection and republishes every notification on the local event bus.
+    Reconnects after errors.
+    """
+    def __init__(self, channel):
+        super().__init__(name='notify-listener', daemon=True)
+        self.channel = channel
+
+    def run(self):
+        while True:
+            conn = None
+            try:
+                conn = open_connection()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(sql.SQL("LISTEN {};").format(sql.Identifier(self.channel)))
+                print(f"Listening for realtime events on channel {self.channel}")
+
+                while True:
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notification = conn.notifies.pop(0)
+                        try:
+                            message = json.loads(notification.payload)
+                            event_bus.publish(message['device_id'], message['event'], message['data'])
+                        except (ValueError, KeyError) as e:
+                            print(f"Ignoring malformed notification: {e}")
+            except Exception as e:
+                print(f"Realtime listener error: {e}")
+                traceback.print_exc()
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+_listener = None
+_listener_lock = threading.Lock()
+
+def ensure_listener():
+    """
+    Start this process's NOTIFY listener if fan-out uses it and it isn't
+    running yet. Called when the first subscriber arrives.
+    """
+    global _listener
+    if not use_notify():
+        return
+    with _listener_lock:
+        if _listener is None or _listener.pid != os.getpid() or not _listener.is_alive():
+            _listener = NotifyListener(REALTIME_CONFIG['channel'])
+            _listener.pid = os.getpid()
+            _listener.start()
@@ -0,0 +1,224 @@
+import re
+import sys
+from datetime import datetime, timedelta
+from psycopg2 import sql
+from ..config import PARTITION_CONFIG
+from .connection import get_connection
+
+# Arbitrary key for pg_advisory_xact_lock so only one worker maintains partitions at a time
+PARTITION_LOCK_ID = 727101
+
+LEGACY_PARTITION = 'locations_legacy'
+DEFAULT_PARTITION = 'locations_default'
+
+_BOUND_PATTERN = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+def interval_start(moment, interval):
+    """
+    Truncate a timestamp to the start of its partition interval.
+    """
+    if interval == 'day':
+        return datetime(moment.year, moment.month, moment.day)
+    return datetime(moment.year, moment.month, 1)
+
+def add_intervals(start, count, interval):
+    """
+    Move an interval start forward (or backward) by count intervals.
+    """
+    if interval == 'day':
+        return start + timedelta(days=count)
+    months = start.year * 12 + (start.month - 1) + count
+    return datetime(months // 12, months % 12 + 1, 1)
+
+def partition_name(start, interval):
+    if interval == 'day':
+        return f"locations_p{start:%Y%m%d}"
+    return f"locations_p{start:%Y%m}"
+
+def _parse_bound(value):
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(value.strip("'"))
+
+def is_partitioned(cursor):
+    """
+    Check whether the locations table is already range-partitioned.
+    """
+    cursor.execute("""
+    SELECT relkind FROM pg_class WHERE oid = to_regclass('locations');
+    """)
+    row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+def list_partitions(cursor):
+    """
+    List the partitions of locations as (name, lower, upper) tuples. Open
+    bounds are None; the default partition has both bounds None.
+    """
+    cursor.execute("""
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'locations'::regclass
+    ORDER BY c.relname;
+    """)
+
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = _BOUND_PATTERN.search(bound)
+        if match:
+            partitions.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+        else:
+            partitions.append((name, None, None))
+    return partitions
+
+def convert_to_partitioned(cursor, interval):
+    """
+    Turn the plain locations table into a table range-partitioned by
+    timestamp. The existing table is kept as is and attached as the
+    locations_legacy partition, covering everything up to the end of the
+    current interval, so no rows are copied. New partitions start where it
+    ends and the legacy partition is removed by retention once it has aged
+    out. Must run inside a transaction.
+    """
+    cursor.execute("LOCK TABLE locations IN ACCESS EXCLUSIVE MODE;")
+
+    cursor.execute("SELECT LOCALTIMESTAMP, (SELECT max(timestamp) FROM locations);")
+    now, latest = cursor.fetchone()
+    boundary = add_intervals(interval_start(max(now, latest or now), interval), 1, interval)
+
+    statements = [
+        ("UPDATE locations SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL;", None),
+        ("ALTER TABLE locations RENAME TO locations_legacy;", None),
+        ("ALTER TABLE locations_legacy RENAME CONSTRAINT locations_pkey TO locations_legacy_pkey;", None),
+        ("ALTER INDEX IF EXISTS idx_locations_device_timestamp RENAME TO idx_locations_legacy_device_timestamp;", None),
+        # A valid CHECK constraint lets SET NOT NULL and ATTACH skip their own table scans
+        ("ALTER TABLE locations_legacy ADD CONSTRAINT locations_legacy_range CHECK (timestamp IS NOT NULL AND timestamp < %s);", (boundary,)),
+        ("ALTER TABLE locations_legacy ALTER COLUMN timestamp SET NOT NULL;", None),
+        ("CREATE UNIQUE INDEX locations_legacy_id_timestamp ON locations_legacy (id, timestamp);", None),
+        ("""
+        CREATE TABLE locations (
+            id INTEGER NOT NULL DEFAULT nextval('locations_id_seq'),
+            device_id INTEGER REFERENCES devices(id) ON DELETE CASCADE,
+            latitude DOUBLE PRECISION NOT NULL,
+            longitude DOUBLE PRECISION NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            accuracy DOUBLE PRECISION,
+            speed DOUBLE PRECISION,
+            heading DOUBLE PRECISION,
+            altitude DOUBLE PRECISION,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+        """, None),
+        # Keep the id sequence alive when the legacy partition is eventually dropped
+        ("ALTER SEQUENCE locations_id_seq OWNED BY locations.id;", None),
+        ("CREATE INDEX idx_locations_device_timestamp ON locations (device_id, timestamp);", None),
+        ("ALTER TABLE locations ATTACH PARTITION locations_legacy FOR VALUES FROM (MINVALUE) TO (%s);", (boundary,)),
+        # Catches fixes beyond the premade partitions (e.g. a device with a wrong clock)
+        ("CREATE TABLE locations_default PARTITION OF locations DEFAULT;", None),
+    ]
+    for statement, params in statements:
+        cursor.execute(statement, params)
+
+def create_partition(cursor, start, interval):
+    """
+    Create and attach the partition for the interval starting at start.
+    Rows that already landed in the default partition for that range are
+    moved into it first, otherwise the attach would fail.
+    """
+    end = add_intervals(start, 1, interval)
+    name = sql.Identifier(partition_name(start, interval))
+    constraint = sql.Identifier(f"{partition_name(start, interval)}_range")
+
+    cursor.execute(sql.SQL("""
+    CREATE TABLE {name} (LIKE locations INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+    """).format(name=name))
+    cursor.execute(sql.SQL("""
+    ALTER TABLE {name} ADD CONSTRAINT {constraint} CHECK (timestamp >= %s AND timestamp < %s);
+    """).format(name=name, constraint=constraint), (start, end))
+    cursor.execute(sql.SQL("""
+    WITH moved AS (
+        DELETE FROM locations_default
+        WHERE timestamp >= %s AND timestamp < %s
+        RETURNING *
+    )
+    INSERT INTO {name} SELECT * FROM moved;
+    """).format(name=name), (start, end))
+    cursor.execute(sql.SQL("""
+    ALTER TABLE locations ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s);
+    """).format(name=name), (start, end))
+
+def maintain_partitions():
+    """
+    Pre-create the next PARTITION_CONFIG['premake'] partitions and detach or
+    drop partitions that fall entirely outside the retention window.
+    Returns (created, removed) partition names. Does nothing if the table is
+    not partitioned or another worker is already maintaining it.
+    """
+    interval = PARTITION_CONFIG['interval']
+    created, removed = [], []
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s);", (PARTITION_LOCK_ID,))
+        if not cursor.fetchone()[0] or not is_partitioned(cursor):
+            return created, removed
+
+        cursor.execute("SELECT LOCALTIMESTAMP;")
+        current = interval_start(cursor.fetchone()[0], interval)
+        partitions = list_partitions(cursor)
+        ranges = [(lower, upper) for name, lower, upper in partitions if name != DEFAULT_PARTITION]
+
+        for offset in range(PARTITION_CONFIG['premake'] + 1):
+            start = add_intervals(current, offset, interval)
+            end = add_intervals(start, 1, interval)
+            overlaps = any(
+                (lower is None or lower < end) and (upper is None or upper > start)
+                for lower, upper in ranges
+            )
+            if not overlaps:
+                create_partition(cursor, start, interval)
+                ranges.append((start, end))
+                created.append(partition_name(start, interval))
+
+        if PARTITION_CONFIG['retention'] > 0:
+            cutoff = add_intervals(current, -PARTITION_CONFIG['retention'], interval)
+            for name, lower, upper in partitions:
+                if name == DEFAULT_PARTITION or upper is None or upper > cutoff:
+                    continue
+                cursor.execute(sql.SQL("ALTER TABLE locations DETACH PARTITION {name};").format(
+                    name=sql.Identifier(name)))
+                if PARTITION_CONFIG['retention_action'] == 'drop':
+                    cursor.execute(sql.SQL("DROP TABLE {name};").format(name=sql.Identifier(name)))
+                removed.append(name)
+
+        conn.commit()
+
+    if created:
+        print(f"Created location partitions: {', '.join(created)}")
+    if removed:
+        print(f"Removed expired location partitions ({PARTITION_CONFIG['retention_action']}): {', '.join(removed)}")
+    return created, removed
+
+def ensure_partitioned():
+    """
+    Convert locations to the partitioned layout if it isn't already, then
+    run partition maintenance.
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_xact_lock(%s);", (PARTITION_LOCK_ID,))
+        if not is_partitioned(cursor):
+            print(f"Converting locations to {PARTITION_CONFIG['interval']}ly partitions...")
+            convert_to_partitioned(cursor, PARTITION_CONFIG['interval'])
+        conn.commit()
+
+    maintain_partitions()
+
+if __name__ == '__main__':
+    # python -m backend.database.partitions [convert|maintain]
+    if len(sys.argv) > 1 and sys.argv[1] == 'convert':
+        ensure_partitioned()
+    else:
+        maintain_partitions()
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+from ..config import RETENTION_CONFIG
+from .connection import get_connection
+
+# Arbitrary key for pg_advisory_lock so only one worker downsamples at a time
+RETENTION_LOCK_ID = 727104
+
+# Moves one device's fixes in [start, end) out of locations, keeping the
+# first fix of every bucket in locations_archive under its original id.
+# Fixes already archived (a rerun after a partial failure) are left alone.
+DOWNSAMPLE_WINDOW = """
+WITH moved AS (
+    DELETE FROM locations
+    WHERE device_id = %(device_id)s AND timestamp >= %(start)s AND timestamp < %(end)s
+    RETURNING id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+)
+INSERT INTO locations_archive
+    (id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude)
+SELECT DISTINCT ON (FLOOR(EXTRACT(EPOCH FROM timestamp) / %(bucket)s))
+    id, device_id, latitude, longitude, timestamp, accuracy, speed, heading, altitude
+FROM moved
+ORDER BY FLOOR(EXTRACT(EPOCH FROM timestamp) / %(bucket)s), timestamp, id
+ON CONFLICT (id) DO NOTHING;
+"""
+
+def align(moment, seconds):
+    """
+    Round a timestamp down to a multiple of seconds since the epoch.
+    """
+    epoch = datetime(1970, 1, 1)
+    return epoch + timedelta(seconds=(moment - epoch) // timedelta(seconds=seconds) * seconds)
+
+def downsample_aged_locations(raw_days=None, max_batches=None):
+    """
+    Move fixes older than raw_days into locations_archive, keeping one per
+    device per bucket_seconds. Each device is processed oldest first in
+    windows of batch_buckets buckets, one short transaction per window, so
+    ingest is never blocked for long. Stops after max_batches windows and
+    picks up where it left off on the next run. Returns the number of
+    windows processed.
+    """
+    raw_days = raw_days or RETENTION_CONFIG['raw_days']
+    max_batches = max_batches or RETENTION_CONFIG['max_batches']
+    if raw_days <= 0:
+        return 0
+
+    bucket = RETENTION_CONFIG['bucket_seconds']
+    window = timedelta(seconds=bucket * RETENTION_CONFIG['batch_buckets'])
+    batches = 0
+
+    # A session-level lock survives the per-window commits below
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_try_advisory_lock(%s);", (RETENTION_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return 0
+
+        try:
+            cursor.execute("SELECT LOCALTIMESTAMP;")
+            # Buckets never straddle the cutoff, so a later run can't keep a
+            # second fix for a bucket already downsampled
+            cutoff = align(cursor.fetchone()[0] - timedelta(days=raw_days), bucket)
+            cursor.execute("SELECT id FROM devices ORDER BY id;")
+            device_ids = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+
+            for device_id in device_ids:
+                while batches < max_batches:
+                    cursor.execute("""
+                    SELECT MIN(timestamp) FROM locations
+                    WHERE device_id = %s AND timestamp < %s;
+                    """, (device_id, cutoff))
+                    oldest = cursor.fetchone()[0]
+                    if oldest is None:
+                        conn.commit()
+                        break
+
+                    start = align(oldest, bucket)
+                    cursor.execute(DOWNSAMPLE_WINDOW, {
+                        'device_id': device_id,
+                        'start': start,
+                        'end': min(start + window, cutoff),
+                        'bucket': bucket,
+                    })
+                    conn.commit()
+                    batches += 1
+
+                if batches >= max_batches:
+                    break
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s);", (RETENTION_LOCK_ID,))
+            conn.commit()
+
+    return batches
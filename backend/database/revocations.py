@@ -0,0 +1,72 @@
+import time
+import threading
+import traceback
+from datetime import datetime, timedelta, timezone
+from ..config import REVOCATION_CONFIG
+from ..utils.revocation import RevocationList
+from .models import RevokedToken
+
+# Rows committed late can carry a revoked_at slightly before the newest one
+# already seen; each sync looks back this far to pick them up
+SYNC_OVERLAP = timedelta(seconds=60)
+
+# Ids of revoked, unexpired tokens, mirrored from revoked_tokens
+revocation_list = RevocationList()
+
+_sync_lock = threading.Lock()
+_next_sync = 0.0
+_synced_until = None  # newest revoked_at fetched so far
+
+def to_utc(epoch_seconds):
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc).replace(tzinfo=None)
+
+def revoke(jti, user_id, expires_at):
+    """
+    Revoke a token id until its expiry (epoch seconds). Takes effect in this
+    process at once and in other workers at their next sync.
+    """
+    RevokedToken.revoke(jti, user_id, to_utc(expires_at))
+    revocation_list.add(jti, expires_at)
+
+def sync_revocations():
+    """
+    Fetch tokens revoked since the last sync, by this or any other worker,
+    and forget those that have expired. The first sync loads them all.
+    """
+    global _synced_until
+    now = time.time()
+    rows = RevokedToken.get_unexpired(
+        to_utc(now), _synced_until - SYNC_OVERLAP if _synced_until is not None else None)
+    for jti, expires_at, revoked_at in rows:
+        revocation_list.add(jti, expires_at.replace(tzinfo=timezone.utc).timestamp())
+        if _synced_until is None or revoked_at > _synced_until:
+            _synced_until = revoked_at
+    revocation_list.prune(now)
+
+def is_revoked(jti):
+    """
+    Whether a token id has been revoked. Answered from memory; at most one
+    caller every sync_interval seconds refreshes the list from the database
+    first, and nobody waits for a refresh already in progress.
+    """
+    global _next_sync
+    if time.monotonic() >= _next_sync and _sync_lock.acquire(blocking=False):
+        try:
+            if time.monotonic() >= _next_sync:
+                sync_revocations()
+                _next_sync = time.monotonic() + REVOCATION_CONFIG['sync_interval']
+        except Exception as e:
+            # Keep answering from what is already loaded; retry next interval
+            print(f"Error syncing token revocations: {e}")
+            traceback.print_exc()
+            _next_sync = time.monotonic() + REVOCATION_CONFIG['sync_interval']
+        finally:
+            _sync_lock.release()
+
+    return jti in revocation_list
+
+def prune_revocations():
+    """
+    Delete revocations of tokens that have expired anyway.
+    """
+    return RevokedToken.prune_expired(to_utc(time.time()))
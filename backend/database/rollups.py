@@ -0,0 +1,91 @@
+from ..config import ROLLUP_CONFIG
+from .connection import get_connection
+from .models import LOCATION_HISTORY
+
+# Claims a batch of dirty (device, hour) buckets and recomputes each from
+# its fixes in both tiers, so late and out-of-order fixes are folded in
+# exactly.
+# Distance sums the steps between consecutive fixes within the hour.
+# Returns (buckets claimed, rollups written); a claimed bucket with no
+# fixes left writes nothing.
+COMPACT_ROLLUPS = """
+WITH claimed AS (
+    DELETE FROM location_rollup_dirty
+    WHERE (device_id, hour) IN (
+        SELECT device_id, hour
+        FROM location_rollup_dirty
+        ORDER BY hour
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING device_id, hour
+),
+fixes AS (
+    SELECT c.device_id, c.hour, l.id, l.timestamp, l.latitude, l.longitude, l.speed,
+           haversine_m(LAG(l.latitude) OVER w, LAG(l.longitude) OVER w, l.latitude, l.longitude) AS step_m
+    FROM claimed c
+    JOIN """ + LOCATION_HISTORY + """ l ON l.device_id = c.device_id
+        AND l.timestamp >= c.hour AND l.timestamp < c.hour + interval '1 hour'
+    WINDOW w AS (PARTITION BY c.device_id, c.hour ORDER BY l.timestamp, l.id)
+),
+written AS (
+    INSERT INTO location_rollups (
+        device_id, hour, point_count, distance_m,
+        min_latitude, max_latitude, min_longitude, max_longitude, max_speed,
+        first_location_id, first_time, first_latitude, first_longitude,
+        last_location_id, last_time, last_latitude, last_longitude
+    )
+    SELECT device_id, hour, COUNT(*), COALESCE(SUM(step_m), 0),
+           MIN(latitude), MAX(latitude), MIN(longitude), MAX(longitude), MAX(speed),
+           (ARRAY_AGG(id ORDER BY timestamp, id))[1], MIN(timestamp),
+           (ARRAY_AGG(latitude ORDER BY timestamp, id))[1], (ARRAY_AGG(longitude ORDER BY timestamp, id))[1],
+           (ARRAY_AGG(id ORDER BY timestamp DESC, id DESC))[1], MAX(timestamp),
+           (ARRAY_AGG(latitude ORDER BY timestamp DESC, id DESC))[1], (ARRAY_AGG(longitude ORDER BY timestamp DESC, id DESC))[1]
+    FROM fixes
+    GROUP BY device_id, hour
+    ON CONFLICT (device_id, hour) DO UPDATE SET
+        point_count = EXCLUDED.point_count,
+        distance_m = EXCLUDED.distance_m,
+        min_latitude = EXCLUDED.min_latitude,
+        max_latitude = EXCLUDED.max_latitude,
+        min_longitude = EXCLUDED.min_longitude,
+        max_longitude = EXCLUDED.max_longitude,
+        max_speed = EXCLUDED.max_speed,
+        first_location_id = EXCLUDED.first_location_id,
+        first_time = EXCLUDED.first_time,
+        first_latitude = EXCLUDED.first_latitude,
+        first_longitude = EXCLUDED.first_longitude,
+        last_location_id = EXCLUDED.last_location_id,
+        last_time = EXCLUDED.last_time,
+        last_latitude = EXCLUDED.last_latitude,
+        last_longitude = EXCLUDED.last_longitude,
+        updated_at = CURRENT_TIMESTAMP
+    RETURNING 1
+)
+SELECT (SELECT COUNT(*) FROM claimed), (SELECT COUNT(*) FROM written);
+"""
+
+def compact_rollups(batch_size=None, max_batches=None):
+    """
+    Bring location_rollups up to date with the buckets ingest has marked
+    dirty, one batch per transaction. Workers running this at the same time
+    claim different buckets. Returns the number of buckets rewritten.
+    Runs until a batch claims fewer than batch_size buckets, so buckets
+    whose fixes are gone (and write no rollup) don't end the run early.
+    """
+    batch_size = batch_size or ROLLUP_CONFIG['batch_size']
+    max_batches = max_batches or ROLLUP_CONFIG['max_batches']
+    compacted = 0
+
+    for _ in range(max_batches):
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(COMPACT_ROLLUPS, (batch_size,))
+            claimed, rewritten = cursor.fetchone()
+            conn.commit()
+
+        compacted += rewritten
+        if claimed < batch_size:
+            break
+
+    return compacted
@@ -1,6 +1,7 @@
 from ..database.models import User
-from ..utils.auth import generate_token, verify_token
+from ..utils.auth import generate_token, revoke_token
 from ..utils.http import success_response, error_response
+from ..utils.passwords import HasherBusyError
 
 def handle_auth_routes(request):
     """
@@ -135,6 +136,9 @@ def handle_register(request):
             'token': token,
         }, 'User registered successfully')
 
+    except HasherBusyError:
+        return error_response('Server busy, please retry', 503)
+
     except Exception as e:
         # Handle duplicate key errors
         if 'duplicate key' in str(e).lower():
@@ -183,6 +187,9 @@ def handle_login(request):
             'token': token,
         }, 'Login successful')
 
+    except HasherBusyError:
+        return error_response('Server busy, please retry', 503)
+
     except Exception as e:
         print(f"Error logging in: {e}")
         return error_response('Error logging in')
@@ -190,7 +197,18 @@ def handle_login(request):
 def handle_logout(request):
     """
     Handle user logout.
+    The bearer token is revoked, so it stops working before it expires.
     """
-    # No server-side action needed for logout
-    # The client should discard the token
-    return success_response(message='Logout successful')
+    auth_header = request['auth_header']
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return error_response('Unauthorized', 401)
+
+    try:
+        if not revoke_token(auth_header.split(' ')[1]):
+            return error_response('Unauthorized', 401)
+
+        return success_response(message='Logout successful')
+
+    except Exception as e:
+        print(f"Error logging out: {e}")
+        return error_response('Error logging out')
@@ -1,7 +1,8 @@
 import re
 from ..database.models import Device
-from ..utils.auth import verify_token
+from ..utils.auth import authenticate_request
 from ..utils.http import success_response, error_response
+from .locations import fleet_location_cache, position_index_cache
 
 def handle_device_routes(request):
     """
@@ -10,9 +11,8 @@ def handle_device_routes(request):
     path = request['path']
     method = request['method']
     
-    # Authenticate user
-    auth_header = request['auth_header']
-    user_id = authenticate_request(auth_header)
+    # Authenticate user (once per request, normally already done by dispatch_request)
+    user_id = authenticate_request(request)
     
     if not user_id:
         return error_response('Unauthorized', 401)
@@ -39,17 +39,6 @@ def handle_device_routes(request):
     else:
         return error_response('Not found', 404)
 
-def authenticate_request(auth_header):
-    """
-    Authenticate a request using the Authorization header.
-    Returns the user ID if authenticated, None otherwise.
-    """
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return None
-    
-    token = auth_header.split(' ')[1]
-    return verify_token(token)
-
 def handle_get_devices(user_id):
     """
     Handle GET /api/devices
@@ -86,6 +75,7 @@ def handle_create_device(request, user_id):
     try:
         # Create device
         device = Device.create(user_id, device_name, device_id)
+        fleet_location_cache.delete(user_id)
         
         return success_response({
             'device': device,
@@ -110,16 +100,16 @@ def handle_update_device(request, device_id, user_id):
     is_active = body.get('is_active')
     
     try:
+        # Verify that the device belongs to the user before changing it
+        if not Device.is_owned_by(device_id, user_id):
+            return error_response('Device not found or unauthorized', 404)
+        
         # Update device
         device = Device.update(device_id, device_name, is_active)
         
         if not device:
             return error_response('Device not found', 404)
         
-        # Verify that the device belongs to the user
-        if device['user_id'] != user_id:
-            return error_response('Unauthorized', 401)
-        
         return success_response({
             'device': device,
         }, 'Device updated successfully')
@@ -133,17 +123,16 @@ def handle_delete_device(device_id, user_id):
     Handle DELETE /api/devices/{id}
     """
     try:
-        # Get the device to verify ownership
-        devices = Device.get_by_user_id(user_id)
-        device_exists = any(device['id'] == device_id for device in devices)
-        
-        if not device_exists:
+        # Verify ownership
+        if not Device.is_owned_by(device_id, user_id):
             return error_response('Device not found or unauthorized', 404)
         
         # Delete device
         success = Device.delete(device_id)
         
         if success:
+            fleet_location_cache.delete(user_id)
+            position_index_cache.delete(user_id)
             return success_response(message='Device deleted successfully')
         else:
             return error_response('Device not found', 404)
@@ -0,0 +1,230 @@
+import re
+from collections import defaultdict
+from ..config import GEOFENCE_CONFIG
+from ..database.models import Geofence
+from ..database.notify import publish_events
+from ..utils.auth import authenticate_request
+from ..utils.cache import LRUCache
+from ..utils.geofence import GeofenceIndex
+from ..utils.http import success_response, error_response, is_number
+
+# User id -> GeofenceIndex of their fences, rebuilt after changes
+geofence_index_cache = LRUCache(GEOFENCE_CONFIG['index_cache_size'], GEOFENCE_CONFIG['index_ttl'])
+
+def handle_geofence_routes(request):
+    """
+    Handle geofence routes.
+    """
+    path = request['path']
+    method = request['method']
+    
+    # Authenticate user (once per request, normally already done by dispatch_request)
+    user_id = authenticate_request(request)
+    
+    if not user_id:
+        return error_response('Unauthorized', 401)
+    
+    # Get all geofences
+    if path == '/api/geofences' and method == 'GET':
+        return handle_get_geofences(user_id)
+    
+    # Create geofence
+    elif path == '/api/geofences' and method == 'POST':
+        return handle_create_geofence(request, user_id)
+    
+    # Get geofence
+    elif re.match(r'^/api/geofences/\d+$', path) and method == 'GET':
+        geofence_id = int(path.split('/')[-1])
+        return handle_get_geofence(geofence_id, user_id)
+    
+    # Delete geofence
+    elif re.match(r'^/api/geofences/\d+$', path) and method == 'DELETE':
+        geofence_id = int(path.split('/')[-1])
+        return handle_delete_geofence(geofence_id, user_id)
+    
+    # Not found
+    else:
+        return error_response('Not found', 404)
+
+def get_geofence_index(user_id):
+    """
+    Return the spatial index of a user's geofences, building it on a miss.
+    """
+    index = geofence_index_cache.get(user_id)
+    if index is None:
+        index = GeofenceIndex(
+            Geofence.get_by_user_id(user_id),
+            GEOFENCE_CONFIG['cell_size'],
+            GEOFENCE_CONFIG['max_cells_per_fence'],
+        )
+        geofence_index_cache.set(user_id, index)
+    return index
+
+def evaluate_geofences(user_id, locations):
+    """
+    Check newly stored fixes of a user's devices against their geofences and
+    publish an event for every enter and exit. Each device's inside set is
+    persisted, so only transitions fire; fixes older than the last one
+    evaluated for a device are skipped. Returns the events published.
+    """
+    index = get_geofence_index(user_id)
+    if not index or not locations:
+        return []
+    
+    by_device = defaultdict(list)
+    for location in locations:
+        by_device[location['device_id']].append(location)
+    
+    states = Geofence.get_device_states(by_device.keys())
+    
+    updates = []
+    events = defaultdict(list)
+    for device_id, fixes in by_device.items():
+        inside, last_fix = states.get(device_id, (set(), None))
+        # Forget fences that have been deleted since
+        inside &= index.fences.keys()
+        
+        evaluated = None
+        for fix in sorted(fixes, key=lambda fix: (fix['timestamp'], fix['id'])):
+            if last_fix is not None and (fix['timestamp'], fix['id']) <= last_fix:
+                continue
+            
+            now_inside = index.containing(fix['latitude'], fix['longitude'])
+            for kind, fence_ids in (('exit', inside - now_inside), ('enter', now_inside - inside)):
+                for fence_id in sorted(fence_ids):
+                    events[device_id].append((device_id, 'geofence', {
+                        'type': kind,
+                        'geofence_id': fence_id,
+                        'geofence_name': index.fences[fence_id].name,
+                        'device_id': device_id,
+                        'location_id': fix['id'],
+                        'latitude': fix['latitude'],
+                        'longitude': fix['longitude'],
+                        'timestamp': fix['timestamp'],
+                    }))
+            
+            inside = now_inside
+            last_fix = (fix['timestamp'], fix['id'])
+            evaluated = fix
+        
+        if evaluated is not None:
+            updates.append((device_id, inside, evaluated['timestamp'], evaluated['id']))
+    
+    # A device whose state another request has moved past publishes nothing
+    written = Geofence.save_device_states(updates)
+    published = [event for device_id in written for event in events[device_id]]
+    publish_events(published)
+    return [data for _, _, data in published]
+
+def validate_geofence(body):
+    """
+    Validate a geofence definition. Returns (fields, None) or (None, message).
+    """
+    name = body.get('name')
+    if not name or not isinstance(name, str):
+        return None, 'Name is required'
+    
+    if body.get('radius') is not None:
+        latitude = body.get('latitude')
+        longitude = body.get('longitude')
+        radius = body.get('radius')
+        
+        if not is_number(latitude) or not -90 <= latitude <= 90:
+            return None, 'Latitude must be a number between -90 and 90'
+        if not is_number(longitude) or not -180 <= longitude <= 180:
+            return None, 'Longitude must be a number between -180 and 180'
+        if not is_number(radius) or radius <= 0:
+            return None, 'Radius must be a positive number of meters'
+        
+        return {'name': name, 'kind': 'circle', 'latitude': latitude, 'longitude': longitude, 'radius': radius}, None
+    
+    points = body.get('points')
+    if points is None:
+        return None, 'Either radius (with latitude and longitude) or points is required'
+    
+    if not isinstance(points, list) or len(points) < 3:
+        return None, 'Points must be a list of at least 3 [latitude, longitude] pairs'
+    
+    for point in points:
+        if (not isinstance(point, list) or len(point) != 2
+                or not is_number(point[0]) or not -90 <= point[0] <= 90
+                or not is_number(point[1]) or not -180 <= point[1] <= 180):
+            return None, 'Points must be a list of at least 3 [latitude, longitude] pairs'
+    
+    return {'name': name, 'kind': 'polygon', 'points': points}, None
+
+def handle_get_geofences(user_id):
+    """
+    Handle GET /api/geofences
+    """
+    try:
+        geofences = Geofence.get_by_user_id(user_id)
+        return success_response({'geofences': geofences})
+    
+    except Exception as e:
+        print(f"Error getting geofences: {e}")
+        return error_response('Error getting geofences')
+
+def handle_create_geofence(request, user_id):
+    """
+    Handle POST /api/geofences
+    A circle is given by latitude, longitude and radius in meters, a polygon
+    by a list of [latitude, longitude] points.
+    """
+    body = request['body']
+    
+    # Validate request body
+    if not isinstance(body, dict):
+        return error_response('Invalid request body')
+    
+    fields, message = validate_geofence(body)
+    if message:
+        return error_response(message)
+    
+    try:
+        if Geofence.count_by_user_id(user_id) >= GEOFENCE_CONFIG['max_per_user']:
+            return error_response(f"Geofence limit of {GEOFENCE_CONFIG['max_per_user']} reached", 409)
+        
+        # Create geofence
+        geofence = Geofence.create(user_id, **fields)
+        geofence_index_cache.delete(user_id)
+        
+        return success_response({
+            'geofence': geofence,
+        }, 'Geofence created successfully')
+    
+    except Exception as e:
+        print(f"Error creating geofence: {e}")
+        return error_response('Error creating geofence')
+
+def handle_get_geofence(geofence_id, user_id):
+    """
+    Handle GET /api/geofences/{id}
+    """
+    try:
+        geofence = Geofence.get_by_id(geofence_id, user_id)
+        
+        if not geofence:
+            return error_response('Geofence not found', 404)
+        
+        return success_response({'geofence': geofence})
+    
+    except Exception as e:
+        print(f"Error getting geofence: {e}")
+        return error_response('Error getting geofence')
+
+def handle_delete_geofence(geofence_id, user_id):
+    """
+    Handle DELETE /api/geofences/{id}
+    """
+    try:
+        if not Geofence.delete(geofence_id, user_id):
+            return error_response('Geofence not found', 404)
+        
+        geofence_index_cache.delete(user_id)
+        
+        return success_response(message='Geofence deleted successfully')
+    
+    except Exception as e:
+        print(f"Error deleting geofence: {e}")
+        return error_response('Error deleting geofence')
@@ -1,8 +1,50 @@
 import re
-from datetime import datetime
-from ..database.models import Location, Device
-from ..utils.auth import verify_token
-from ..utils.http import success_response, error_response
+import time
+from itertools import islice
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import numpy as np
+from ..config import CACHE_CONFIG, LOCATION_CONFIG
+from ..database.models import Location, LocationRollup, Device, TripSegment
+from ..database.notify import publish_events, use_notify
+from .geofences import evaluate_geofences
+from ..utils.auth import authenticate_request
+from ..utils.cache import LRUCache
+from ..utils.heatmap import bin_points, merge_bins
+from ..utils.formats import MEDIA_TYPES, negotiate_format, encode_binary, encode_polyline, encode_columnar
+from ..utils.simplify import simplify_mask
+from ..utils.spatial import PositionIndex
+from ..utils.trips import segment_track
+from ..utils.http import success_response, error_response, not_modified_response, get_header, json_stream_response, binary_response, event_stream_response, is_number
+
+# Device id -> latest known fix. Filled on read and kept current by ingest,
+# so dashboard polls are answered without a database round trip.
+current_location_cache = LRUCache(
+    CACHE_CONFIG['current_location_max_size'],
+    CACHE_CONFIG['current_location_ttl'],
+)
+
+# User id -> latest fix of each of their devices. Dropped whenever one of
+# the user's devices reports, or a device is added or removed.
+fleet_location_cache = LRUCache(
+    CACHE_CONFIG['fleet_location_max_size'],
+    CACHE_CONFIG['fleet_location_ttl'],
+)
+
+# (device id, UTC day, zoom) -> heatmap bins. Only days that have ended are
+# cached; today's fixes are binned on every request. Ingest drops the days
+# late or replayed fixes land in (invalidate_heatmaps).
+heatmap_cache = LRUCache(
+    CACHE_CONFIG['heatmap_max_size'],
+    CACHE_CONFIG['heatmap_ttl'],
+)
+
+# User id -> PositionIndex of their devices' latest fixes, for proximity
+# queries. Built on first use and updated by ingest.
+position_index_cache = LRUCache(
+    CACHE_CONFIG['position_index_max_size'],
+    CACHE_CONFIG['position_index_ttl'],
+)
 
 def handle_location_routes(request):
     """
@@ -11,9 +53,8 @@ def handle_location_routes(request):
     path = request['path']
     method = request['method']
     
-    # Authenticate user
-    auth_header = request['auth_header']
-    user_id = authenticate_request(auth_header)
+    # Authenticate user (once per request, normally already done by dispatch_request)
+    user_id = authenticate_request(request)
     
     if not user_id:
         return error_response('Unauthorized', 401)
@@ -22,38 +63,132 @@ def handle_location_routes(request):
     if path == '/api/location/update' and method == 'POST':
         return handle_update_location(request, user_id)
     
+    # Batch location upload
+    elif path == '/api/location/batch' and method == 'POST':
+        return handle_batch_locations(request, user_id)
+    
+    # Get current location of every device
+    elif path == '/api/location/current' and method == 'GET':
+        return handle_get_fleet_locations(user_id)
+    
+    # Get trips and stops
+    elif re.match(r'^/api/location/trips/\d+$', path) and method == 'GET':
+        device_id = int(path.split('/')[-1])
+        return handle_get_trips(request, device_id, user_id)
+    
+    # Get per-hour or per-day statistics
+    elif re.match(r'^/api/location/stats/\d+$', path) and method == 'GET':
+        device_id = int(path.split('/')[-1])
+        return handle_get_stats(request, device_id, user_id)
+    
+    # Get a heatmap of fixes
+    elif re.match(r'^/api/location/heatmap/\d+$', path) and method == 'GET':
+        device_id = int(path.split('/')[-1])
+        return handle_get_heatmap(request, device_id, user_id)
+    
+    # Find devices near a point
+    elif path == '/api/location/nearby' and method == 'GET':
+        return handle_get_nearby(request, user_id)
+    
     # Get current location
     elif re.match(r'^/api/location/current/\d+$', path) and method == 'GET':
         device_id = int(path.split('/')[-1])
-        return handle_get_current_location(device_id, user_id)
+        return handle_get_current_location(request, device_id, user_id)
     
     # Get location history
     elif re.match(r'^/api/location/history/\d+$', path) and method == 'GET':
         device_id = int(path.split('/')[-1])
-        query_params = request['query_params']
-        return handle_get_location_history(device_id, query_params, user_id)
+        return handle_get_location_history(request, device_id, user_id)
+    
+    # Subscribe to live location updates
+    elif path == '/api/location/stream' and method == 'GET':
+        return handle_location_stream(request, user_id)
     
     # Not found
     else:
         return error_response('Not found', 404)
 
-def authenticate_request(auth_header):
+def verify_device_ownership(device_id, user_id):
+    """
+    Verify that a device belongs to a user.
     """
-    Authenticate a request using the Authorization header.
-    Returns the user ID if authenticated, None otherwise.
+    return Device.is_owned_by(device_id, user_id)
+
+def cache_current_location(location):
     """
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return None
+    Write a new fix through to the current location cache if it is newer
+    than the cached one. Devices that aren't cached are left to be filled on
+    the next read, since the fix might be an out-of-order replay.
+    """
+    cached = current_location_cache.get(location['device_id'])
+    if cached is not None and (cached['timestamp'], cached['id']) < (location['timestamp'], location['id']):
+        current_location_cache.set(location['device_id'], location)
+
+def publish_locations(user_id, locations):
+    """
+    Push new fixes to live subscribers and check them against the user's
+    geofences. Failures are logged, never surfaced, since the fixes are
+    already stored. With NOTIFY fan-out the fixes were already sent by
+    Location.create/create_many, in the transaction that stored them.
+    """
+    if not use_notify():
+        try:
+            publish_events([(location['device_id'], 'location', location) for location in locations])
+        except Exception as e:
+            print(f"Error publishing location events: {e}")
     
-    token = auth_header.split(' ')[1]
-    return verify_token(token)
+    try:
+        evaluate_geofences(user_id, locations)
+    except Exception as e:
+        print(f"Error evaluating geofences: {e}")
 
-def verify_device_ownership(device_id, user_id):
+def get_position_index(user_id):
     """
-    Verify that a device belongs to a user.
+    Return the spatial index of a user's devices, building it from
+    device_latest_location on a miss.
+    """
+    index = position_index_cache.get(user_id)
+    if index is None:
+        index = PositionIndex(LOCATION_CONFIG['nearby_cell_size'])
+        for location in Location.iter_current_for_user(user_id, LOCATION_CONFIG['history_stream_batch']):
+            index.update(location)
+        position_index_cache.set(user_id, index)
+    return index
+
+def track_positions(user_id, locations):
+    """
+    Move a user's devices in their position index, if it is loaded.
+    """
+    index = position_index_cache.get(user_id)
+    if index is not None:
+        for location in locations:
+            index.update(location)
+
+def invalidate_heatmaps(locations):
+    """
+    Drop the cached heatmap bins, at every zoom, of the finished days that
+    new fixes fall into, so late or replayed fixes show up at once.
+    """
+    today = datetime.now(timezone.utc).date().isoformat()
+    days = {(location['device_id'], location['timestamp'][:10]) for location in locations}
+    for device_id, day in days:
+        if day < today:
+            for zoom in range(LOCATION_CONFIG['heatmap_max_zoom'] + 1):
+                heatmap_cache.delete((device_id, day, zoom))
+
+def location_cache_headers(location):
+    """
+    Validators for a location response: the ETag is derived from the
+    location id, Last-Modified from its timestamp.
     """
-    devices = Device.get_by_user_id(user_id)
-    return any(device['id'] == device_id for device in devices)
+    modified = datetime.fromisoformat(location['timestamp'])
+    if modified.tzinfo is None:
+        modified = modified.replace(tzinfo=timezone.utc)
+    return {
+        'ETag': f'"loc-{location["id"]}"',
+        'Last-Modified': format_datetime(modified.astimezone(timezone.utc), usegmt=True),
+        'Cache-Control': 'no-cache',
+    }
 
 def handle_update_location(request, user_id):
     """
@@ -65,41 +200,36 @@ def handle_update_location(request, user_id):
     if not body:
         return error_response('Invalid request body')
     
-    # Extract fields
-    device_id = body.get('device_id')
-    latitude = body.get('latitude')
-    longitude = body.get('longitude')
-    accuracy = body.get('accuracy')
-    speed = body.get('speed')
-    heading = body.get('heading')
-    altitude = body.get('altitude')
-    
-    # Validate required fields
-    if not device_id:
-        return error_response('Device ID is required')
-    
-    if latitude is None:
-        return error_response('Latitude is required')
-    
-    if longitude is None:
-        return error_response('Longitude is required')
-    
-    # Verify device ownership
-    if not verify_device_ownership(device_id, user_id):
-        return error_response('Unauthorized', 401)
+    # Validate fields the same way as a batch upload; the fix is stamped
+    # with the server's time
+    fix, message = validate_fix(body)
+    if message:
+        return error_response(message)
+    device_id = fix['device_id']
     
     try:
+        # Verify device ownership
+        if not verify_device_ownership(device_id, user_id):
+            return error_response('Unauthorized', 401)
+        
         # Create location
         location = Location.create(
             device_id,
-            latitude,
-            longitude,
-            accuracy,
-            speed,
-            heading,
-            altitude
+            fix['latitude'],
+            fix['longitude'],
+            fix['accuracy'],
+            fix['speed'],
+            fix['heading'],
+            fix['altitude'],
+            publish=True
         )
         
+        cache_current_location(location)
+        fleet_location_cache.delete(user_id)
+        invalidate_heatmaps([location])
+        track_positions(user_id, [location])
+        publish_locations(user_id, [location])
+        
         return success_response({
             'location': location,
         }, 'Location updated successfully')
@@ -108,9 +238,116 @@ def handle_update_location(request, user_id):
         print(f"Error updating location: {e}")
         return error_response('Error updating location')
 
-def handle_get_current_location(device_id, user_id):
+def validate_fix(fix):
+    """
+    Validate one fix of an update or batch upload.
+    Returns (cleaned fix, None) if valid, (None, error message) otherwise.
+    """
+    if not isinstance(fix, dict):
+        return None, 'Fix must be an object'
+    
+    device_id = fix.get('device_id')
+    latitude = fix.get('latitude')
+    longitude = fix.get('longitude')
+    
+    if not isinstance(device_id, int) or isinstance(device_id, bool):
+        return None, 'Device ID is required'
+    
+    if not is_number(latitude) or not -90 <= latitude <= 90:
+        return None, 'Latitude is required and must be between -90 and 90'
+    
+    if not is_number(longitude) or not -180 <= longitude <= 180:
+        return None, 'Longitude is required and must be between -180 and 180'
+    
+    cleaned = {
+        'device_id': device_id,
+        'latitude': latitude,
+        'longitude': longitude,
+    }
+    
+    for field in ('accuracy', 'speed', 'heading', 'altitude'):
+        value = fix.get(field)
+        if value is not None and not is_number(value):
+            return None, f'{field.capitalize()} must be a number'
+        cleaned[field] = value
+    
+    timestamp = fix.get('timestamp')
+    if timestamp is not None:
+        try:
+            cleaned['timestamp'] = datetime.fromisoformat(str(timestamp).replace('Z', '+00:00'))
+        except ValueError:
+            return None, 'Invalid timestamp format'
+    
+    return cleaned, None
+
+def handle_batch_locations(request, user_id):
+    """
+    Handle POST /api/location/batch
+    Accepts a JSON array, an object with a "locations" array, or an NDJSON
+    body (Content-Type: application/x-ndjson) of fixes for one or more devices.
+    """
+    body = request['body']
+    
+    if isinstance(body, dict):
+        body = body.get('locations')
+    
+    # Validate request body
+    if not isinstance(body, list) or not body:
+        return error_response('Request body must be a non-empty list of locations')
+    
+    if len(body) > LOCATION_CONFIG['max_batch_size']:
+        return error_response(f"Batch size exceeds the limit of {LOCATION_CONFIG['max_batch_size']} locations", 413)
+    
+    results = [None] * len(body)
+    valid = []
+    
+    # Validate every fix in one pass
+    for index, fix in enumerate(body):
+        cleaned, message = validate_fix(fix)
+        if message:
+            results[index] = {'index': index, 'status': 'error', 'message': message}
+        else:
+            valid.append((index, cleaned))
+    
+    try:
+        # Verify ownership once per device
+        device_ids = {fix['device_id'] for _, fix in valid}
+        owned = Device.get_owned_ids(user_id, device_ids) if device_ids else set()
+        
+        accepted = []
+        for index, fix in valid:
+            if fix['device_id'] in owned:
+                accepted.append((index, fix))
+            else:
+                results[index] = {'index': index, 'status': 'error', 'message': 'Unauthorized'}
+        
+        # Write all accepted fixes with a single multi-row insert
+        locations = Location.create_many([fix for _, fix in accepted], publish=True)
+        
+        for (index, _), location in zip(accepted, locations):
+            results[index] = {'index': index, 'status': 'created', 'location_id': location['id']}
+            cache_current_location(location)
+        if locations:
+            fleet_location_cache.delete(user_id)
+        invalidate_heatmaps(locations)
+        track_positions(user_id, locations)
+        publish_locations(user_id, locations)
+        
+        created = len(locations)
+        return success_response({
+            'created': created,
+            'failed': len(results) - created,
+            'results': results,
+        }, f'{created} of {len(results)} locations saved')
+    
+    except Exception as e:
+        print(f"Error saving location batch: {e}")
+        return error_response('Error saving location batch')
+
+def handle_get_current_location(request, device_id, user_id):
     """
     Handle GET /api/location/current/{device_id}
+    Supports conditional requests: a matching If-None-Match gets a 304.
     """
     # Verify device ownership
     if not verify_device_ownership(device_id, user_id):
@@ -118,26 +355,319 @@ def handle_get_current_location(device_id, user_id):
     
     try:
         # Get current location
-        location = Location.get_current(device_id)
+        location = current_location_cache.get(device_id)
+        if location is None:
+            location = Location.get_current(device_id)
+            if location:
+                current_location_cache.set(device_id, location)
         
         if not location:
             return error_response('No location data found', 404)
         
-        return success_response({'location': location})
+        headers = location_cache_headers(location)
+        
+        if_none_match = get_header(request, 'If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or
+                              headers['ETag'] in [tag.strip() for tag in if_none_match.split(',')]):
+            return not_modified_response(headers)
+        
+        response = success_response({'location': location})
+        response['headers'].update(headers)
+        return response
     
     except Exception as e:
         print(f"Error getting current location: {e}")
         return error_response('Error getting current location')
 
-def handle_get_location_history(device_id, query_params, user_id):
+def handle_get_fleet_locations(user_id):
+    """
+    Handle GET /api/location/current
+    Latest fix of every device the user owns. Fleets up to
+    fleet_location_max_devices are cached per user; larger ones are
+    streamed straight from the database.
+    """
+    try:
+        locations = fleet_location_cache.get(user_id)
+        if locations is not None:
+            return success_response({'locations': locations})
+        
+        limit = CACHE_CONFIG['fleet_location_max_devices']
+        rows = Location.iter_current_for_user(user_id, LOCATION_CONFIG['history_stream_batch'])
+        locations = list(islice(rows, limit + 1))
+        
+        if len(locations) <= limit:
+            fleet_location_cache.set(user_id, locations)
+            return success_response({'locations': locations})
+        
+        def remaining():
+            yield from locations
+            yield from rows
+        
+        return json_stream_response({'success': True}, 'locations', remaining())
+    
+    except Exception as e:
+        print(f"Error getting fleet locations: {e}")
+        return error_response('Error getting current locations')
+
+def handle_get_nearby(request, user_id):
+    """
+    Handle GET /api/location/nearby?lat=&lon=[&radius=][&k=]
+    The user's devices whose latest fix is within radius meters of the
+    point, nearest first. Without a radius, the k nearest devices.
+    """
+    query_params = request['query_params']
+    
+    try:
+        lat = float(query_params.get('lat', [None])[0])
+        lon = float(query_params.get('lon', [None])[0])
+    except (TypeError, ValueError):
+        return error_response('lat and lon are required')
+    
+    if not -90 <= lat <= 90 or not -180 <= lon <= 180:
+        return error_response('lat must be between -90 and 90 and lon between -180 and 180')
+    
+    radius = query_params.get('radius', [None])[0]
+    k = query_params.get('k', [None])[0]
+    max_results = LOCATION_CONFIG['nearby_max_results']
+    
+    try:
+        radius = float(radius) if radius is not None else None
+        k = int(k) if k is not None else None
+    except ValueError:
+        return error_response('radius must be a number and k an integer')
+    
+    if radius is not None and radius <= 0:
+        return error_response('radius must be positive')
+    
+    if k is not None and not 1 <= k <= max_results:
+        return error_response(f'k must be between 1 and {max_results}')
+    
+    try:
+        index = get_position_index(user_id)
+        
+        if radius is not None:
+            found = index.within(lat, lon, radius, k or max_results)
+        else:
+            found = index.nearest(lat, lon, k or LOCATION_CONFIG['nearby_default_k'])
+        
+        return success_response({
+            'devices': [{
+                'device_id': location['device_id'],
+                'distance': round(distance, 1),
+                'location': location,
+            } for distance, location in found],
+        })
+    
+    except Exception as e:
+        print(f"Error finding nearby devices: {e}")
+        return error_response('Error finding nearby devices')
+
+def handle_location_stream(request, user_id):
+    """
+    Handle GET /api/location/stream
+    Server-Sent Events of new fixes for the devices listed in ?devices=1,2,3,
+    or for all of the user's devices.
+    """
+    devices_param = request['query_params'].get('devices', [None])[0]
+    
+    try:
+        if devices_param:
+            try:
+                device_ids = {int(value) for value in devices_param.split(',') if value.strip()}
+            except ValueError:
+                return error_response('devices must be a comma-separated list of device IDs')
+            
+            if not device_ids:
+                return error_response('devices must be a comma-separated list of device IDs')
+            
+            # Verify device ownership
+            if Device.get_owned_ids(user_id, device_ids) != device_ids:
+                return error_response('Unauthorized', 401)
+        else:
+            device_ids = {device['id'] for device in Device.get_by_user_id(user_id)}
+            
+            if not device_ids:
+                return error_response('No devices to stream', 404)
+        
+        return event_stream_response(sorted(device_ids))
+    
+    except Exception as e:
+        print(f"Error subscribing to locations: {e}")
+        return error_response('Error subscribing to locations')
+
+def parse_history_cursor(value):
+    """
+    Parse a keyset cursor of the form <timestamp>,<id>.
+    """
+    timestamp, _, location_id = value.rpartition(',')
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00')), int(location_id)
+
+def handle_get_location_history(request, device_id, user_id):
     """
     Handle GET /api/location/history/{device_id}
+    With limit and/or after=<timestamp>,<id> the history is returned one
+    page at a time along with a next_cursor. With simplify=<meters> and/or
+    max_points=<n> the route is simplified for drawing, keeping the start,
+    end and stops. Otherwise the whole range is streamed from a server-side
+    cursor. format= (or the Accept header) selects a compact encoding:
+    columnar, polyline or binary; see utils/formats.py.
+    """
+    # Verify device ownership
+    if not verify_device_ownership(device_id, user_id):
+        return error_response('Unauthorized', 401)
+    
+    # Extract query parameters
+    query_params = request['query_params']
+    start = query_params.get('start', [None])[0]
+    end = query_params.get('end', [None])[0]
+    limit = query_params.get('limit', [None])[0]
+    after = query_params.get('after', [None])[0]
+    simplify = query_params.get('simplify', [None])[0]
+    max_points = query_params.get('max_points', [None])[0]
+    history_format = negotiate_format(query_params.get('format', [None])[0], get_header(request, 'Accept'))
+    
+    # Validate parameters
+    if not start:
+        return error_response('Start time is required')
+    
+    if not end:
+        return error_response('End time is required')
+    
+    try:
+        # Parse timestamps
+        start_time = datetime.fromisoformat(start.replace('Z', '+00:00'))
+        end_time = datetime.fromisoformat(end.replace('Z', '+00:00'))
+    except ValueError:
+        return error_response('Invalid timestamp format')
+    
+    if history_format is None:
+        return error_response(f"Format must be one of: {', '.join(MEDIA_TYPES)}")
+    
+    try:
+        if history_format != 'json':
+            return handle_get_encoded_history(device_id, start_time, end_time, history_format, simplify, max_points)
+        
+        if simplify is not None or max_points is not None:
+            return handle_get_simplified_history(device_id, start_time, end_time, simplify, max_points)
+        
+        if limit is None and after is None:
+            # Stream the whole range without materialising it
+            locations = Location.iter_history(
+                device_id, start_time, end_time, LOCATION_CONFIG['history_stream_batch'])
+            return json_stream_response({'success': True}, 'locations', locations)
+        
+        try:
+            page_size = int(limit) if limit is not None else LOCATION_CONFIG['history_page_size']
+            cursor = parse_history_cursor(after) if after else None
+        except ValueError:
+            return error_response('Invalid limit or cursor')
+        
+        if not 1 <= page_size <= LOCATION_CONFIG['history_max_page_size']:
+            return error_response(f"Limit must be between 1 and {LOCATION_CONFIG['history_max_page_size']}")
+        
+        # Get one page of location history
+        locations, has_more = Location.get_history_page(device_id, start_time, end_time, page_size, cursor)
+        
+        next_cursor = None
+        if has_more:
+            next_cursor = f"{locations[-1]['timestamp']},{locations[-1]['id']}"
+        
+        return success_response({'locations': locations, 'next_cursor': next_cursor})
+    
+    except Exception as e:
+        print(f"Error getting location history: {e}")
+        return error_response('Error getting location history')
+
+def to_naive_utc(moment):
+    """
+    Convert an aware datetime to naive UTC, the form timestamps are stored
+    in. Naive datetimes are taken to be UTC already.
+    """
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+def epoch_ms(moment):
+    """
+    Whole milliseconds since the epoch of a naive UTC datetime, rounded
+    down like the timestamp_ms of Location.get_history_columns.
+    """
+    return (moment.replace(tzinfo=None) - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+
+def refresh_trip_segments(device_id):
+    """
+    Segment a device's fixes newer than its persisted segments, persist the
+    ones that are closed and return (watermark the persisted segments ran
+    up to before the last chunk, segments computed from the last chunk).
+    Every segment but the last is closed, and the last too once the device
+    has been silent for longer than the trip gap. Late fixes older than the
+    watermark are not folded into segments that were already persisted.
+    
+    Fixes are read trip_chunk_size at a time and the watermark advances
+    after each chunk, so a device's first call (or one after a long
+    absence) holds one chunk in memory rather than its whole history, and
+    an interrupted catch-up resumes where it stopped. A chunk is only grown
+    while a single open segment is longer than it. While another request
+    is saving the same device's segments, this one stops at its current
+    chunk instead of waiting.
+    """
+    max_gap = LOCATION_CONFIG['trip_max_gap_s']
+    chunk_size = LOCATION_CONFIG['trip_chunk_size']
+    limit = chunk_size
+    watermark = TripSegment.get_watermark(device_id)
+    
+    while True:
+        since = datetime.fromisoformat(watermark[0]) if watermark else datetime(1970, 1, 1)
+        columns = Location.get_history_columns(
+            device_id, since, datetime(9999, 12, 31), LOCATION_CONFIG['history_stream_batch'], limit)
+        more = len(columns['id']) == limit
+        
+        if watermark:
+            # Start from the fix the last persisted segment ended on
+            since_ms = epoch_ms(since)
+            newer = (columns['timestamp_ms'] > since_ms) | (
+                (columns['timestamp_ms'] == since_ms) & (columns['id'] >= watermark[1]))
+            columns = {name: values[newer] for name, values in columns.items()}
+        
+        segments = segment_track(
+            columns, LOCATION_CONFIG['stop_radius_m'], LOCATION_CONFIG['stop_min_duration_s'], max_gap)
+        
+        if not more:
+            if not segments:
+                return watermark, segments
+            silent = time.time() * 1000 - columns['timestamp_ms'][-1] > max_gap * 1000
+            closed = segments if silent else segments[:-1]
+            TripSegment.save(device_id, closed, watermark)
+            return watermark, segments
+        
+        # More fixes follow, so the chunk's last segment may continue past it
+        closed = segments[:-1]
+        if not closed:
+            limit *= 2
+            continue
+        
+        saved = TripSegment.save(device_id, closed, watermark)
+        previous, watermark = watermark, TripSegment.get_watermark(device_id)
+        if not saved and watermark == previous:
+            # Another request holds the lock and hasn't moved on yet; don't
+            # re-read the same chunk until it has
+            return previous, segments
+        # If another request saved first, carry on from where it got to
+        limit = chunk_size
+
+def handle_get_trips(request, device_id, user_id):
+    """
+    Handle GET /api/location/trips/{device_id}
+    Trips and stops overlapping the start-end range. Segments are persisted
+    once closed, so only fixes since the last persisted segment are
+    processed on each request.
     """
     # Verify device ownership
     if not verify_device_ownership(device_id, user_id):
         return error_response('Unauthorized', 401)
     
     # Extract query parameters
+    query_params = request['query_params']
     start = query_params.get('start', [None])[0]
     end = query_params.get('end', [None])[0]
     
@@ -152,15 +682,293 @@ def handle_get_location_history(device_id, query_params, user_id):
         # Parse timestamps
         start_time = datetime.fromisoformat(start.replace('Z', '+00:00'))
         end_time = datetime.fromisoformat(end.replace('Z', '+00:00'))
+    except ValueError:
+        return error_response('Invalid timestamp format')
+    
+    try:
+        watermark, recent = refresh_trip_segments(device_id)
         
-        # Get location history
-        locations = Location.get_history(device_id, start_time, end_time)
+        segments = TripSegment.get_range(device_id, start_time, end_time, watermark) if watermark else []
         
-        return success_response({'locations': locations})
+        # Compare as naive UTC, like the stored timestamps
+        start_iso = to_naive_utc(start_time).isoformat()
+        end_iso = to_naive_utc(end_time).isoformat()
+        segments.extend(
+            segment for segment in recent
+            if segment['start_time'] <= end_iso and segment['end_time'] >= start_iso
+        )
+        
+        return success_response({
+            'segments': segments,
+            'trips': sum(1 for segment in segments if segment['type'] == 'trip'),
+            'stops': sum(1 for segment in segments if segment['type'] == 'stop'),
+            'distance_m': round(sum(segment['distance_m'] for segment in segments), 1),
+        })
+    
+    except Exception as e:
+        print(f"Error getting trips: {e}")
+        return error_response('Error getting trips')
+
+def handle_get_stats(request, device_id, user_id):
+    """
+    Handle GET /api/location/stats/{device_id}
+    Point count, distance, bounding box, max speed and first/last fix per
+    interval=day (default) or hour, in UTC, read from the hourly rollups.
+    Fixes from the last MAINTENANCE_ROLLUP_INTERVAL seconds may not be
+    counted yet.
+    """
+    # Verify device ownership
+    if not verify_device_ownership(device_id, user_id):
+        return error_response('Unauthorized', 401)
+    
+    # Extract query parameters
+    query_params = request['query_params']
+    start = query_params.get('start', [None])[0]
+    end = query_params.get('end', [None])[0]
+    interval = query_params.get('interval', ['day'])[0]
     
+    # Validate parameters
+    if not start:
+        return error_response('Start time is required')
+    
+    if not end:
+        return error_response('End time is required')
+    
+    if interval not in ('hour', 'day'):
+        return error_response('Interval must be hour or day')
+    
+    try:
+        # Parse timestamps
+        start_time = datetime.fromisoformat(start.replace('Z', '+00:00'))
+        end_time = datetime.fromisoformat(end.replace('Z', '+00:00'))
     except ValueError:
         return error_response('Invalid timestamp format')
     
+    try:
+        stats = LocationRollup.get_range(device_id, start_time, end_time, interval)
+        
+        return success_response({
+            'interval': interval,
+            'stats': stats,
+            'point_count': sum(bucket['point_count'] for bucket in stats),
+            'distance_m': round(sum(bucket['distance_m'] for bucket in stats), 1),
+        })
+    
     except Exception as e:
-        print(f"Error getting location history: {e}")
-        return error_response('Error getting location history')
+        print(f"Error getting location stats: {e}")
+        return error_response('Error getting location stats')
+
+def get_heatmap_bins(device_id, start_time, end_time, zoom):
+    """
+    Heatmap bins of a device's fixes in [start_time, end_time) (naive UTC),
+    computed per UTC day. Whole days that have ended are cached per
+    (device, day, zoom); each run of uncached days is fetched with one
+    columnar query and split at midnights.
+    """
+    today = datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    
+    # Split the range at midnights into (start, end, cache key or None)
+    pieces = []
+    day = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < end_time:
+        next_day = day + timedelta(days=1)
+        piece_start, piece_end = max(start_time, day), min(end_time, next_day)
+        whole = piece_start == day and piece_end == next_day and next_day <= today
+        pieces.append((piece_start, piece_end, (device_id, day.date().isoformat(), zoom) if whole else None))
+        day = next_day
+    
+    bins = []
+    runs = []
+    for piece in pieces:
+        cached = heatmap_cache.get(piece[2]) if piece[2] else None
+        if cached is not None:
+            bins.append(cached)
+        elif runs and runs[-1][-1][1] == piece[0]:
+            runs[-1].append(piece)
+        else:
+            runs.append([piece])
+    
+    for run in runs:
+        columns = Location.get_history_columns(
+            device_id, run[0][0], run[-1][1] - timedelta(microseconds=1), LOCATION_CONFIG['history_stream_batch'])
+        edges = np.searchsorted(
+            columns['timestamp_ms'], [epoch_ms(piece[0]) for piece in run] + [epoch_ms(run[-1][1])])
+        for piece, first, last in zip(run, edges[:-1], edges[1:]):
+            piece_bins = bin_points(columns['latitude'][first:last], columns['longitude'][first:last], zoom)
+            if piece[2]:
+                heatmap_cache.set(piece[2], piece_bins)
+            bins.append(piece_bins)
+    
+    return merge_bins(bins, zoom)
+
+def handle_get_heatmap(request, device_id, user_id):
+    """
+    Handle GET /api/location/heatmap/{device_id}?start=&end=&zoom=
+    Number of fixes per web mercator pixel (256 pixel tiles) at the zoom
+    level, as parallel x, y and count lists.
+    """
+    # Verify device ownership
+    if not verify_device_ownership(device_id, user_id):
+        return error_response('Unauthorized', 401)
+    
+    # Extract query parameters
+    query_params = request['query_params']
+    start = query_params.get('start', [None])[0]
+    end = query_params.get('end', [None])[0]
+    zoom = query_params.get('zoom', [LOCATION_CONFIG['heatmap_default_zoom']])[0]
+    
+    # Validate parameters
+    if not start:
+        return error_response('Start time is required')
+    
+    if not end:
+        return error_response('End time is required')
+    
+    try:
+        # Parse timestamps
+        start_time = to_naive_utc(datetime.fromisoformat(start.replace('Z', '+00:00')))
+        end_time = to_naive_utc(datetime.fromisoformat(end.replace('Z', '+00:00')))
+    except ValueError:
+        return error_response('Invalid timestamp format')
+    
+    try:
+        zoom = int(zoom)
+    except ValueError:
+        return error_response('Zoom must be an integer')
+    
+    if not 0 <= zoom <= LOCATION_CONFIG['heatmap_max_zoom']:
+        return error_response(f"Zoom must be between 0 and {LOCATION_CONFIG['heatmap_max_zoom']}")
+    
+    if end_time - start_time > timedelta(days=LOCATION_CONFIG['heatmap_max_days']):
+        return error_response(f"Range must not exceed {LOCATION_CONFIG['heatmap_max_days']} days")
+    
+    try:
+        x, y, counts = get_heatmap_bins(device_id, start_time, end_time, zoom)
+        
+        return success_response({
+            'zoom': zoom,
+            'total': int(counts.sum()),
+            'max': int(counts.max()) if len(counts) else 0,
+            'cells': {
+                'x': x.tolist(),
+                'y': y.tolist(),
+                'count': counts.tolist(),
+            },
+        })
+    
+    except Exception as e:
+        print(f"Error getting heatmap: {e}")
+        return error_response('Error getting heatmap')
+
+def parse_simplify_params(simplify, max_points):
+    """
+    Parse the simplify and max_points query parameters.
+    Raises ValueError with a client-facing message if they are invalid.
+    """
+    try:
+        tolerance = float(simplify) if simplify is not None else None
+        point_limit = int(max_points) if max_points is not None else None
+    except ValueError:
+        raise ValueError('Invalid simplify or max_points value')
+    
+    if tolerance is not None and tolerance <= 0:
+        raise ValueError('Simplify tolerance must be positive')
+    
+    if point_limit is not None and point_limit < 2:
+        raise ValueError('max_points must be at least 2')
+    
+    return tolerance, point_limit
+
+def handle_get_simplified_history(device_id, start_time, end_time, simplify, max_points):
+    """
+    Return location history simplified for drawing a route. The track is
+    read and simplified as columns, and location dicts are only built for
+    the fixes kept; their timestamps are to the millisecond.
+    """
+    try:
+        tolerance, point_limit = parse_simplify_params(simplify, max_points)
+    except ValueError as e:
+        return error_response(str(e))
+    
+    columns = Location.get_history_columns(
+        device_id, start_time, end_time, LOCATION_CONFIG['history_stream_batch'])
+    original_count = len(columns['id'])
+    
+    keep = simplify_mask(
+        columns['latitude'],
+        columns['longitude'],
+        (columns['timestamp_ms'] - (columns['timestamp_ms'][0] if original_count else 0)) / 1000.0,
+        tolerance=tolerance,
+        max_points=point_limit,
+        stop_radius=LOCATION_CONFIG['stop_radius_m'],
+        stop_min_duration=LOCATION_CONFIG['stop_min_duration_s'],
+    )
+    # NaN marks a missing value; JSON has null for that
+    kept = {
+        name: [None if value != value else value for value in values[keep].tolist()]
+        for name, values in columns.items()
+    }
+    epoch = datetime(1970, 1, 1)
+    
+    return success_response({
+        'locations': [{
+            'id': location_id,
+            'device_id': device_id,
+            'latitude': latitude,
+            'longitude': longitude,
+            'timestamp': (epoch + timedelta(milliseconds=timestamp_ms)).isoformat(),
+            'accuracy': accuracy,
+            'speed': speed,
+            'heading': heading,
+            'altitude': altitude,
+        } for location_id, timestamp_ms, latitude, longitude, accuracy, speed, heading, altitude in zip(
+            *(kept[name] for name in Location.HISTORY_COLUMNS))],
+        'original_count': original_count,
+    })
+
+def handle_get_encoded_history(device_id, start_time, end_time, history_format, simplify, max_points):
+    """
+    Return location history in a compact format, optionally simplified.
+    """
+    try:
+        tolerance, point_limit = parse_simplify_params(simplify, max_points)
+    except ValueError as e:
+        return error_response(str(e))
+    
+    columns = Location.get_history_columns(
+        device_id, start_time, end_time, LOCATION_CONFIG['history_stream_batch'])
+    original_count = len(columns['id'])
+    
+    if tolerance is not None or point_limit is not None:
+        keep = simplify_mask(
+            columns['latitude'],
+            columns['longitude'],
+            (columns['timestamp_ms'] - (columns['timestamp_ms'][0] if original_count else 0)) / 1000.0,
+            tolerance=tolerance,
+            max_points=point_limit,
+            stop_radius=LOCATION_CONFIG['stop_radius_m'],
+            stop_min_duration=LOCATION_CONFIG['stop_min_duration_s'],
+        )
+        columns = {name: values[keep] for name, values in columns.items()}
+    
+    if history_format == 'binary':
+        response = binary_response(encode_binary(columns), MEDIA_TYPES['binary'])
+    
+    elif history_format == 'polyline':
+        timestamps = columns['timestamp_ms']
+        response = success_response({
+            'polyline': encode_polyline(columns['latitude'], columns['longitude']),
+            'count': len(timestamps),
+            'original_count': original_count,
+            'start_timestamp_ms': int(timestamps[0]) if len(timestamps) else None,
+            'end_timestamp_ms': int(timestamps[-1]) if len(timestamps) else None,
+        })
+    
+    else:
+        data = encode_columnar(columns)
+        data['original_count'] = original_count
+        response = success_response(data)
+    
+    response['headers']['Content-Type'] = MEDIA_TYPES[history_format]
+    response['headers']['Vary'] = 'Accept'
+    return response
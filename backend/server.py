@@ -1,5 +1,9 @@
+import os
+import queue
+import signal
 import socket
 import threading
+import time
 import json
 import traceback
 from http.server import HTTPServer, BaseHTTPRequestHandler
@@ -7,12 +11,54 @@ from urllib.parse import urlparse, parse_qs
 
 # Change these imports to use relative paths
 from .config import SERVER_CONFIG
-from .database.connection import create_tables
+from .database.connection import close_pool, get_pool
+from .database.maintenance import start_maintenance_thread
+from .database.migrations import create_tables
+from .database.notify import ensure_listener
 from .routes.auth import handle_auth_routes
 from .routes.devices import handle_device_routes
+from .routes.geofences import handle_geofence_routes
 from .routes.locations import handle_location_routes
-from .utils.http import error_response, parse_json_body
-from .utils.rate_limit import is_rate_limited
+from .utils.auth import authenticate_request
+from .utils.http import error_response, parse_request_body
+from .utils.passwords import password_hasher
+from .utils.rate_limit import is_rate_limited, is_request_rate_limited
+from .utils.sse import get_sse_hub
+
+def dispatch_request(request):
+    """
+    Route a parsed request to the appropriate handler based on the path.
+    Shared by every server front end.
+    """
+    path = request['path']
+
+    # Verify the bearer token once; routes read the result from request['user_id']
+    user_id = authenticate_request(request)
+
+    # Per-route and per-user limits; the per-client one is checked by the
+    # front end before the request is parsed
+    if is_request_rate_limited(path, request['client_ip'], user_id):
+        return error_response('Rate limit exceeded', 429)
+
+    # Auth routes
+    if path.startswith('/api/auth/'):
+        return handle_auth_routes(request)
+
+    # Device routes
+    elif path.startswith('/api/devices'):
+        return handle_device_routes(request)
+
+    # Geofence routes
+    elif path.startswith('/api/geofences'):
+        return handle_geofence_routes(request)
+
+    # Location routes
+    elif path.startswith('/api/location/'):
+        return handle_location_routes(request)
+
+    # Not found
+    else:
+        return error_response('Not found', 404)
 
 class RequestHandler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
@@ -63,7 +109,7 @@ class RequestHandler(BaseHTTPRequestHandler):
                     content_length = int(self.headers.get('Content-Length', 0))
                     if content_length > 0:
                         body_data = self.rfile.read(content_length)
-                        body = parse_json_body(body_data.decode('utf-8'))
+                        body = parse_request_body(body_data.decode('utf-8'), self.headers.get('Content-Type', ''))
                 except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
                     print(f"Client disconnected during request reading: {e}")
                     return
@@ -112,49 +158,50 @@ class RequestHandler(BaseHTTPRequestHandler):
         """
         Route the request to the appropriate handler based on the path.
         """
-        path = request['path']
+        return dispatch_request(request)
 
-        # Auth routes
-        if path.startswith('/api/auth/'):
-            return handle_auth_routes(request)
+    def _send_headers(self, response):
+        """
+        Send the status line and headers of a response.
+        """
+        self.send_response(response['status'])
 
-        # Device routes
-        elif path.startswith('/api/devices'):
-            return handle_device_routes(request)
+        # Set headers
+        for header, value in response['headers'].items():
+            self.send_header(header, value)
 
-        # Location routes
-        elif path.startswith('/api/location/'):
-            return handle_location_routes(request)
+        # Ensure CORS headers are always included
+        if 'Access-Control-Allow-Origin' not in response['headers']:
+            self.send_header('Access-Control-Allow-Origin', '*')
+        if 'Access-Control-Allow-Methods' not in response['headers']:
+            self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
+        if 'Access-Control-Allow-Headers' not in response['headers']:
+            self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
 
-        # Not found
-        else:
-            return error_response('Not found', 404)
+        self.end_headers()
 
     def _send_response(self, response):
         """
         Send an HTTP response.
         """
-        try:
-            self.send_response(response['status'])
+        if response.get('subscribe') is not None:
+            self._send_event_stream(response)
+            return
 
-            # Set headers
-            for header, value in response['headers'].items():
-                self.send_header(header, value)
-
-            # Ensure CORS headers are always included
-            if 'Access-Control-Allow-Origin' not in response['headers']:
-                self.send_header('Access-Control-Allow-Origin', '*')
-            if 'Access-Control-Allow-Methods' not in response['headers']:
-                self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-            if 'Access-Control-Allow-Headers' not in response['headers']:
-                self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        try:
+            self._send_headers(response)
 
-            self.end_headers()
+            # Send a streamed body chunk by chunk. The response is HTTP/1.0,
+            # so the end of the body is marked by closing the connection.
+            if response.get('stream') is not None:
+                self.close_connection = True
+                self._send_stream(response['stream'])
 
             # Send body
-            if 'body' in response and response['body']:
+            elif 'body' in response and response['body']:
                 try:
-                    self.wfile.write(response['body'].encode('utf-8'))
+                    body = response['body']
+                    self.wfile.write(body.encode('utf-8') if isinstance(body, str) else body)
                 except (ConnectionAbortedError, ConnectionResetError, BrokenPipeError) as e:
                     # Client disconnected before we could send the response
                     # This is not a server error, just log it and continue
@@ -166,16 +213,268 @@ class RequestHandler(BaseHTTPRequestHandler):
             print(f"Error sending response headers: {e}")
             traceback.print_exc()
 
+    def _send_stream(self, stream):
+        """
+        Write each chunk of a streamed response as it is produced.
+        """
+        try:
+            for chunk in stream:
+                self.wfile.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        except (ConnectionAbortedError, ConnectionResetError, BrokenPipeError) as e:
+            print(f"Client disconnected during streamed response: {e}")
+        except Exception as e:
+            # Headers are already sent; the truncated body tells the client it failed
+            print(f"Error streaming response body: {e}")
+            traceback.print_exc()
+        finally:
+            close = getattr(stream, 'close', None)
+            if close:
+                close()
+
+    def _send_event_stream(self, response):
+        """
+        Send event stream headers and hand the connection over to the event
+        hub, which pushes events to it from then on. This worker thread is
+        free again as soon as the headers are out.
+        """
+        hub = get_sse_hub()
+        if not hub.reserve():
+            self._send_response(error_response('Too many event stream subscribers', 503))
+            return
+
+        try:
+            ensure_listener()
+            self._send_headers(response)
+            self.wfile.flush()
+        except Exception as e:
+            hub.release()
+            print(f"Error starting event stream: {e}")
+            self.close_connection = True
+            return
+
+        self.close_connection = True
+        self.server.detach_request(self.connection)
+        hub.attach(self.connection, response['subscribe'])
+
 class TimeoutHTTPServer(HTTPServer):
     """
     HTTP Server with socket timeout.
     """
+    reuse_port = False
+    # socketserver's default backlog of 5 drops SYNs under any burst
+    request_queue_size = SERVER_CONFIG['backlog']
+
+    def __init__(self, *args, **kwargs):
+        # Connections handed to another owner, which shutdown_request must
+        # leave open; touched by every pool worker thread
+        self._detached = set()
+        self._detached_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Let several worker processes bind the same port; the kernel
+            # load-balances incoming connections between them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.settimeout(SERVER_CONFIG['timeout'])
         self.socket.bind(self.server_address)
         self.server_address = self.socket.getsockname()
 
+    def detach_request(self, request):
+        """
+        Keep a connection open after its handler returns, because it has
+        been handed to another owner (the event stream hub).
+        """
+        with self._detached_lock:
+            self._detached.add(request)
+
+    def shutdown_request(self, request):
+        with self._detached_lock:
+            if request in self._detached:
+                self._detached.discard(request)
+                return
+        super().shutdown_request(request)
+
+class ThreadPoolHTTPServer(TimeoutHTTPServer):
+    """
+    HTTP Server that hands accepted connections to a fixed pool of worker
+    threads through a bounded queue. When the queue is full new connections
+    are answered with 503 straight away instead of piling up.
+    """
+    def __init__(self, server_address, handler_class, threads, queue_size, reuse_port=False):
+        self.reuse_port = reuse_port
+        self.threads = threads
+        self.queue_size = queue_size
+        self.request_queue_size = max(SERVER_CONFIG['backlog'], queue_size)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stats_lock = threading.Lock()
+        self._active = 0
+        self._handled = 0
+        self._rejected = 0
+        self._errors = 0
+        self._started = time.time()
+
+        super().__init__(server_address, handler_class)
+
+        for i in range(threads):
+            worker = threading.Thread(target=self._worker, name=f'http-worker-{i}', daemon=True)
+            worker.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self._queue.put_nowait((request, client_address))
+        except queue.Full:
+            with self._stats_lock:
+                self._rejected += 1
+            self._reject(request)
+            self.shutdown_request(request)
+
+    def _reject(self, request):
+        """
+        Write a minimal 503 response without reading the request.
+        """
+        response = error_response('Server busy, please retry', 503)
+        body = response['body'].encode('utf-8')
+        head = 'HTTP/1.1 503 Service Unavailable\r\n'
+        for header, value in response['headers'].items():
+            head += f'{header}: {value}\r\n'
+        head += f'Content-Length: {len(body)}\r\nRetry-After: 1\r\nConnection: close\r\n\r\n'
+        try:
+            request.sendall(head.encode('latin-1') + body)
+        except OSError as e:
+            print(f"Failed to send busy response: {e}")
+
+    def _worker(self):
+        while True:
+            request, client_address = self._queue.get()
+            with self._stats_lock:
+                self._active += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                with self._stats_lock:
+                    self._errors += 1
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._stats_lock:
+                    self._active -= 1
+                    self._handled += 1
+
+    def stats(self):
+        """
+        Snapshot of this worker's request counters and queue depth.
+        """
+        with self._stats_lock:
+            return {
+                'pid': os.getpid(),
+                'uptime_seconds': int(time.time() - self._started),
+                'threads': self.threads,
+                'active': self._active,
+                'queue_depth': self._queue.qsize(),
+                'queue_size': self.queue_size,
+                'handled': self._handled,
+                'rejected': self._rejected,
+                'errors': self._errors,
+                'db_pool': get_pool().stats(),
+                'password_hashing': password_hasher.stats(),
+            }
+
+def _create_server(reuse_port=False):
+    """
+    Create the HTTP server for the configured concurrency mode.
+    """
+    server_address = (SERVER_CONFIG['host'], SERVER_CONFIG['port'])
+
+    if SERVER_CONFIG['mode'] == 'single':
+        return TimeoutHTTPServer(server_address, RequestHandler)
+
+    return ThreadPoolHTTPServer(
+        server_address,
+        RequestHandler,
+        threads=SERVER_CONFIG['threads'],
+        queue_size=SERVER_CONFIG['queue_size'],
+        reuse_port=reuse_port,
+    )
+
+def _start_stats_logger(httpd):
+    """
+    Periodically log the worker's stats if enabled in SERVER_CONFIG.
+    """
+    interval = SERVER_CONFIG['stats_interval']
+    if interval <= 0 or not hasattr(httpd, 'stats'):
+        return
+
+    def log_stats():
+        while True:
+            time.sleep(interval)
+            print(f"Worker stats: {json.dumps(httpd.stats())}")
+
+    threading.Thread(target=log_stats, name='stats-logger', daemon=True).start()
+
+def _serve(httpd):
+    start_maintenance_thread()
+    _start_stats_logger(httpd)
+    httpd.serve_forever()
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def _run_prefork():
+    """
+    Run SERVER_CONFIG['workers'] processes, each with its own threaded server
+    bound to the same port via SO_REUSEPORT. The parent only supervises and
+    restarts workers that die.
+    """
+    # Children must not inherit the parent's database sockets
+    close_pool()
+
+    workers = set()
+
+    def spawn_worker():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            exit_code = 0
+            try:
+                _serve(_create_server(reuse_port=True))
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                print(f"Worker {os.getpid()} crashed: {e}")
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        workers.add(pid)
+
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+
+    for _ in range(SERVER_CONFIG['workers']):
+        spawn_worker()
+    print(f"Started {len(workers)} worker processes")
+
+    try:
+        while True:
+            pid, status = os.wait()
+            if pid in workers:
+                workers.discard(pid)
+                print(f"Worker {pid} exited with status {status}, restarting")
+                time.sleep(1)  # Avoid a tight restart loop if workers keep crashing
+                spawn_worker()
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
 def run_server():
     """
     Run the HTTP server.
@@ -191,13 +490,23 @@ def run_server():
             print("WARNING: Database tables could not be created or verified")
             print("The server will start, but some functionality may not work correctly")
 
-        # Start the server
-        server_address = (SERVER_CONFIG['host'], SERVER_CONFIG['port'])
-        httpd = TimeoutHTTPServer(server_address, RequestHandler)
+        mode = SERVER_CONFIG['mode']
+        if mode == 'prefork' and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+            print("WARNING: prefork mode is not supported on this platform, falling back to threaded")
+            mode = SERVER_CONFIG['mode'] = 'threaded'
 
         print(f"Server running at http://{SERVER_CONFIG['host']}:{SERVER_CONFIG['port']}")
         print(f"Socket timeout set to {SERVER_CONFIG['timeout']} seconds")
-        httpd.serve_forever()
+
+        # Start the server
+        if mode == 'prefork':
+            print(f"Concurrency: {SERVER_CONFIG['workers']} processes x {SERVER_CONFIG['threads']} threads")
+            _run_prefork()
+        else:
+            httpd = _create_server()
+            if mode != 'single':
+                print(f"Concurrency: {SERVER_CONFIG['threads']} threads, queue size {SERVER_CONFIG['queue_size']}")
+            _serve(httpd)
 
     except KeyboardInterrupt:
         print("Server stopped")
@@ -207,5 +516,3 @@ def run_server():
 
 if __name__ == '__main__':
     run_server()
-
-
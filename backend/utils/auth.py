@@ -1,7 +1,14 @@
 import jwt
 import time
+import uuid
 import hashlib
-from ..config import JWT_CONFIG
+from ..config import CACHE_CONFIG, JWT_CONFIG
+from ..database.revocations import is_revoked, revoke
+from .cache import LRUCache
+from .passwords import password_hasher
+
+# SHA-256 of a verified token -> (user id, expiry as epoch seconds, token id)
+token_cache = LRUCache(CACHE_CONFIG['token_max_size'])
 
 def generate_token(user_id):
     """
@@ -11,6 +18,8 @@ def generate_token(user_id):
         'user_id': user_id,
         'exp': int(time.time()) + (JWT_CONFIG['token_expiry_minutes'] * 60),
         'iat': int(time.time()),
+        # Token id, so the token can be revoked on its own
+        'jti': uuid.uuid4().hex,
     }
     
     token = jwt.encode(
@@ -24,15 +33,47 @@ def generate_token(user_id):
 def verify_token(token):
     """
     Verify a JWT token and return the user ID if valid.
+    Recently verified tokens are answered from token_cache without decoding;
+    revocation is checked either way.
+    """
+    digest = hashlib.sha256(token.encode()).digest()
+    cached = token_cache.get(digest)
+    if cached is not None:
+        user_id, expires_at, jti = cached
+        if expires_at <= time.time():
+            # Token has expired since it was cached
+            token_cache.delete(digest)
+            return None
+        if jti is not None and is_revoked(jti):
+            return None
+        return user_id
+    
+    payload = decode_token(token)
+    if payload is None:
+        return None
+    
+    jti = payload.get('jti')
+    if jti is not None and is_revoked(jti):
+        return None
+    
+    # Tokens without an expiry are still verified, just never cached
+    expires_at = payload.get('exp')
+    if isinstance(expires_at, (int, float)):
+        token_cache.set(digest, (payload['user_id'], expires_at, jti), ttl=max(0.0, expires_at - time.time()))
+    
+    return payload['user_id']
+
+def decode_token(token):
+    """
+    Decode a JWT token and return its payload if the signature and expiry
+    are valid, None otherwise.
     """
     try:
-        payload = jwt.decode(
+        return jwt.decode(
             token,
             JWT_CONFIG['secret_key'],
             algorithms=[JWT_CONFIG['algorithm']]
         )
-        
-        return payload['user_id']
     except jwt.ExpiredSignatureError:
         # Token has expired
         return None
@@ -40,14 +81,46 @@ def verify_token(token):
         # Invalid token
         return None
 
+def revoke_token(token):
+    """
+    Revoke a token until it expires. Returns False if the token is invalid.
+    Tokens issued before token ids were added can't be revoked and are
+    left to expire.
+    """
+    payload = decode_token(token)
+    if payload is None:
+        return False
+    
+    if 'jti' in payload and 'exp' in payload:
+        revoke(payload['jti'], payload['user_id'], payload['exp'])
+    token_cache.delete(hashlib.sha256(token.encode()).digest())
+    return True
+
+def authenticate_request(request):
+    """
+    Authenticate a request using the Authorization header, once per request.
+    Stores the user ID in request['user_id'] (None if not authenticated)
+    and returns it.
+    """
+    if 'user_id' in request:
+        return request['user_id']
+    
+    auth_header = request.get('auth_header')
+    user_id = None
+    if auth_header and auth_header.startswith('Bearer '):
+        user_id = verify_token(auth_header.split(' ')[1])
+    
+    request['user_id'] = user_id
+    return user_id
+
 def hash_password(password):
     """
-    Hash a password using SHA-256.
+    Hash a password with scrypt in the password hashing pool.
     """
-    return hashlib.sha256(password.encode()).hexdigest()
+    return password_hasher.hash(password)
 
 def verify_password(password, password_hash):
     """
-    Verify a password against a hash.
+    Verify a password against a hash (scrypt or legacy SHA-256).
     """
-    return hash_password(password) == password_hash
+    return password_hasher.verify(password, password_hash)[0]
@@ -0,0 +1,231 @@
+"""
+Compact encodings for location history.
+
+columnar
+    JSON object of parallel arrays, one per field, instead of one object per
+    fix. Timestamps are epoch milliseconds; missing values are null.
+
+polyline
+    Google's encoded polyline algorithm (precision 5) over latitude and
+    longitude: https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    Returned inside JSON along with the first and last timestamp.
+
+binary (media type application/vnd.location-delta)
+    All integers are unsigned LEB128 varints; "zigzag" maps signed n to
+    (n << 1) ^ (n >> 63). Layout:
+
+        magic     4 bytes  b'LOCD'
+        version   1 byte   1
+        count     varint   number of fixes n
+        id        n zigzag varints, each the delta from the previous id (first from 0)
+        timestamp n zigzag varints, deltas of epoch milliseconds
+        latitude  n zigzag varints, deltas of round(degrees * 1e7)
+        longitude n zigzag varints, deltas of round(degrees * 1e7)
+        accuracy, speed, heading, altitude, each as:
+            presence bitmap  ceil(n / 8) bytes, bit i (LSB first) set if fix i has a value
+            values           zigzag varint deltas of round(value * 100) over present fixes only
+
+    decode_binary() below is the reference decoder.
+"""
+import numpy as np
+
+BINARY_MAGIC = b'LOCD'
+BINARY_VERSION = 1
+COORDINATE_SCALE = 10 ** 7
+OPTIONAL_SCALE = 100
+OPTIONAL_FIELDS = ('accuracy', 'speed', 'heading', 'altitude')
+
+# Media types understood by history content negotiation
+MEDIA_TYPES = {
+    'binary': 'application/vnd.location-delta',
+    'polyline': 'application/vnd.location-polyline+json',
+    'columnar': 'application/vnd.location-columnar+json',
+    'json': 'application/json',
+}
+
+def negotiate_format(format_param, accept_header):
+    """
+    Pick a history format from an explicit format= value or the Accept
+    header, defaulting to json. Returns None for an unknown format= value.
+    """
+    if format_param:
+        return format_param if format_param in MEDIA_TYPES else None
+
+    for media_range in (accept_header or '').split(','):
+        media_type = media_range.split(';')[0].strip().lower()
+        if media_type == 'application/octet-stream':
+            return 'binary'
+        for name, known in MEDIA_TYPES.items():
+            if media_type == known:
+                return name
+    return 'json'
+
+def _zigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+def _deltas(values):
+    values = np.asarray(values, dtype=np.int64)
+    return np.diff(values, prepend=np.int64(0))
+
+def _pack_groups(values, bits, flag, offset):
+    """
+    Split unsigned integers into little-endian groups of `bits` bits, setting
+    `flag` on every group but the last and adding `offset`; the shared core
+    of LEB128 varints (7 bits, 0x80, 0) and polyline chunks (5 bits, 0x20, 63).
+    Vectorized over all values at once.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if values.size == 0:
+        return np.empty(0, dtype=np.uint8)
+
+    mask = np.uint64((1 << bits) - 1)
+    groups = np.ones(values.size, dtype=np.int64)
+    remaining = values >> np.uint64(bits)
+    while remaining.any():
+        groups += remaining > 0
+        remaining >>= np.uint64(bits)
+
+    out = np.empty(int(groups.sum()), dtype=np.uint8)
+    starts = np.cumsum(groups) - groups
+    for k in range(int(groups.max())):
+        present = groups > k
+        chunk = (values[present] >> np.uint64(bits * k)) & mask
+        more = (groups[present] > k + 1).astype(np.uint64) * np.uint64(flag)
+        out[starts[present] + k] = (chunk | more) + np.uint64(offset)
+    return out
+
+def encode_varints(values):
+    """
+    Encode non-negative integers as concatenated LEB128 varints.
+    """
+    return _pack_groups(values, 7, 0x80, 0).tobytes()
+
+def encode_polyline(latitudes, longitudes, precision=5):
+    """
+    Encode coordinates with Google's polyline algorithm.
+    """
+    scale = 10 ** precision
+    lat = _deltas(np.round(np.asarray(latitudes, dtype=float) * scale))
+    lon = _deltas(np.round(np.asarray(longitudes, dtype=float) * scale))
+    interleaved = np.empty(lat.size * 2, dtype=np.int64)
+    interleaved[0::2] = lat
+    interleaved[1::2] = lon
+    # Polyline zigzag: invert negative values after shifting
+    shifted = interleaved << 1
+    shifted = np.where(interleaved < 0, ~shifted, shifted).astype(np.uint64)
+    return _pack_groups(shifted, 5, 0x20, 63).tobytes().decode('ascii')
+
+def decode_polyline(polyline, precision=5):
+    """
+    Reference decoder for encode_polyline. Returns a list of (lat, lon).
+    """
+    coordinates = []
+    index = lat = lon = 0
+    scale = 10 ** precision
+    while index < len(polyline):
+        deltas = []
+        for _ in range(2):
+            result = shift = 0
+            while True:
+                chunk = ord(polyline[index]) - 63
+                index += 1
+                result |= (chunk & 0x1f) << shift
+                shift += 5
+                if chunk < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        coordinates.append((lat / scale, lon / scale))
+    return coordinates
+
+def encode_binary(columns):
+    """
+    Encode history columns (see Location.get_history_columns) in the
+    delta/varint binary format described in the module docstring.
+    """
+    count = len(columns['id'])
+    parts = [
+        BINARY_MAGIC,
+        bytes([BINARY_VERSION]),
+        encode_varints([count]),
+        encode_varints(_zigzag(_deltas(columns['id']))),
+        encode_varints(_zigzag(_deltas(columns['timestamp_ms']))),
+        encode_varints(_zigzag(_deltas(np.round(columns['latitude'] * COORDINATE_SCALE)))),
+        encode_varints(_zigzag(_deltas(np.round(columns['longitude'] * COORDINATE_SCALE)))),
+    ]
+    for field in OPTIONAL_FIELDS:
+        values = np.asarray(columns[field], dtype=float)
+        present = ~np.isnan(values)
+        parts.append(np.packbits(present, bitorder='little').tobytes())
+        parts.append(encode_varints(_zigzag(_deltas(np.round(values[present] * OPTIONAL_SCALE)))))
+    return b''.join(parts)
+
+def decode_binary(data):
+    """
+    Reference decoder for encode_binary, in plain Python. Returns a list of
+    dicts with id, timestamp_ms, latitude, longitude and the optional fields
+    (None where absent).
+    """
+    if data[:4] != BINARY_MAGIC:
+        raise ValueError('Not a location-delta payload')
+    if data[4] != BINARY_VERSION:
+        raise ValueError(f'Unsupported version {data[4]}')
+    position = 5
+
+    def varint():
+        nonlocal position
+        result = shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            result |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return result
+
+    def signed_deltas(n):
+        total = 0
+        values = []
+        for _ in range(n):
+            raw = varint()
+            total += (raw >> 1) ^ -(raw & 1)
+            values.append(total)
+        return values
+
+    count = varint()
+    ids = signed_deltas(count)
+    timestamps = signed_deltas(count)
+    latitudes = [value / COORDINATE_SCALE for value in signed_deltas(count)]
+    longitudes = [value / COORDINATE_SCALE for value in signed_deltas(count)]
+
+    optional = {}
+    for field in OPTIONAL_FIELDS:
+        bitmap = data[position:position + (count + 7) // 8]
+        position += len(bitmap)
+        present = [bool(bitmap[i // 8] >> (i % 8) & 1) for i in range(count)]
+        values = iter(signed_deltas(sum(present)))
+        optional[field] = [next(values) / OPTIONAL_SCALE if flag else None for flag in present]
+
+    return [{
+        'id': ids[i],
+        'timestamp_ms': timestamps[i],
+        'latitude': latitudes[i],
+        'longitude': longitudes[i],
+        **{field: optional[field][i] for field in OPTIONAL_FIELDS},
+    } for i in range(count)]
+
+def encode_columnar(columns):
+    """
+    Convert history columns to a JSON-serialisable dict of parallel arrays.
+    """
+    encoded = {'count': len(columns['id'])}
+    for name, values in columns.items():
+        values = np.asarray(values)
+        if values.dtype.kind == 'f':
+            # NaN marks a missing value; JSON has null for that
+            encoded[name] = [None if value != value else value for value in values.tolist()]
+        else:
+            encoded[name] = values.tolist()
+    return encoded
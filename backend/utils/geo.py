@@ -0,0 +1,40 @@
+import math
+import numpy as np
+
+# Mean Earth radius in meters
+EARTH_RADIUS_M = 6371008.8
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in meters. Accepts scalars or NumPy arrays, which
+    are broadcast against each other.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=float)) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in meters between two points, for scalar use on
+    hot paths where NumPy's per-call overhead dominates.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
+
+def project_local(latitudes, longitudes):
+    """
+    Project coordinates onto a local equirectangular plane in meters,
+    centred on the mean latitude. Accurate enough for distance thresholds
+    over the extent of a single trip.
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    if latitudes.size == 0:
+        return latitudes, longitudes
+    # Unwrap so tracks crossing the antimeridian stay continuous
+    longitudes = np.degrees(np.unwrap(np.radians(longitudes)))
+    scale = np.cos(np.radians(latitudes.mean()))
+    x = EARTH_RADIUS_M * np.radians(longitudes) * scale
+    y = EARTH_RADIUS_M * np.radians(latitudes)
+    return x, y
@@ -0,0 +1,102 @@
+import math
+from collections import defaultdict
+from .geo import EARTH_RADIUS_M, distance_m
+
+def point_in_polygon(lat, lon, points):
+    """
+    Ray casting test of a point against a polygon given as [lat, lon]
+    vertices. Points exactly on an edge may fall either way.
+    """
+    inside = False
+    j = len(points) - 1
+    for i in range(len(points)):
+        lat_i, lon_i = points[i]
+        lat_j, lon_j = points[j]
+        if (lat_i > lat) != (lat_j > lat):
+            crossing = lon_i + (lat - lat_i) * (lon_j - lon_i) / (lat_j - lat_i)
+            if lon < crossing:
+                inside = not inside
+        j = i
+    return inside
+
+class Fence:
+    """
+    A geofence prepared for containment tests: its bounding box and an
+    exact test for candidates that pass it.
+    """
+    __slots__ = ('id', 'name', 'kind', 'latitude', 'longitude', 'radius', 'points', 'bbox')
+
+    def __init__(self, geofence):
+        self.id = geofence['id']
+        self.name = geofence['name']
+        self.kind = geofence['kind']
+        self.latitude = geofence.get('latitude')
+        self.longitude = geofence.get('longitude')
+        self.radius = geofence.get('radius')
+        self.points = geofence.get('points')
+
+        if self.kind == 'circle':
+            dlat = math.degrees(self.radius / EARTH_RADIUS_M)
+            cos_lat = math.cos(math.radians(self.latitude))
+            dlon = 180.0 if cos_lat < 1e-6 else min(180.0, dlat / cos_lat)
+            self.bbox = (self.latitude - dlat, self.longitude - dlon, self.latitude + dlat, self.longitude + dlon)
+        else:
+            lats = [point[0] for point in self.points]
+            lons = [point[1] for point in self.points]
+            self.bbox = (min(lats), min(lons), max(lats), max(lons))
+
+    def contains(self, lat, lon):
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        if self.kind == 'circle':
+            return distance_m(lat, lon, self.latitude, self.longitude) <= self.radius
+        return point_in_polygon(lat, lon, self.points)
+
+class GeofenceIndex:
+    """
+    Uniform grid over latitude/longitude mapping each cell to the fences
+    whose bounding box overlaps it. A lookup reads one cell, prefilters the
+    candidates by bounding box and runs the exact test only on those left.
+    Fences too large for the grid are kept in a separate list.
+
+    Fences crossing the antimeridian are not supported.
+    """
+    def __init__(self, geofences, cell_size, max_cells_per_fence):
+        self.cell_size = cell_size
+        self.fences = {}
+        self._cells = defaultdict(list)
+        self._large = []
+
+        for geofence in geofences:
+            fence = Fence(geofence)
+            self.fences[fence.id] = fence
+
+            min_lat, min_lon, max_lat, max_lon = fence.bbox
+            row_start, col_start = self._cell(min_lat, min_lon)
+            row_end, col_end = self._cell(max_lat, max_lon)
+            if (row_end - row_start + 1) * (col_end - col_start + 1) > max_cells_per_fence:
+                self._large.append(fence)
+                continue
+            for row in range(row_start, row_end + 1):
+                for col in range(col_start, col_end + 1):
+                    self._cells[(row, col)].append(fence)
+
+    def __len__(self):
+        return len(self.fences)
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def containing(self, lat, lon):
+        """
+        Ids of the fences containing a point.
+        """
+        inside = set()
+        for fence in self._cells.get(self._cell(lat, lon), ()):
+            if fence.contains(lat, lon):
+                inside.add(fence.id)
+        for fence in self._large:
+            if fence.contains(lat, lon):
+                inside.add(fence.id)
+        return inside
@@ -0,0 +1,55 @@
+import numpy as np
+
+TILE_SIZE = 256
+
+# Web mercator is undefined at the poles; clamp like map renderers do
+MAX_LATITUDE = 85.05112878
+
+def mercator_pixels(latitudes, longitudes, zoom):
+    """
+    Global web mercator pixel coordinates of points at a zoom level, with
+    256 pixel tiles: x grows east from the antimeridian, y south from the
+    top of the map. The tile of a pixel is (x // 256, y // 256).
+    """
+    latitudes = np.clip(np.asarray(latitudes, dtype=float), -MAX_LATITUDE, MAX_LATITUDE)
+    longitudes = np.asarray(longitudes, dtype=float)
+    world = TILE_SIZE * 2 ** zoom
+
+    x = (longitudes + 180.0) / 360.0 * world
+    sin_lat = np.sin(np.radians(latitudes))
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * world
+
+    x = np.clip(np.floor(x), 0, world - 1).astype(np.int64)
+    y = np.clip(np.floor(y), 0, world - 1).astype(np.int64)
+    return x, y
+
+def bin_points(latitudes, longitudes, zoom):
+    """
+    Count points per mercator pixel. Returns parallel (x, y, count) arrays
+    sorted by pixel.
+    """
+    if len(latitudes) == 0:
+        return empty_bins()
+    x, y = mercator_pixels(latitudes, longitudes, zoom)
+    world = TILE_SIZE * 2 ** zoom
+    keys, counts = np.unique(x * world + y, return_counts=True)
+    return keys // world, keys % world, counts.astype(np.int64)
+
+def merge_bins(bins, zoom):
+    """
+    Sum several (x, y, count) binnings of the same zoom into one.
+    """
+    bins = [b for b in bins if len(b[0])]
+    if not bins:
+        return empty_bins()
+    if len(bins) == 1:
+        return bins[0]
+    world = TILE_SIZE * 2 ** zoom
+    keys = np.concatenate([x * world + y for x, y, _ in bins])
+    counts = np.concatenate([count for _, _, count in bins])
+    unique, inverse = np.unique(keys, return_inverse=True)
+    totals = np.bincount(inverse, weights=counts).astype(np.int64)
+    return unique // world, unique % world, totals
+
+def empty_bins():
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
@@ -17,6 +17,66 @@ def json_response(data, status_code=200):
     
     return response
 
+def binary_response(data, content_type='application/octet-stream', status_code=200):
+    """
+    Create an HTTP response with a bytes body.
+    """
+    response = json_response(None, status_code)
+    response['headers']['Content-Type'] = content_type
+    response['body'] = data
+    return response
+
+def json_stream_response(data, key, items, batch_size=500):
+    """
+    Create a streamed JSON response. The body is the object data with the
+    list under key produced lazily from the items iterable, so the whole
+    list never has to be held in memory. Servers write the stream chunks
+    as they are produced.
+    """
+    def generate():
+        head = json.dumps(data)
+        yield head[:-1] + (', ' if data else '') + json.dumps(key) + ': ['
+        batch = []
+        first = True
+        for item in items:
+            batch.append(json.dumps(item))
+            if len(batch) >= batch_size:
+                yield ('' if first else ', ') + ', '.join(batch)
+                first = False
+                batch = []
+        if batch:
+            yield ('' if first else ', ') + ', '.join(batch)
+        yield ']}'
+
+    response = json_response(None)
+    del response['body']
+    response['stream'] = generate()
+    return response
+
+def event_stream_response(device_ids):
+    """
+    Create a Server-Sent Events response subscribing to events for
+    device_ids. The server sends the headers and then hands the connection
+    to its event hub instead of writing a body.
+    """
+    response = json_response(None)
+    del response['body']
+    response['headers'].update({
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response['subscribe'] = list(device_ids)
+    return response
+
+def response_body(response):
+    """
+    Return a response's full body, draining it if it is streamed.
+    """
+    if response.get('stream') is not None:
+        return ''.join(response['stream'])
+    return response.get('body', '')
+
 def success_response(data=None, message=None):
     """
     Create a success response.
@@ -37,6 +97,27 @@ def error_response(message, status_code=400):
     """
     return json_response({'success': False, 'message': message}, status_code)
 
+def not_modified_response(headers=None):
+    """
+    Create a body-less 304 Not Modified response.
+    """
+    response = json_response(None, 304)
+    response['body'] = ''
+    del response['headers']['Content-Type']
+    if headers:
+        response['headers'].update(headers)
+    return response
+
+def get_header(request, name):
+    """
+    Look up a request header case-insensitively.
+    """
+    name = name.lower()
+    for header, value in request.get('headers', {}).items():
+        if header.lower() == name:
+            return value
+    return None
+
 def parse_json_body(body):
     """
     Parse a JSON request body.
@@ -45,3 +126,26 @@ def parse_json_body(body):
         return json.loads(body)
     except json.JSONDecodeError:
         return None
+
+def parse_ndjson_body(body):
+    """
+    Parse a newline-delimited JSON request body into a list.
+    """
+    try:
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+    except json.JSONDecodeError:
+        return None
+
+def parse_request_body(body, content_type=''):
+    """
+    Parse a request body according to its Content-Type.
+    """
+    if 'ndjson' in (content_type or '').lower():
+        return parse_ndjson_body(body)
+    return parse_json_body(body)
+
+def is_number(value):
+    """
+    Check that a value from a parsed JSON body is a number (and not a boolean).
+    """
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
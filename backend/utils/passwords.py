@@ -0,0 +1,169 @@
+import os
+import hmac
+import time
+import base64
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from ..config import PASSWORD_CONFIG
+
+SCRYPT_PREFIX = 'scrypt'
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+class HasherBusyError(Exception):
+    """
+    Raised when too many hashes are pending to take another within the queue timeout.
+    """
+    pass
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+def scrypt_key(password, salt, n, r, p):
+    """
+    Derive a scrypt key. Runs in the hashing processes.
+    """
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=KEY_BYTES)
+
+def parse_hash(password_hash):
+    """
+    Split a stored hash into ('scrypt', (n, r, p), salt, key), or
+    ('sha256', None, None, hex digest) for legacy unsalted hashes.
+    """
+    if password_hash.startswith(SCRYPT_PREFIX + '$'):
+        _, n, r, p, salt, key = password_hash.split('$')
+        return SCRYPT_PREFIX, (int(n), int(r), int(p)), base64.b64decode(salt), base64.b64decode(key)
+    return 'sha256', None, None, password_hash
+
+class PasswordHasher:
+    """
+    Runs scrypt in a pool of worker processes so the CPU and memory-heavy
+    work never holds up request threads (or the GIL). At most max_pending
+    hashes are queued or running; callers past that wait up to
+    queue_timeout seconds and then get HasherBusyError.
+
+    Hashes are stored as scrypt$n$r$p$salt$key with base64 salt and key.
+    Legacy unsalted SHA-256 hex digests still verify, and are reported as
+    needing an upgrade, as are scrypt hashes made with other cost settings.
+
+    The pool is created on first use in each process, so prefork workers
+    each get their own. If no pool can be started (e.g. no shared memory
+    for its semaphores) hashing falls back to the calling thread.
+    """
+    # Latencies kept for the percentiles in stats()
+    LATENCY_SAMPLES = 1000
+
+    def __init__(self, n, r, p, workers, max_pending, queue_timeout):
+        self.params = (n, r, p)
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self._hashed = 0
+        self._rejected = 0
+
+    def _get_pool(self):
+        if self.workers <= 0:
+            return None
+        with self._lock:
+            if self._pool_pid != os.getpid():
+                self._pool_pid = os.getpid()
+                try:
+                    # Forking a threaded server is unsafe; start workers from a clean process
+                    methods = multiprocessing.get_all_start_methods()
+                    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=context)
+                except (OSError, ImportError) as e:
+                    print(f"Password hashing pool unavailable, hashing in-thread: {e}")
+                    self._pool = None
+            return self._pool
+
+    def _derive(self, password, salt, params):
+        """
+        Run one scrypt derivation in the pool, timing it from submission,
+        so queueing counts towards the latency callers see.
+        """
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self._rejected += 1
+            raise HasherBusyError('Too many password hashes pending')
+        try:
+            pool = self._get_pool()
+            if pool is None:
+                key = scrypt_key(password, salt, *params)
+            else:
+                key = pool.submit(scrypt_key, password, salt, *params).result()
+        finally:
+            self._slots.release()
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._hashed += 1
+            self._latencies.append(elapsed)
+        return key
+
+    def hash(self, password):
+        """
+        Hash a password with a fresh salt and the configured cost.
+        """
+        salt = os.urandom(SALT_BYTES)
+        key = self._derive(password, salt, self.params)
+        n, r, p = self.params
+        return f"{SCRYPT_PREFIX}${n}${r}${p}${_b64(salt)}${_b64(key)}"
+
+    def verify(self, password, password_hash):
+        """
+        Check a password against a stored hash (None for an unknown user).
+        Returns (matches, needs_upgrade), needs_upgrade meaning the hash
+        should be replaced with hash(password) now that the password is
+        known.
+        """
+        if password_hash is None:
+            # No such user: spend the same work, so that can't be told by timing
+            self._derive(password, bytes(SALT_BYTES), self.params)
+            return False, False
+
+        kind, params, salt, expected = parse_hash(password_hash)
+        if kind == 'sha256':
+            matches = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), expected)
+            return matches, matches
+
+        key = self._derive(password, salt, params)
+        matches = hmac.compare_digest(key, expected)
+        return matches, matches and params != self.params
+
+    def stats(self):
+        """
+        Snapshot of hashing throughput and per-hash latency, queueing included.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            hashed = self._hashed
+            rejected = self._rejected
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000 if latencies else 0.0
+
+        return {
+            'hashed': hashed,
+            'rejected': rejected,
+            'p50_ms': percentile(50),
+            'p99_ms': percentile(99),
+            'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        }
+
+password_hasher = PasswordHasher(
+    PASSWORD_CONFIG['scrypt_n'],
+    PASSWORD_CONFIG['scrypt_r'],
+    PASSWORD_CONFIG['scrypt_p'],
+    PASSWORD_CONFIG['workers'],
+    PASSWORD_CONFIG['max_pending'],
+    PASSWORD_CONFIG['queue_timeout'],
+)
@@ -0,0 +1,53 @@
+import threading
+from collections import defaultdict
+
+class EventBus:
+    """
+    In-process publish/subscribe of per-device events.
+
+    Callbacks run on the publishing thread and must not block; they are
+    expected to hand the event to their own buffer and return.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)  # device id -> callbacks
+        self._count = 0
+
+    def subscribe(self, device_ids, callback):
+        """
+        Deliver events for device_ids to callback(device_id, event, data).
+        Returns a token for unsubscribe().
+        """
+        device_ids = frozenset(device_ids)
+        with self._lock:
+            for device_id in device_ids:
+                self._subscribers[device_id].add(callback)
+            self._count += 1
+        return device_ids, callback
+
+    def unsubscribe(self, token):
+        device_ids, callback = token
+        with self._lock:
+            for device_id in device_ids:
+                callbacks = self._subscribers.get(device_id)
+                if callbacks is not None:
+                    callbacks.discard(callback)
+                    if not callbacks:
+                        del self._subscribers[device_id]
+            self._count -= 1
+
+    def publish(self, device_id, event, data):
+        with self._lock:
+            callbacks = list(self._subscribers.get(device_id, ()))
+        for callback in callbacks:
+            try:
+                callback(device_id, event, data)
+            except Exception as e:
+                print(f"Error delivering {event} event for device {device_id}: {e}")
+
+    @property
+    def subscriber_count(self):
+        return self._count
+
+# Process-wide bus fed by ingest (directly or via LISTEN/NOTIFY)
+event_bus = EventBus()
@@ -1,28 +1,191 @@
+import os
+import mmap
 import time
-from collections import defaultdict
-from ..config import RATE_LIMIT_CONFIG
+import struct
+import threading
+import multiprocessing
+from collections import OrderedDict
+from ..config import RATE_LIMIT_CONFIG, SERVER_CONFIG
 
-# Store request counts per IP address
-request_counts = defaultdict(list)
+class TokenBucketLimiter:
+    """
+    Thread-safe token buckets keyed by client, user or anything hashable.
+    Each key holds up to burst tokens, refilled continuously at
+    requests_per_minute; a request takes one token or is refused.
+
+    Every call does constant work. Buckets are kept in least recently seen
+    order, and each call drops a few from the front that have been idle
+    long enough to refill completely, which loses nothing since a new
+    bucket starts full. Past max_keys the least recently seen bucket is
+    dropped regardless.
+    """
+    # Idle buckets dropped per call at most
+    EVICT_PER_CALL = 2
+
+    def __init__(self, requests_per_minute, burst=None, max_keys=100000):
+        self.rate = requests_per_minute / 60.0
+        self.burst = float(burst or requests_per_minute)
+        self.max_keys = max_keys
+        # Seconds after which an untouched bucket is full again
+        self.idle_after = self.burst / self.rate if self.rate > 0 else float('inf')
+        self._buckets = OrderedDict()  # key -> [tokens, last refill time]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, key, now=None):
+        """
+        Take a token from key's bucket. Returns False if it is empty.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            buckets = self._buckets
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = [self.burst, now]
+                if len(buckets) > self.max_keys:
+                    buckets.popitem(last=False)
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                buckets.move_to_end(key)
+
+            for _ in range(self.EVICT_PER_CALL):
+                oldest_key, oldest = next(iter(buckets.items()))
+                if oldest_key == key or now - oldest[1] < self.idle_after:
+                    break
+                del buckets[oldest_key]
+
+            if bucket[0] < 1.0:
+                return False
+            bucket[0] -= 1.0
+            return True
+
+class SharedTokenBucketLimiter:
+    """
+    Token buckets like TokenBucketLimiter, kept in an anonymous shared
+    memory map so every worker process forked after it is created sees the
+    same buckets. Must be created before the workers fork.
+
+    The map is a fixed-size open-addressing hash table split into
+    lock_stripes equal slices, each guarded by its own process-shared lock;
+    a key's 64-bit hash picks its slice and home slot. Lookups probe at
+    most PROBE_LIMIT slots from there. A new key takes the first empty or
+    fully refilled slot in its probe window, or else evicts the least
+    recently seen one, so every call does bounded work and memory never
+    grows. Keys are told apart by hash alone; a collision between two
+    64-bit hashes is not worth guarding against.
+    """
+    # Slot: key hash (0 = empty), tokens, last refill time
+    SLOT = struct.Struct('<Qdd')
+    PROBE_LIMIT = 8
+    # Slots allocated per key of capacity, keeping probe windows short
+    LOAD_FACTOR = 0.5
+
+    def __init__(self, requests_per_minute, burst=None, max_keys=100000, lock_stripes=64):
+        self.rate = requests_per_minute / 60.0
+        self.burst = float(burst or requests_per_minute)
+        self.idle_after = self.burst / self.rate if self.rate > 0 else float('inf')
+
+        self.stripe_bits = max(0, lock_stripes - 1).bit_length()
+        self.stripes = 1 << self.stripe_bits
+        per_stripe = max(self.PROBE_LIMIT, int(max_keys / self.LOAD_FACTOR) // self.stripes)
+        self.slot_bits = (per_stripe - 1).bit_length()
+        self.stripe_slots = 1 << self.slot_bits
+        # Anonymous shared mappings are inherited by forked children
+        self._map = mmap.mmap(-1, self.stripes * self.stripe_slots * self.SLOT.size)
+        self._locks = [multiprocessing.Lock() for _ in range(self.stripes)]
+
+    def __len__(self):
+        slot_size = self.SLOT.size
+        return sum(
+            1 for offset in range(0, len(self._map), slot_size)
+            if self.SLOT.unpack_from(self._map, offset)[0]
+        )
+
+    def allow(self, key, now=None):
+        """
+        Take a token from key's bucket. Returns False if it is empty.
+        """
+        now = time.monotonic() if now is None else now
+        # CLOCK_MONOTONIC is system-wide, so times compare across processes
+        # Fibonacci hashing spreads out small integer keys like user ids,
+        # whose hash is the number itself
+        key_hash = (hash(key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF or 1
+        stripe = key_hash >> (64 - self.stripe_bits) if self.stripe_bits else 0
+        home = (key_hash >> (64 - self.stripe_bits - self.slot_bits)) & (self.stripe_slots - 1)
+        base = stripe * self.stripe_slots
+        slot_size = self.SLOT.size
+        memory = self._map
+
+        with self._locks[stripe]:
+            target = None
+            target_last = None
+            for probe in range(self.PROBE_LIMIT):
+                offset = (base + (home + probe) % self.stripe_slots) * slot_size
+                slot_hash, tokens, last = self.SLOT.unpack_from(memory, offset)
+                if slot_hash == key_hash:
+                    tokens = min(self.burst, tokens + (now - last) * self.rate)
+                    break
+                if slot_hash == 0 or now - last >= self.idle_after:
+                    # Free, or a bucket that has refilled and can be forgotten
+                    if target_last != float('-inf'):
+                        target, target_last = offset, float('-inf')
+                elif target_last is None or last < target_last:
+                    target, target_last = offset, last
+            else:
+                offset = target
+                tokens = self.burst
+
+            allowed = tokens >= 1.0
+            self.SLOT.pack_into(memory, offset, key_hash, tokens - 1.0 if allowed else tokens, now)
+            return allowed
+
+def use_shared_backend():
+    """
+    Whether rate limits are kept in shared memory rather than per process.
+    """
+    backend = RATE_LIMIT_CONFIG['backend']
+    if backend == 'auto':
+        return SERVER_CONFIG['mode'] == 'prefork' and hasattr(os, 'fork')
+    return backend == 'shared'
+
+def _limiter(requests_per_minute, burst=None):
+    # Created at import, in the parent process before any worker forks
+    if use_shared_backend():
+        return SharedTokenBucketLimiter(
+            requests_per_minute, burst, RATE_LIMIT_CONFIG['max_clients'], RATE_LIMIT_CONFIG['lock_stripes'])
+    return TokenBucketLimiter(requests_per_minute, burst, RATE_LIMIT_CONFIG['max_clients'])
+
+client_limiter = _limiter(RATE_LIMIT_CONFIG['requests_per_minute'], RATE_LIMIT_CONFIG['burst'])
+user_limiter = (_limiter(RATE_LIMIT_CONFIG['user_requests_per_minute'])
+                if RATE_LIMIT_CONFIG['user_requests_per_minute'] > 0 else None)
+# Longest prefix first, so the most specific rule applies
+route_limiters = [
+    (prefix, _limiter(limit))
+    for prefix, limit in sorted(RATE_LIMIT_CONFIG['routes'].items(), key=lambda rule: -len(rule[0]))
+]
 
 def is_rate_limited(ip_address):
     """
     Check if an IP address is rate limited.
     Returns True if rate limited, False otherwise.
     """
-    current_time = time.time()
-    
-    # Remove requests older than 1 minute
-    request_counts[ip_address] = [
-        timestamp for timestamp in request_counts[ip_address]
-        if current_time - timestamp < 60
-    ]
-    
-    # Check if the number of requests in the last minute exceeds the limit
-    if len(request_counts[ip_address]) >= RATE_LIMIT_CONFIG['requests_per_minute']:
-        return True
-    
-    # Add the current request
-    request_counts[ip_address].append(current_time)
-    
+    return not client_limiter.allow(ip_address)
+
+def is_request_rate_limited(path, ip_address, user_id=None):
+    """
+    Check the per-route limit of a client IP and the per-user limit, where
+    configured. Returns True if rate limited, False otherwise.
+    """
+    for prefix, limiter in route_limiters:
+        if path.startswith(prefix):
+            if not limiter.allow(ip_address):
+                return True
+            break
+
+    if user_limiter is not None and user_id is not None:
+        return not user_limiter.allow(user_id)
+
     return False
@@ -0,0 +1,41 @@
+import heapq
+import threading
+
+class RevocationList:
+    """
+    Thread-safe set of revoked token ids, each kept until the token it
+    revokes would have expired anyway.
+
+    Lookups are a single dict membership test. Expiries are kept in a
+    min-heap, so pruning only touches the ids that have expired.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._expiries = {}  # token id -> expiry as epoch seconds
+        self._heap = []  # (expiry, token id)
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def add(self, jti, expires_at):
+        with self._lock:
+            if jti in self._expiries:
+                return
+            self._expiries[jti] = expires_at
+            heapq.heappush(self._heap, (expires_at, jti))
+
+    def __contains__(self, jti):
+        # A dict lookup is atomic, so readers don't need the lock
+        return jti in self._expiries
+
+    def prune(self, now):
+        """
+        Forget ids whose tokens expired by now. Returns how many were pruned.
+        """
+        pruned = 0
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, jti = heapq.heappop(self._heap)
+                del self._expiries[jti]
+                pruned += 1
+        return pruned
@@ -0,0 +1,164 @@
+import heapq
+import numpy as np
+from .geo import project_local
+
+def find_stops(x, y, seconds, radius, min_duration):
+    """
+    Find stops in a projected track: stretches where the device stays within
+    radius meters for at least min_duration seconds. A fix starts a
+    stationary window if the first fix min_duration seconds later is still
+    within radius of it; overlapping windows are merged into one stop.
+    Returns the indices of the first and last fix of every stop.
+    """
+    n = len(x)
+    if n < 2:
+        return np.empty(0, dtype=np.intp)
+
+    # For every fix, the first fix at least min_duration later
+    window_end = np.searchsorted(seconds, seconds + min_duration, side='left')
+    valid = window_end < n
+    starts = np.flatnonzero(valid)
+    ends = window_end[valid]
+    if starts.size == 0:
+        return np.empty(0, dtype=np.intp)
+
+    displacement = np.hypot(x[ends] - x[starts], y[ends] - y[starts])
+    still = displacement <= radius
+    starts, ends = starts[still], ends[still]
+    if starts.size == 0:
+        return np.empty(0, dtype=np.intp)
+
+    # Merge overlapping [start, end] windows with a difference array
+    coverage = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(coverage, starts, 1)
+    np.add.at(coverage, ends + 1, -1)
+    stationary = np.cumsum(coverage[:-1]) > 0
+
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], stationary.astype(np.int8), [0]))))
+    return np.unique(np.concatenate((edges[0::2], edges[1::2] - 1)))
+
+def douglas_peucker(x, y, tolerance, keep=None):
+    """
+    Douglas-Peucker simplification of a projected track. Points already set
+    in keep are preserved and split the track into independently simplified
+    spans. Distances to each span are computed with vectorized NumPy.
+    Returns a boolean mask of the points to keep.
+    """
+    n = len(x)
+    keep = np.zeros(n, dtype=bool) if keep is None else keep.copy()
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+
+    anchors = np.flatnonzero(keep)
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        # Distance from each interior point to the segment start-end
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        length2 = dx * dx + dy * dy
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        if length2 > 0:
+            t = np.clip((px * dx + py * dy) / length2, 0.0, 1.0)
+            distances = np.hypot(px - t * dx, py - t * dy)
+        else:
+            distances = np.hypot(px, py)
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return keep
+
+def visvalingam(x, y, max_points, keep=None):
+    """
+    Visvalingam-Whyatt simplification down to at most max_points, repeatedly
+    removing the point whose triangle with its neighbours has the smallest
+    area. Points set in keep are never removed. Returns a boolean mask.
+    """
+    n = len(x)
+    protected = np.zeros(n, dtype=bool) if keep is None else keep.copy()
+    if n == 0:
+        return protected
+    protected[0] = protected[-1] = True
+    alive = np.ones(n, dtype=bool)
+    if n <= max_points:
+        return alive
+
+    # Initial areas for every interior point, vectorized
+    areas = np.full(n, np.inf)
+    areas[1:-1] = 0.5 * np.abs(
+        (x[:-2] - x[2:]) * (y[1:-1] - y[:-2]) - (x[:-2] - x[1:-1]) * (y[2:] - y[:-2])
+    )
+    areas[protected] = np.inf
+    areas = areas.tolist()
+    xs, ys = x.tolist(), y.tolist()
+    previous = list(range(-1, n - 1))
+    following = list(range(1, n + 1))
+
+    heap = [(areas[i], i) for i in range(1, n - 1) if not protected[i]]
+    heapq.heapify(heap)
+
+    remaining = n
+    while remaining > max_points and heap:
+        area, index = heapq.heappop(heap)
+        if not alive[index] or area != areas[index]:
+            continue  # Stale heap entry
+        alive[index] = False
+        remaining -= 1
+
+        before, after = previous[index], following[index]
+        following[before] = after
+        previous[after] = before
+
+        for neighbour in (before, after):
+            if protected[neighbour]:
+                continue
+            a, c = previous[neighbour], following[neighbour]
+            new_area = 0.5 * abs(
+                (xs[a] - xs[c]) * (ys[neighbour] - ys[a]) - (xs[a] - xs[neighbour]) * (ys[c] - ys[a])
+            )
+            # Never let a neighbour become cheaper to drop than the point just removed
+            areas[neighbour] = max(new_area, area)
+            heapq.heappush(heap, (areas[neighbour], neighbour))
+
+    return alive
+
+def simplify_mask(latitudes, longitudes, seconds, tolerance=None, max_points=None,
+                  stop_radius=25.0, stop_min_duration=120.0):
+    """
+    Compute which fixes of a time-ordered track to keep when simplifying it
+    for drawing. The first and last fix and the start and end of every stop
+    are always kept. tolerance (meters) runs Douglas-Peucker, max_points caps
+    the result with Visvalingam-Whyatt; both may be combined.
+    Returns a boolean mask.
+    """
+    n = len(latitudes)
+    if n <= 2 or (tolerance is None and max_points is None):
+        return np.ones(n, dtype=bool)
+
+    x, y = project_local(latitudes, longitudes)
+
+    anchors = np.zeros(n, dtype=bool)
+    anchors[0] = anchors[-1] = True
+    anchors[find_stops(x, y, np.asarray(seconds, dtype=float), stop_radius, stop_min_duration)] = True
+
+    if tolerance is not None:
+        keep = douglas_peucker(x, y, tolerance, anchors)
+    else:
+        keep = np.ones(n, dtype=bool)
+
+    if max_points is not None and keep.sum() > max_points:
+        # Simplify further among the points that survived so far
+        candidates = np.flatnonzero(keep)
+        survived = visvalingam(x[candidates], y[candidates], max_points, anchors[candidates])
+        keep = np.zeros(n, dtype=bool)
+        keep[candidates[survived]] = True
+
+    return keep
@@ -0,0 +1,197 @@
+import math
+import heapq
+import threading
+from .geo import EARTH_RADIUS_M, distance_m
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = EARTH_RADIUS_M * math.pi / 180
+
+class PositionIndex:
+    """
+    Latest position of each device in uniform latitude/longitude grids,
+    answering radius and k-nearest-neighbour queries by visiting only the
+    cells around the query point. Each coarser level has cells LEVEL_RATIO
+    times wider, so sparse fleets and large radii are served by a level
+    where the search window covers few cells.
+
+    Positions are location dicts as returned by the models; an update only
+    replaces a device's position with a newer fix. Longitudes are not
+    wrapped, so queries don't see across the antimeridian.
+    """
+    LEVELS = 5
+    LEVEL_RATIO = 4
+    # Largest number of cells a query visits on one level before moving to
+    # the next coarser one
+    MAX_WINDOW_CELLS = 256
+
+    def __init__(self, cell_size):
+        self.cell_sizes = [cell_size * self.LEVEL_RATIO ** level for level in range(self.LEVELS)]
+        self._lock = threading.Lock()
+        self._grids = [{} for _ in self.cell_sizes]  # per level: (row, col) -> {device id: location}
+        self._positions = {}  # device id -> (cell on each level, location)
+
+    def __len__(self):
+        return len(self._positions)
+
+    @staticmethod
+    def _cell(lat, lon, cell_size):
+        return math.floor(lat / cell_size), math.floor(lon / cell_size)
+
+    def update(self, location):
+        """
+        Record a device's fix unless a newer one is already indexed.
+        Returns whether the position changed.
+        """
+        device_id = location['device_id']
+        cells = [self._cell(location['latitude'], location['longitude'], size) for size in self.cell_sizes]
+        with self._lock:
+            current = self._positions.get(device_id)
+            if current is not None:
+                old_cells, old = current
+                if (old['timestamp'], old['id']) >= (location['timestamp'], location['id']):
+                    return False
+                self._discard(old_cells, device_id)
+            for grid, cell in zip(self._grids, cells):
+                grid.setdefault(cell, {})[device_id] = location
+            self._positions[device_id] = (cells, location)
+            return True
+
+    def remove(self, device_id):
+        with self._lock:
+            current = self._positions.pop(device_id, None)
+            if current is not None:
+                self._discard(current[0], device_id)
+
+    def _discard(self, cells, device_id):
+        for grid, cell in zip(self._grids, cells):
+            members = grid[cell]
+            del members[device_id]
+            if not members:
+                del grid[cell]
+
+    def within(self, lat, lon, radius, limit=None):
+        """
+        (distance in meters, location) of every device within radius meters
+        of a point, nearest first, at most limit of them.
+        """
+        dlat = math.degrees(radius / EARTH_RADIUS_M)
+        cos_lat = math.cos(math.radians(min(90.0, abs(lat) + dlat)))
+        dlon = 360.0 if cos_lat < 1e-9 else min(360.0, dlat / cos_lat)
+
+        found = []
+        with self._lock:
+            # Finest level whose window is small enough, else the coarsest
+            for size, grid in zip(self.cell_sizes, self._grids):
+                row_start, col_start = self._cell(lat - dlat, lon - dlon, size)
+                row_end, col_end = self._cell(lat + dlat, lon + dlon, size)
+                window = (row_end - row_start + 1) * (col_end - col_start + 1)
+                if window <= self.MAX_WINDOW_CELLS:
+                    break
+
+            if window > len(grid):
+                # Fewer occupied cells than cells in the window: scan those instead
+                cells = [members for (row, col), members in grid.items()
+                         if row_start <= row <= row_end and col_start <= col <= col_end]
+            else:
+                cells = [grid[(row, col)]
+                         for row in range(row_start, row_end + 1)
+                         for col in range(col_start, col_end + 1)
+                         if (row, col) in grid]
+
+            for members in cells:
+                for location in members.values():
+                    if abs(location['latitude'] - lat) > dlat or abs(location['longitude'] - lon) > dlon:
+                        continue
+                    distance = distance_m(lat, lon, location['latitude'], location['longitude'])
+                    if distance <= radius:
+                        found.append((distance, location))
+
+        found.sort(key=lambda item: (item[0], item[1]['device_id']))
+        return found[:limit] if limit is not None else found
+
+    def nearest(self, lat, lon, k):
+        """
+        (distance in meters, location) of the k devices nearest to a point,
+        nearest first. Searches rings of cells outwards from the point's
+        cell until no unvisited cell can hold anything closer than the k-th
+        best so far, moving to a coarser level when the rings grow too wide.
+        """
+        if k <= 0:
+            return []
+
+        with self._lock:
+            if k < len(self._positions):
+                for size, grid in zip(self.cell_sizes, self._grids):
+                    best = self._nearest_rings(grid, size, lat, lon, k)
+                    if best is not None:
+                        break
+                else:
+                    best = None
+            else:
+                best = None
+
+            if best is None:
+                best = [
+                    (-distance_m(lat, lon, location['latitude'], location['longitude']), device_id, location)
+                    for device_id, (_, location) in self._positions.items()
+                ]
+
+        best.sort(key=lambda item: (-item[0], item[1]))
+        return [(-distance, location) for distance, _, location in best[:k]]
+
+    def _nearest_rings(self, grid, cell_size, lat, lon, k):
+        """
+        Ring search on one grid level. Returns the heap of the k nearest as
+        (-distance, device id, location), or None if the search window grew
+        past MAX_WINDOW_CELLS first.
+        """
+        row0, col0 = self._cell(lat, lon, cell_size)
+        best = []  # max-heap of the k nearest
+        visited = 0
+        ring = 0
+        while True:
+            for cell in self._ring(row0, col0, ring):
+                members = grid.get(cell)
+                if members is None:
+                    continue
+                visited += 1
+                for device_id, location in members.items():
+                    if len(best) < k:
+                        distance = distance_m(lat, lon, location['latitude'], location['longitude'])
+                        heapq.heappush(best, (-distance, device_id, location))
+                        continue
+                    # The latitude gap alone bounds the distance from below,
+                    # which rules most candidates out without the haversine
+                    worst = -best[0][0]
+                    if abs(location['latitude'] - lat) * METERS_PER_DEGREE >= worst:
+                        continue
+                    distance = distance_m(lat, lon, location['latitude'], location['longitude'])
+                    if distance < worst:
+                        heapq.heapreplace(best, (-distance, device_id, location))
+
+            if visited == len(grid):
+                return best
+
+            # Anything outside the rings searched so far is at least ring
+            # cells away north/south, or east/west at the narrowest
+            # longitude spacing in reach
+            reach = min(90.0, abs(lat) + (ring + 1) * cell_size)
+            bound = ring * cell_size * METERS_PER_DEGREE * math.cos(math.radians(reach))
+            if len(best) == k and -best[0][0] <= bound:
+                return best
+
+            ring += 1
+            if (2 * ring + 1) ** 2 > self.MAX_WINDOW_CELLS:
+                return None
+
+    @staticmethod
+    def _ring(row0, col0, ring):
+        if ring == 0:
+            yield row0, col0
+            return
+        for col in range(col0 - ring, col0 + ring + 1):
+            yield row0 - ring, col
+            yield row0 + ring, col
+        for row in range(row0 - ring + 1, row0 + ring):
+            yield row, col0 - ring
+            yield row, col0 + ring
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import socket
+import selectors
+import threading
+from collections import deque
+from ..config import REALTIME_CONFIG
+from .pubsub import event_bus
+
+# Comment line sent to idle subscribers so proxies keep the connection open
+HEARTBEAT = b': ping\n\n'
+
+# Tells EventSource clients how long to wait before reconnecting
+RETRY = b'retry: 3000\n\n'
+
+def format_sse(event, data, event_id=None):
+    """
+    Encode one Server-Sent Event. data is serialized as single-line JSON.
+    """
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+def event_id_for(data):
+    """
+    Event id for a location event, so clients can tell fixes apart.
+    """
+    if isinstance(data, dict) and 'id' in data:
+        return data['id']
+    return None
+
+class _Subscriber:
+    __slots__ = ('sock', 'buffer', 'pending', 'token', 'events', 'last_progress', 'dropped', 'closed')
+
+    def __init__(self, sock, buffer_size):
+        self.sock = sock
+        self.buffer = deque(maxlen=buffer_size)
+        self.pending = b''
+        self.token = None
+        self.events = 0
+        self.last_progress = time.monotonic()
+        self.dropped = 0
+        self.closed = False
+
+class SSEHub:
+    """
+    Serves event-stream subscribers from a single selector thread.
+
+    Request handlers write the response headers and hand the socket over
+    with attach(); from then on no worker thread is tied up by the
+    subscription. Each subscriber has a bounded buffer (the oldest events
+    are dropped when a client falls behind), sockets are written
+    non-blocking with partial writes carried over, idle subscribers get
+    heartbeats and subscribers that accept nothing for stall_timeout
+    seconds are disconnected.
+    """
+    def __init__(self, bus=event_bus, buffer_size=None, heartbeat_interval=None,
+                 stall_timeout=None, max_subscribers=None):
+        self.bus = bus
+        self.buffer_size = buffer_size or REALTIME_CONFIG['buffer_size']
+        self.heartbeat_interval = heartbeat_interval or REALTIME_CONFIG['heartbeat_interval']
+        self.stall_timeout = stall_timeout or REALTIME_CONFIG['stall_timeout']
+        self.max_subscribers = max_subscribers or REALTIME_CONFIG['max_subscribers']
+
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._new = []
+        self._dirty = set()
+        self._reserved = 0
+
+        self._thread = threading.Thread(target=self._run, name='sse-hub', daemon=True)
+        self._thread.start()
+
+    def reserve(self):
+        """
+        Claim a subscriber slot before sending response headers. Returns
+        False when the hub is full; a successful reserve must be followed
+        by attach() or release().
+        """
+        with self._lock:
+            if len(self._subscribers) + len(self._new) + self._reserved >= self.max_subscribers:
+                return False
+            self._reserved += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._reserved -= 1
+
+    def attach(self, sock, device_ids):
+        """
+        Take over a connected socket (headers already sent) and stream
+        events for device_ids to it. Must follow a successful reserve().
+        """
+        sock.setblocking(False)
+        subscriber = _Subscriber(sock, self.buffer_size)
+        subscriber.buffer.append(RETRY)
+
+        def deliver(device_id, event, data):
+            self._deliver(subscriber, format_sse(event, data, event_id_for(data)))
+
+        subscriber.token = self.bus.subscribe(device_ids, deliver)
+        with self._lock:
+            self._reserved -= 1
+            self._new.append(subscriber)
+            self._dirty.add(subscriber)
+        self._wake()
+
+    def _deliver(self, subscriber, payload):
+        with self._lock:
+            if subscriber.closed:
+                return
+            if len(subscriber.buffer) == subscriber.buffer.maxlen:
+                subscriber.dropped += 1
+            subscriber.buffer.append(payload)
+            self._dirty.add(subscriber)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            # Buffer full means a wake-up is already pending
+            pass
+
+    def _run(self):
+        next_heartbeat = time.monotonic() + self.heartbeat_interval
+        while True:
+            timeout = max(0.0, next_heartbeat - time.monotonic())
+            for key, mask in self._selector.select(timeout):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+
+                subscriber = key.data
+                if mask & selectors.EVENT_READ:
+                    # Clients never send anything; readable means closed
+                    try:
+                        if not subscriber.sock.recv(4096):
+                            self._close(subscriber)
+                            continue
+                    except BlockingIOError:
+                        pass
+                    except OSError:
+                        self._close(subscriber)
+                        continue
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(subscriber)
+
+            with self._lock:
+                new, self._new = self._new, []
+                dirty, self._dirty = self._dirty, set()
+            for subscriber in new:
+                subscriber.events = selectors.EVENT_READ
+                self._selector.register(subscriber.sock, subscriber.events, subscriber)
+                self._subscribers[subscriber.sock.fileno()] = subscriber
+            for subscriber in dirty:
+                if not subscriber.closed:
+                    self._flush(subscriber)
+
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                self._heartbeat(now)
+                next_heartbeat = now + self.heartbeat_interval
+
+    def _heartbeat(self, now):
+        for subscriber in list(self._subscribers.values()):
+            if subscriber.pending or subscriber.buffer:
+                if now - subscriber.last_progress > self.stall_timeout:
+                    print(f"Disconnecting stalled event subscriber ({subscriber.dropped} events dropped)")
+                    self._close(subscriber)
+                continue
+            with self._lock:
+                subscriber.buffer.append(HEARTBEAT)
+            self._flush(subscriber)
+
+    def _flush(self, subscriber):
+        while True:
+            if not subscriber.pending:
+                with self._lock:
+                    if not subscriber.buffer:
+                        break
+                    subscriber.pending = b''.join(subscriber.buffer)
+                    subscriber.buffer.clear()
+            try:
+                sent = subscriber.sock.send(subscriber.pending)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self._close(subscriber)
+                return
+            if sent:
+                subscriber.last_progress = time.monotonic()
+                subscriber.pending = subscriber.pending[sent:]
+            if subscriber.pending:
+                break
+
+        # Only wait for writability while there is something left to send
+        events = selectors.EVENT_READ
+        if subscriber.pending:
+            events |= selectors.EVENT_WRITE
+        if events != subscriber.events:
+            self._selector.modify(subscriber.sock, events, subscriber)
+            subscriber.events = events
+
+    def _close(self, subscriber):
+        with self._lock:
+            if subscriber.closed:
+                return
+            subscriber.closed = True
+        self.bus.unsubscribe(subscriber.token)
+        self._subscribers.pop(subscriber.sock.fileno(), None)
+        try:
+            self._selector.unregister(subscriber.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            subscriber.sock.close()
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': len(self._subscribers) + len(self._new),
+                'dropped': sum(s.dropped for s in self._subscribers.values()),
+            }
+
+_hub = None
+_hub_lock = threading.Lock()
+
+def get_sse_hub():
+    """
+    Return this process's hub, starting it on first use (and again in a
+    forked worker, whose copy has no selector thread).
+    """
+    global _hub
+    with _hub_lock:
+        if _hub is None or _hub.pid != os.getpid():
+            _hub = SSEHub()
+            _hub.pid = os.getpid()
+        return _hub
@@ -0,0 +1,100 @@
+from datetime import datetime, timezone
+import numpy as np
+from .geo import haversine, project_local
+from .simplify import find_stops
+
+def _iso(timestamp_ms):
+    return datetime.fromtimestamp(timestamp_ms / 1000, timezone.utc).replace(tzinfo=None).isoformat()
+
+def segment_track(columns, stop_radius, stop_min_duration, max_gap):
+    """
+    Split a time-ordered track into stops and trips. columns are parallel
+    arrays as returned by Location.get_history_columns.
+
+    The track is first cut wherever consecutive fixes are more than max_gap
+    seconds apart. Within each piece, stops are stretches of at least
+    stop_min_duration seconds within stop_radius meters (see find_stops),
+    and trips are the movement between them. A trip shares its first fix
+    with the stop before it and its last with the stop after it.
+
+    Distances are great-circle, duration in seconds and speeds in meters
+    per second, computed with vectorized NumPy over all fixes at once. The
+    max speed comes from consecutive fixes, not the reported speed. Stops
+    report no distance or speed, since within a stop those are GPS jitter.
+    """
+    ids = columns['id']
+    timestamps = columns['timestamp_ms']
+    latitudes = columns['latitude']
+    longitudes = columns['longitude']
+    n = len(ids)
+    if n < 2:
+        return []
+
+    seconds = (timestamps - timestamps[0]) / 1000.0
+    step_meters = haversine(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+    step_seconds = np.diff(seconds)
+    step_speeds = np.divide(step_meters, step_seconds, out=np.zeros_like(step_meters), where=step_seconds > 0)
+    travelled = np.concatenate(([0.0], np.cumsum(step_meters)))
+
+    # Pieces of the track without a gap longer than max_gap, as [start, stop)
+    breaks = np.flatnonzero(step_seconds > max_gap) + 1
+    piece_starts = np.concatenate(([0], breaks))
+    piece_stops = np.concatenate((breaks, [n]))
+
+    spans = []  # (kind, first fix, last fix)
+    for start, stop in zip(piece_starts.tolist(), piece_stops.tolist()):
+        if stop - start < 2:
+            continue
+        x, y = project_local(latitudes[start:stop], longitudes[start:stop])
+        stops = find_stops(x, y, seconds[start:stop], stop_radius, stop_min_duration).reshape(-1, 2) + start
+
+        position = start
+        for first, last in stops.tolist():
+            if first > position:
+                spans.append(('trip', position, first))
+            spans.append(('stop', first, last))
+            position = last
+        if stop - 1 > position:
+            spans.append(('trip', position, stop - 1))
+
+    if not spans:
+        return []
+
+    firsts = np.array([span[1] for span in spans])
+    lasts = np.array([span[2] for span in spans])
+
+    distances = travelled[lasts] - travelled[firsts]
+    durations = seconds[lasts] - seconds[firsts]
+    average_speeds = np.divide(distances, durations, out=np.zeros_like(distances), where=durations > 0)
+    # Max over the steps of each span: reduce over [first, last) pairs and
+    # keep every other result
+    bounds = np.stack((firsts, lasts), axis=1).ravel()
+    max_speeds = np.maximum.reduceat(np.append(step_speeds, 0.0), bounds)[::2]
+    # Centroids from running sums
+    lat_sums = np.concatenate(([0.0], np.cumsum(latitudes)))
+    lon_sums = np.concatenate(([0.0], np.cumsum(longitudes)))
+    counts = lasts - firsts + 1
+    moving = np.array([span[0] == 'trip' for span in spans])
+    distances, average_speeds, max_speeds = (
+        np.where(moving, values, 0.0) for values in (distances, average_speeds, max_speeds))
+    centre_lats = (lat_sums[lasts + 1] - lat_sums[firsts]) / counts
+    centre_lons = (lon_sums[lasts + 1] - lon_sums[firsts]) / counts
+
+    return [{
+        'type': kind,
+        'start_time': _iso(int(timestamps[first])),
+        'end_time': _iso(int(timestamps[last])),
+        'start_location_id': int(ids[first]),
+        'end_location_id': int(ids[last]),
+        'point_count': int(counts[i]),
+        'distance_m': round(float(distances[i]), 1),
+        'duration_s': round(float(durations[i]), 3),
+        'avg_speed_mps': round(float(average_speeds[i]), 2),
+        'max_speed_mps': round(float(max_speeds[i]), 2),
+        'start_latitude': float(latitudes[first]),
+        'start_longitude': float(longitudes[first]),
+        'end_latitude': float(latitudes[last]),
+        'end_longitude': float(longitudes[last]),
+        'latitude': float(centre_lats[i]),
+        'longitude': float(centre_lons[i]),
+    } for i, (kind, first, last) in enumerate(spans)]
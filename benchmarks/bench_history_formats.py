@@ -0,0 +1,93 @@
+"""
+Compare payload size and encode time of the location history formats on a
+synthetic 1 Hz track.
+
+Usage:
+    python benchmarks/bench_history_formats.py [--points 100000]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.utils.formats import decode_binary, encode_binary, encode_columnar, encode_polyline
+
+
+def synthetic_columns(points):
+    rng = np.random.default_rng(42)
+    start_ms = int(datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp() * 1000)
+    return {
+        'id': np.arange(points, dtype=np.int64) + 1_000_000,
+        'timestamp_ms': start_ms + np.arange(points, dtype=np.int64) * 1000,
+        'latitude': 51.5 + np.cumsum(rng.normal(0, 5e-5, points)),
+        'longitude': -0.12 + np.cumsum(rng.normal(0, 5e-5, points)),
+        'accuracy': np.round(rng.uniform(3, 15, points), 1),
+        'speed': np.where(rng.random(points) < 0.1, np.nan, np.round(rng.uniform(0, 30, points), 2)),
+        'heading': np.round(rng.uniform(0, 360, points), 1),
+        'altitude': np.round(30 + np.cumsum(rng.normal(0, 0.2, points)), 1),
+    }
+
+
+def current_json(columns):
+    """
+    The existing response: one 9-key object per fix with an ISO timestamp.
+    """
+    locations = [{
+        'id': int(columns['id'][i]),
+        'device_id': 1,
+        'latitude': float(columns['latitude'][i]),
+        'longitude': float(columns['longitude'][i]),
+        'timestamp': datetime.fromtimestamp(columns['timestamp_ms'][i] / 1000, timezone.utc).replace(tzinfo=None).isoformat(),
+        'accuracy': float(columns['accuracy'][i]),
+        'speed': None if np.isnan(columns['speed'][i]) else float(columns['speed'][i]),
+        'heading': float(columns['heading'][i]),
+        'altitude': float(columns['altitude'][i]),
+    } for i in range(len(columns['id']))]
+    return json.dumps({'success': True, 'locations': locations}).encode('utf-8')
+
+
+def measure(encode, columns, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        payload = encode(columns)
+        best = min(best, time.perf_counter() - started)
+    return payload, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=100_000)
+    args = parser.parse_args()
+
+    columns = synthetic_columns(args.points)
+    encoders = [
+        ('json (current)', current_json),
+        ('columnar json', lambda c: json.dumps(encode_columnar(c)).encode('utf-8')),
+        ('polyline', lambda c: json.dumps({'polyline': encode_polyline(c['latitude'], c['longitude'])}).encode('utf-8')),
+        ('binary', encode_binary),
+    ]
+
+    print(f"{args.points} points")
+    print(f"{'format':<16} {'bytes':>12} {'gzip bytes':>12} {'bytes/point':>12} {'encode ms':>10}")
+    for name, encode in encoders:
+        payload, seconds = measure(encode, columns)
+        print(f"{name:<16} {len(payload):>12,} {len(gzip.compress(payload)):>12,} "
+              f"{len(payload) / args.points:>12.2f} {seconds * 1000:>10.1f}")
+
+    # Sanity check the reference decoder against the source data
+    decoded = decode_binary(encode_binary(columns))
+    assert len(decoded) == args.points
+    assert decoded[-1]['id'] == columns['id'][-1]
+    assert abs(decoded[-1]['latitude'] - columns['latitude'][-1]) < 1e-7
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Latency of radius and k-nearest-neighbour queries against the in-memory
+position index, checked against a brute-force oracle.
+
+The target is a sub-millisecond p99, not just p50: a query landing in a
+sparse area can fall through to a coarser grid level and scan far more
+devices than a typical one. With 100k devices, radius queries up to 2 km
+and k<=10 stay under it; k=100 sits right at it (p99 of about 0.9-1.2 ms
+across runs), so large k is not guaranteed sub-millisecond.
+
+Usage:
+    python benchmarks/bench_nearby.py [--devices 100000] [--queries 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.config import LOCATION_CONFIG
+from backend.utils.geo import distance_m
+from backend.utils.spatial import PositionIndex
+
+
+def synthetic_fleet(devices, spread, seed=42):
+    """
+    Devices scattered around a city centre, denser towards the middle.
+    """
+    rng = random.Random(seed)
+    return [{
+        'id': device_id,
+        'device_id': device_id,
+        'latitude': 6.5 + rng.gauss(0, spread),
+        'longitude': 3.4 + rng.gauss(0, spread),
+        'timestamp': '2024-01-01T00:00:00',
+    } for device_id in range(devices)]
+
+
+def oracle_within(fleet, lat, lon, radius):
+    found = [(distance_m(lat, lon, l['latitude'], l['longitude']), l['device_id']) for l in fleet]
+    return [device_id for distance, device_id in sorted(found) if distance <= radius]
+
+
+def oracle_nearest(fleet, lat, lon, k):
+    found = [(distance_m(lat, lon, l['latitude'], l['longitude']), l['device_id']) for l in fleet]
+    return [device_id for _, device_id in sorted(found)[:k]]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {p: samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000 for p in (50, 99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=100_000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--spread', type=float, default=0.3, help='standard deviation of positions in degrees')
+    parser.add_argument('--oracle-queries', type=int, default=50)
+    args = parser.parse_args()
+
+    fleet = synthetic_fleet(args.devices, args.spread)
+    index = PositionIndex(LOCATION_CONFIG['nearby_cell_size'])
+    started = time.perf_counter()
+    for location in fleet:
+        index.update(location)
+    print(f"{args.devices} devices indexed in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    rng = random.Random(7)
+    points = [(6.5 + rng.gauss(0, args.spread), 3.4 + rng.gauss(0, args.spread)) for _ in range(args.queries)]
+
+    cases = [
+        ('radius 500 m', lambda lat, lon: index.within(lat, lon, 500),
+         lambda lat, lon: oracle_within(fleet, lat, lon, 500)),
+        ('radius 2 km', lambda lat, lon: index.within(lat, lon, 2000),
+         lambda lat, lon: oracle_within(fleet, lat, lon, 2000)),
+        ('knn k=1', lambda lat, lon: index.nearest(lat, lon, 1),
+         lambda lat, lon: oracle_nearest(fleet, lat, lon, 1)),
+        ('knn k=10', lambda lat, lon: index.nearest(lat, lon, 10),
+         lambda lat, lon: oracle_nearest(fleet, lat, lon, 10)),
+        ('knn k=100', lambda lat, lon: index.nearest(lat, lon, 100),
+         lambda lat, lon: oracle_nearest(fleet, lat, lon, 100)),
+    ]
+
+    print(f"{'query':<14} {'results':>8} {'p50 ms':>8} {'p99 ms':>8} {'oracle ms':>10}")
+    for name, query, oracle in cases:
+        timings = []
+        results = 0
+        for lat, lon in points:
+            started = time.perf_counter()
+            found = query(lat, lon)
+            timings.append(time.perf_counter() - started)
+            results += len(found)
+
+        # Compare against brute force on a sample of the query points
+        oracle_started = time.perf_counter()
+        for lat, lon in points[:args.oracle_queries]:
+            expected = oracle(lat, lon)
+            actual = [location['device_id'] for _, location in query(lat, lon)]
+            assert actual == expected, f"{name} at ({lat}, {lon}): {actual[:5]} != {expected[:5]}"
+        oracle_ms = (time.perf_counter() - oracle_started) * 1000 / min(args.oracle_queries, len(points))
+
+        stats = percentiles(timings)
+        print(f"{name:<14} {results / len(points):>8.1f} {stats[50]:>8.3f} {stats[99]:>8.3f} {oracle_ms:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Per-call cost of the in-process and shared-memory token-bucket rate
+limiters against the previous timestamp-list limiter, with many distinct
+clients, plus the limiter's memory once clients go idle and whether the
+shared limiter holds one client to its limit across worker processes.
+
+Usage:
+    python benchmarks/bench_rate_limit.py [--clients 100000] [--calls 1000000] [--workers 4]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.utils.rate_limit import SharedTokenBucketLimiter, TokenBucketLimiter
+
+
+class TimestampListLimiter:
+    """
+    The previous implementation: a list of request times per client,
+    rebuilt on every call and never evicted.
+    """
+    def __init__(self, requests_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.request_counts = defaultdict(list)
+
+    def allow(self, key, now):
+        self.request_counts[key] = [t for t in self.request_counts[key] if now - t < 60]
+        if len(self.request_counts[key]) >= self.requests_per_minute:
+            return False
+        self.request_counts[key].append(now)
+        return True
+
+    def __len__(self):
+        return len(self.request_counts)
+
+
+def client_sequence(clients, calls, hot_share, seed=42):
+    """
+    Client ids for each call: hot_share of the calls come from 1% of the
+    clients, the rest spread over all of them.
+    """
+    rng = random.Random(seed)
+    hot = max(1, clients // 100)
+    return [
+        f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+        for i in (rng.randrange(hot) if rng.random() < hot_share else rng.randrange(clients) for _ in range(calls))
+    ]
+
+
+def run(limiter, keys, duration):
+    """
+    Replay keys spread evenly over duration simulated seconds.
+    Returns (ns per call, allowed fraction).
+    """
+    step = duration / len(keys)
+    allowed = 0
+    started = time.perf_counter()
+    for i, key in enumerate(keys):
+        allowed += limiter.allow(key, i * step)
+    elapsed = time.perf_counter() - started
+    return elapsed / len(keys) * 1e9, allowed / len(keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=100_000)
+    parser.add_argument('--calls', type=int, default=1_000_000)
+    parser.add_argument('--limit', type=int, default=60, help='requests per minute')
+    parser.add_argument('--duration', type=float, default=60.0, help='simulated seconds the calls span')
+    parser.add_argument('--hot-share', type=float, default=0.5)
+    parser.add_argument('--workers', type=int, default=4, help='processes sharing one client in the fork test')
+    args = parser.parse_args()
+
+    keys = client_sequence(args.clients, args.calls, args.hot_share)
+    print(f"{args.calls} calls from {args.clients} clients over {args.duration:.0f} simulated s, "
+          f"limit {args.limit}/min")
+    print(f"{'limiter':<16} {'ns/call':>9} {'allowed':>8} {'keys kept':>10}")
+
+    for name, limiter in (
+        ('token bucket', TokenBucketLimiter(args.limit, max_keys=args.clients)),
+        ('shared memory', SharedTokenBucketLimiter(args.limit, max_keys=args.clients)),
+        ('timestamp list', TimestampListLimiter(args.limit)),
+    ):
+        ns, allowed = run(limiter, keys, args.duration)
+        print(f"{name:<16} {ns:>9.0f} {allowed:>8.1%} {len(limiter):>10}")
+
+    # Every client goes quiet; a trickle of new traffic drains the idle buckets
+    limiter = TokenBucketLimiter(args.limit, max_keys=args.clients)
+    run(limiter, keys, args.duration)
+    before = len(limiter)
+    later = args.duration + limiter.idle_after
+    for i in range(before):
+        limiter.allow(f"new-{i % 100}", later + i * 1e-6)
+    print(f"token bucket keys after clients go idle: {before} -> {len(limiter)} "
+          f"after {before} calls from 100 new clients")
+
+    if hasattr(os, 'fork'):
+        print(f"one client, {args.limit * 10} requests from each of {args.workers} processes: "
+              f"{fork_test(args.limit, args.workers)} allowed in total (limit {args.limit})")
+
+
+def fork_test(limit, workers):
+    """
+    Requests allowed for a single client hammering a shared limiter from
+    several forked processes at once.
+    """
+    limiter = SharedTokenBucketLimiter(limit)
+    read_end, write_end = os.pipe()
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            allowed = sum(limiter.allow('203.0.113.7') for _ in range(limit * 10))
+            os.write(write_end, f"{allowed}\n".encode())
+            os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    os.close(write_end)
+    with os.fdopen(read_end) as results:
+        return sum(int(line) for line in results)
+
+
+if __name__ == '__main__':
+    main()
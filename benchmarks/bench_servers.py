@@ -0,0 +1,157 @@
+"""
+Compare the threaded RequestHandler server with the asyncio server.
+
+Each server runs in its own subprocess; N concurrent clients then issue
+requests against an endpoint that does not touch the database, reusing
+their connection whenever the server allows keep-alive. Optionally a
+number of idle keep-alive connections are opened first, which is what
+trackers do in production.
+
+Bursts of new connections are sensitive to the listen backlog
+(SERVER_BACKLOG): with a small one the kernel drops SYNs and the client
+retries after about a second, which shows up as a ~1 s p99 that has
+nothing to do with the threading model.
+
+Usage:
+    python benchmarks/bench_servers.py [--clients 50] [--requests 200] [--idle 0]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATH = '/api/auth/login'
+
+
+def serve(kind, port, threads):
+    """
+    Run one server in this process (used by the subprocesses).
+    """
+    os.environ['RATE_LIMIT'] = str(10 ** 9)
+    sys.path.insert(0, ROOT)
+    from backend.config import SERVER_CONFIG
+    SERVER_CONFIG.update(host='127.0.0.1', port=port, threads=threads, mode='threaded',
+                         queue_size=threads * 8)
+
+    if kind == 'threaded':
+        from backend.server import _create_server
+        _create_server().serve_forever()
+    else:
+        from backend.async_server import serve as serve_async
+        asyncio.run(serve_async())
+
+
+async def read_response(reader):
+    """
+    Read one response; returns True if the connection can be reused.
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+        return headers.get('connection', '').lower() != 'close' and status_line.startswith(b'HTTP/1.1')
+    await reader.read()  # No length: body runs until the server closes
+    return False
+
+
+async def client(port, count, latencies, errors):
+    request = f"GET {PATH} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode()
+    reader = writer = None
+    for _ in range(count):
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request)
+            await writer.drain()
+            reusable = await read_response(reader)
+            latencies.append(time.perf_counter() - started)
+        except (ConnectionError, asyncio.IncompleteReadError, OSError):
+            errors.append(1)
+            reusable = False
+        if not reusable and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run_load(port, clients, requests, idle):
+    idle_connections = []
+    for _ in range(idle):
+        try:
+            idle_connections.append(await asyncio.open_connection('127.0.0.1', port))
+        except OSError:
+            break
+
+    latencies, errors = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*(client(port, requests, latencies, errors) for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+
+    for _, writer in idle_connections:
+        writer.close()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else float('nan')
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else float('nan')
+    return len(latencies) / elapsed, p50, p99, len(errors)
+
+
+def wait_for_port(port, timeout=10):
+    import socket
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200, help='requests per client')
+    parser.add_argument('--idle', type=int, default=0, help='idle keep-alive connections held open')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--serve', choices=['threaded', 'async'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=8900)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.threads)
+        return
+
+    print(f"{args.clients} clients x {args.requests} requests, {args.idle} idle connections, GET {PATH}")
+    print(f"{'server':<10} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'errors':>8}")
+    for offset, kind in enumerate(['threaded', 'async']):
+        port = args.port + offset
+        proc = subprocess.Popen(
+            [sys.executable, __file__, '--serve', kind, '--port', str(port), '--threads', str(args.threads)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_port(port)
+            rps, p50, p99, errors = asyncio.run(run_load(port, args.clients, args.requests, args.idle))
+            print(f"{kind:<10} {rps:>10.0f} {p50:>10.2f} {p99:>10.2f} {errors:>8}")
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
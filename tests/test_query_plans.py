@@ -0,0 +1,12 @@
+import os
+import pytest
+
+# Needs a PostgreSQL database, configured the same way as the server
+pytestmark = pytest.mark.skipif('DB_HOST' not in os.environ, reason='no database configured (set DB_HOST)')
+
+def test_hot_queries_use_indexes():
+    from backend.database.migrations import create_tables, check_query_plans
+
+    assert create_tables()
+    for name, seq_scans, plan in check_query_plans():
+        assert not seq_scans, f"{name} reads {', '.join(seq_scans)} with a sequential scan:\n{plan}"